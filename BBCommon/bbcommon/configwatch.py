@@ -0,0 +1,164 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Watches an agent's config file and calls back when it changes, so the agent can load the new settings  #
+# without restarting (a restart resets its outputs).                                                     #
+# On Linux the directory holding the file is watched with inotify, and the inotify descriptor is         #
+# registered with the agent's reactor, so a change is noticed the next time the reactor polls. Editors   #
+# often save by writing a new file and renaming it over the old one, which is why the directory (not the #
+# file) is watched. Where inotify isn't available the file's mtime, size and inode are polled instead.   #
+# An editor may write a file in several steps, so the callback runs once the file has been quiet for      #
+# 'settle' seconds, and only if its contents really changed.                                             #
+# ------------------------------------------------------------------------------------------------------ #
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import zlib
+
+
+_log = logging.getLogger(__name__)
+
+# Default watch settings. Anything under "config_watch" in the agent config overrides these.
+WATCH_DEFAULTS = {
+    'enabled': True,
+    'method': 'auto',           # 'inotify', 'poll', or 'auto' (inotify where it is available)
+    'poll_interval': 2.0,       # seconds between checks when polling
+    'settle': 0.5,              # seconds the file must be unchanged before it is reloaded
+}
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+EVENT = struct.Struct('iIII')   # wd, mask, cookie, len; followed by len bytes of name
+
+
+class Inotify(object):
+    """ An inotify descriptor watching one directory. fileno() lets the reactor poll it. """
+
+    def __init__(self, directory, mask):
+        path = ctypes.util.find_library('c')
+        if path is None:
+            raise OSError(errno.ENOSYS, 'No C library to call inotify through')
+        libc = ctypes.CDLL(path, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, directory.encode('utf-8'), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'Could not watch {}'.format(directory))
+
+    def fileno(self):
+        return self.fd
+
+    def names(self):
+        """ Names of the files that had events since the last call. """
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return names
+                raise
+            offset = 0
+            while offset + EVENT.size <= len(data):
+                length = EVENT.unpack_from(data, offset)[3]
+                start = offset + EVENT.size
+                names.add(data[start:start + length].rstrip(b'\0').decode('utf-8', 'replace'))
+                offset = start + length
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher(object):
+    """ Calls on_change(path) on agent's reactor after the file at path changes. """
+
+    def __init__(self, agent, path, on_change, config):
+        self.agent = agent
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+        self.config = dict(WATCH_DEFAULTS, **config)
+        self.method = None
+        self.inotify = None
+        self.stamp = None
+        self.checksum = None
+        self.settle_timer = None
+        self.changes = 0
+
+    def start(self):
+        if not self.config['enabled']:
+            return
+        self.stamp = self._stamp()
+        self.checksum = self._checksum()
+        if self.config['method'] in ('auto', 'inotify'):
+            try:
+                self.inotify = Inotify(os.path.dirname(self.path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            except (OSError, AttributeError) as error:
+                if self.config['method'] == 'inotify':
+                    raise
+                _log.info("inotify unavailable ({}); polling {} instead.".format(error, self.path))
+            else:
+                self.method = 'inotify'
+                self.agent.reactor.register(self.inotify, self._readable)
+                return
+        self.method = 'poll'
+        self.agent.periodic_timer(float(self.config['poll_interval']), self.poll)
+
+    def _readable(self, inotify):
+        """ Called by the reactor when inotify has events. """
+        if os.path.basename(self.path) in inotify.names():
+            self._changed()
+
+    def poll(self):
+        stamp = self._stamp()
+        if stamp != self.stamp:
+            self.stamp = stamp
+            self._changed()
+
+    def _changed(self):
+        # Wait for the writer to finish: every event restarts the wait.
+        if self.settle_timer is not None:
+            self.settle_timer.cancel()
+        self.settle_timer = self.agent.timer(float(self.config['settle']), self._settled)
+
+    def _settled(self):
+        self.settle_timer = None
+        checksum = self._checksum()
+        if checksum is None or checksum == self.checksum:
+            # Deleted (mid-rename) or rewritten with the same contents.
+            return
+        self.checksum = checksum
+        self.changes += 1
+        self.on_change(self.path)
+
+    def _stamp(self):
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return None
+        return (info.st_mtime, info.st_size, info.st_ino)
+
+    def _checksum(self):
+        try:
+            with open(self.path, 'rb') as config_file:
+                return zlib.crc32(config_file.read())
+        except IOError:
+            return None
+
+
+def log_level(name):
+    """ The logging level for a "log_level" config value such as "DEBUG" (NOTSET when it is None).
+        Raises ValueError for an unknown level. """
+    if name is None:
+        return logging.NOTSET
+    level = logging.getLevelName(str(name).upper())
+    if not isinstance(level, int):
+        raise ValueError('Unknown log_level {!r}'.format(name))
+    return level
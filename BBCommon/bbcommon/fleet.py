@@ -0,0 +1,274 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# A fleet snapshot: one small record per unit (BeagleBone), built from the status, heartbeat and metrics #
+# topics of many boards and kept indexed so the usual questions are answered without looking at every   #
+# unit.                                                                                                  #
+# Each board's messages reach the fleet agent under the unit's name:                                     #
+#     fleet/unit/<unit>/dhcontrol/heartbeat    (and .../dhcontrol/status, .../dhcontrol/metrics)         #
+# On the board, the control agent republishes them there itself (FORWARD_DEFAULTS: the unit is its agent #
+# id unless fleet.unit names it), and the platform's forwarder carries 'fleet/unit/' to the fleet agent. #
+# translate() turns a message into the record fields it sets; only the fields in RECORD_FIELDS are kept, #
+# so a record stays the same small size whatever the boards send.                                       #
+# Indexes, updated as each field changes:                                                                #
+#   - 'indexed' fields (compressor on, mode, degraded, online, ...): value -> set of units, so "units      #
+#     with the compressor on" is a dict lookup, and several conditions intersect the smallest set first; #
+#   - 'ranked' fields (run hours, starts, humidity): a sorted list of (value, unit), so "top 10 by run     #
+#     hours" reads 10 entries off the end (skipping units that don't meet the conditions).                #
+# Units are also kept in order of the last message from each. A unit silent for stale_after seconds is   #
+# marked offline, and one silent for expire_after seconds is dropped; each sweep only looks at the units  #
+# that have just gone over, at the front of the order. At most max_units are kept.                       #
+# Queries come on 'fleet/query' and are answered on the reply_to topic given:                            #
+#     {"where": {"dehum": "ON"}, "top": {"field": "run_hours", "count": 10}, "reply_to": "fleet/reply/me"} #
+#     {"summary": true, "reply_to": "fleet/reply/me"}     -> counts for each value of each indexed field   #
+# ------------------------------------------------------------------------------------------------------ #
+import bisect
+import itertools
+import logging
+from collections import OrderedDict
+
+
+_log = logging.getLogger(__name__)
+
+FLEET_PREFIX = 'fleet/unit/'
+FLEET_QUERY = 'fleet/query'
+FLEET_REPLY = 'fleet/reply/'
+FLEET_SUMMARY = 'fleet/summary'
+
+# Record fields, by the topic (under the unit's prefix) that sets them. 'degraded' is also set by a
+# ('FAILED', device, 'DEGRADED') status, and 'dehum' by a status for the dehumidifier.
+HEARTBEAT_FIELDS = ('dehum', 'fan', 'mode', 'dr', 'deferred')
+METRICS_FIELDS = ('run_hours', 'starts', 'humidity', 'temperature')
+RECORD_FIELDS = frozenset(HEARTBEAT_FIELDS + METRICS_FIELDS + ('degraded', 'online', 'seen'))
+
+# Default fleet settings. Anything under "fleet" in the fleet agent's config overrides these.
+FLEET_DEFAULTS = {
+    'max_units': 5000,          # units kept; messages from new units beyond this are ignored
+    'stale_after': 330.0,       # seconds without a message before a unit is marked offline
+    'expire_after': 86400.0,    # seconds without a message before a unit is dropped
+    'sweep_interval': 10.0,
+    'summary_interval': 60.0,   # seconds between summaries on fleet/summary (0: none)
+    'indexed': ['dehum', 'fan', 'mode', 'dr', 'deferred', 'degraded', 'online'],
+    'ranked': ['run_hours', 'starts', 'humidity'],
+    'max_results': 100,         # records returned by one query, at most
+    'max_name': 64,             # longest unit name accepted
+}
+
+
+# Default settings for forwarding a board's topics to the fleet. Anything under "fleet" in the control
+# agent's config overrides these.
+FORWARD_DEFAULTS = {
+    'enabled': True,
+    'unit': None,               # the unit's name in the fleet; None uses the agent id
+    'topics': ['dhcontrol/heartbeat', 'dhcontrol/status', 'dhcontrol/metrics'],
+}
+
+
+def check_forward_config(config):
+    """ Raise ValueError if the forwarding settings can't be used. """
+    config = dict(FORWARD_DEFAULTS, **config)
+    if not isinstance(config['topics'], list):
+        raise ValueError('The fleet topics setting must be a list of topics')
+    unit = config['unit']
+    if unit is not None and (not unit or '/' in unit or len(unit) > FLEET_DEFAULTS['max_name']):
+        raise ValueError('The fleet unit must be a name of 1 to {} characters without a /: {!r}'.format(
+            FLEET_DEFAULTS['max_name'], unit))
+    return config
+
+
+def unit_prefix(unit):
+    """ The prefix a unit's topics are forwarded under. """
+    return FLEET_PREFIX + unit + '/'
+
+
+def check_config(config):
+    """ Raise ValueError if the fleet settings can't be used. """
+    config = dict(FLEET_DEFAULTS, **config)
+    if int(config['max_units']) < 1 or int(config['max_results']) < 1:
+        raise ValueError('The fleet max_units and max_results must be at least 1')
+    if not 0 < float(config['stale_after']) <= float(config['expire_after']):
+        raise ValueError('The fleet stale_after must be greater than 0 and no more than expire_after')
+    if float(config['sweep_interval']) <= 0 or float(config['summary_interval']) < 0:
+        raise ValueError('The fleet sweep_interval must be greater than 0, and summary_interval not negative')
+    unknown = sorted((set(config['indexed']) | set(config['ranked'])) - RECORD_FIELDS)
+    if unknown:
+        raise ValueError('Unknown fleet record field(s) {}'.format(', '.join(unknown)))
+    return config
+
+
+def translate(source, message):
+    """ The record fields set by message, which came from a unit on topic source ('dhcontrol/heartbeat'). """
+    values = {}
+    if source == 'dhcontrol/heartbeat' and isinstance(message, dict):
+        state = message.get('state') or {}
+        for field in HEARTBEAT_FIELDS:
+            # Only plain values are kept, so every value can be indexed.
+            if field in state and not isinstance(state[field], (list, dict)):
+                values[field] = state[field]
+        if 'degraded' in state:
+            values['degraded'] = bool(state['degraded'])
+    elif source == 'dhcontrol/metrics' and isinstance(message, dict):
+        for field in METRICS_FIELDS:
+            if isinstance(message.get(field), (int, float)) and not isinstance(message[field], bool):
+                values[field] = message[field]
+    elif source == 'dhcontrol/status' and isinstance(message, list) and len(message) == 3:
+        result, component, mode = message
+        if result == 'FAILED' and mode == 'DEGRADED':
+            values['degraded'] = True
+        elif result == 'SUCCESS' and component == 'dehumidifier':
+            values['dehum'] = mode
+    return values
+
+
+class FleetIndex(object):
+    """ The fleet snapshot and its indexes. """
+
+    def __init__(self, config):
+        self.config = check_config(config)
+        self.units = {}
+        self.indexed = dict((field, {}) for field in self.config['indexed'])
+        self.ranked = dict((field, []) for field in self.config['ranked'])
+        # Units by time of their last message, oldest first: online units, and units gone offline.
+        self.online = OrderedDict()
+        self.offline = OrderedDict()
+        self.full = False
+        self.ignored = 0
+
+    def __len__(self):
+        return len(self.units)
+
+    def update(self, unit, values, now):
+        """ A message from unit, setting values. Returns False if the unit isn't (and can't be) kept. """
+        record = self.units.get(unit)
+        if record is None:
+            if len(self.units) >= int(self.config['max_units']) or len(unit) > int(self.config['max_name']):
+                self.ignored += 1
+                if not self.full and len(self.units) >= int(self.config['max_units']):
+                    _log.warning("The fleet is full ({} units); new units are ignored.".format(len(self.units)))
+                    self.full = True
+                return False
+            record = self.units[unit] = {'unit': unit}
+        for field, value in values.items():
+            if field in RECORD_FIELDS:
+                self._set(unit, record, field, value)
+        record['seen'] = now
+        if unit in self.offline:
+            del self.offline[unit]
+        elif unit in self.online:
+            del self.online[unit]
+        self.online[unit] = None
+        self._set(unit, record, 'online', True)
+        return True
+
+    def sweep(self, now):
+        """ Mark units silent for stale_after offline, and drop units silent for expire_after. Returns the
+            numbers marked offline and dropped. """
+        stale = now - float(self.config['stale_after'])
+        expired = now - float(self.config['expire_after'])
+        marked = dropped = 0
+        while self.online:
+            unit = next(iter(self.online))
+            record = self.units[unit]
+            if record['seen'] > stale:
+                break
+            del self.online[unit]
+            self.offline[unit] = None
+            self._set(unit, record, 'online', False)
+            marked += 1
+        while self.offline:
+            unit = next(iter(self.offline))
+            if self.units[unit]['seen'] > expired:
+                break
+            self.remove(unit)
+            dropped += 1
+        return marked, dropped
+
+    def remove(self, unit):
+        record = self.units.pop(unit, None)
+        if record is None:
+            return
+        self.online.pop(unit, None)
+        self.offline.pop(unit, None)
+        for field, value in record.items():
+            self._unindex(unit, field, value)
+        self.full = False
+
+    def query(self, where=None, top=None, limit=None):
+        """ The units whose indexed fields have the values in where (all of them), with their records: the
+            top['count'] by top['field'] (highest first, or lowest with "order": "asc"), or else up to limit
+            of them. The count is of all the units that match.
+            Raises ValueError for a field that isn't indexed (or ranked, for top). """
+        limit = min(int(limit or self.config['max_results']), int(self.config['max_results']))
+        sets = []
+        for field, value in (where or {}).items():
+            if field not in self.indexed:
+                raise ValueError('{!r} is not an indexed field (indexed: {})'.format(
+                    field, ', '.join(sorted(self.indexed))))
+            sets.append(self.indexed[field].get(_key(value), frozenset()))
+        # Smallest set first, so the intersection costs no more than the smallest set.
+        sets.sort(key=len)
+        candidates = None
+        if sets:
+            candidates = sets[0].intersection(*sets[1:]) if len(sets) > 1 else sets[0]
+        count = len(self.units) if candidates is None else len(candidates)
+        if top:
+            field = top.get('field')
+            if field not in self.ranked:
+                raise ValueError('{!r} is not a ranked field (ranked: {})'.format(
+                    field, ', '.join(sorted(self.ranked))))
+            wanted = min(int(top.get('count', 10)), limit)
+            entries = self.ranked[field] if top.get('order') == 'asc' else reversed(self.ranked[field])
+            units = []
+            for _, unit in entries:
+                if len(units) >= wanted:
+                    break
+                if candidates is None or unit in candidates:
+                    units.append(unit)
+        else:
+            # Any limit of them (in name order), so a big answer costs no more than limit records.
+            units = sorted(itertools.islice(self.units if candidates is None else candidates, limit))
+        return {'count': count, 'units': [dict(self.units[unit]) for unit in units]}
+
+    def summary(self):
+        """ The number of units with each value of each indexed field. """
+        return {'units': len(self.units),
+                'counts': dict((field, sorted([value, len(units)] for value, units in values.items() if units))
+                               for field, values in self.indexed.items())}
+
+    def _set(self, unit, record, field, value):
+        old = record.get(field, _MISSING)
+        if old == value and type(old) is type(value):
+            return
+        if old is not _MISSING:
+            self._unindex(unit, field, old)
+        record[field] = value
+        values = self.indexed.get(field)
+        if values is not None:
+            values.setdefault(_key(value), set()).add(unit)
+        ranked = self.ranked.get(field)
+        if ranked is not None and _rankable(value):
+            bisect.insort(ranked, (value, unit))
+
+    def _unindex(self, unit, field, value):
+        values = self.indexed.get(field)
+        if values is not None:
+            units = values.get(_key(value))
+            if units is not None:
+                units.discard(unit)
+                if not units:
+                    del values[_key(value)]
+        ranked = self.ranked.get(field)
+        if ranked is not None and _rankable(value):
+            index = bisect.bisect_left(ranked, (value, unit))
+            if index < len(ranked) and ranked[index] == (value, unit):
+                del ranked[index]
+
+
+_MISSING = object()
+
+
+def _key(value):
+    """ The index key for a value from a query: lists (which can't be dict keys) become tuples. """
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _rankable(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
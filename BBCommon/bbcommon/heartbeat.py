@@ -0,0 +1,107 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Change-only status heartbeat for the control agents.                                                   #
+# The agent describes its state as a small dict (pin levels, flags, mode). Heartbeat publishes            #
+#   - a full snapshot every full_interval seconds, and whenever a subscriber asks for one;               #
+#   - a delta holding only the keys that changed, when the state is checked and something changed.       #
+# The state is checked every check_interval seconds and right after each command (the agent calls        #
+# check()), so nothing is published while nothing changes.                                               #
+# Every message carries a sequence number one higher than the last:                                      #
+#     {'seq': 12, 'type': 'delta', 'time': 1400000000.0, 'state': {'fan': 'ON'}}                         #
+# A subscriber that sees a gap in the numbers has missed a delta and should ask for a full snapshot by   #
+# publishing on the agent's request topic. HeartbeatTracker does that bookkeeping for subscribers.       #
+# ------------------------------------------------------------------------------------------------------ #
+import time
+
+
+# Default heartbeat settings. Anything under "heartbeat" in the agent config overrides these.
+HEARTBEAT_DEFAULTS = {
+    'enabled': True,
+    'full_interval': 300.0,     # seconds between full snapshots
+    'check_interval': 10.0,     # seconds between checks for changes
+}
+
+
+class Heartbeat(object):
+    """ Publishes snapshot() on topic: full snapshots on a slow timer, deltas when it changes. """
+
+    def __init__(self, agent, topic, snapshot, config):
+        self.agent = agent
+        self.topic = topic
+        self.snapshot = snapshot
+        self.config = dict(HEARTBEAT_DEFAULTS, **config)
+        self.seq = 0
+        self.last = None
+        self.sent = 0
+        self.timers = []
+
+    def start(self):
+        if self.config['enabled']:
+            self.publish_full()
+            self.timers = [self.agent.periodic_timer(float(self.config['full_interval']), self.publish_full),
+                           self.agent.periodic_timer(float(self.config['check_interval']), self.check)]
+
+    def reconfigure(self, config):
+        """ Switch to new settings, restarting the timers only if they changed. """
+        config = dict(HEARTBEAT_DEFAULTS, **config)
+        if config == self.config:
+            return
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
+        self.config = config
+        self.last = None
+        self.start()
+
+    def publish_full(self):
+        self.last = self.snapshot()
+        self._publish('full', self.last)
+
+    def check(self):
+        """ Publish a delta if the state changed since the last message. """
+        if not self.config['enabled'] or self.last is None:
+            return
+        state = self.snapshot()
+        delta = dict((key, value) for key, value in state.items() if self.last.get(key) != value)
+        if delta:
+            self.last = state
+            self._publish('delta', delta)
+
+    def _publish(self, kind, state):
+        self.seq += 1
+        self.sent += 1
+        self.agent.publish_json(self.topic, {}, {'seq': self.seq, 'type': kind, 'time': time.time(),
+                                                 'state': state})
+
+
+def check_config(config):
+    """ Raise ValueError if the heartbeat settings can't be used. """
+    config = dict(HEARTBEAT_DEFAULTS, **config)
+    for key in ('full_interval', 'check_interval'):
+        if float(config[key]) <= 0:
+            raise ValueError('The heartbeat {} must be greater than 0'.format(key))
+
+
+class HeartbeatTracker(object):
+    """ Rebuilds an agent's state from its heartbeat messages. """
+
+    def __init__(self):
+        self.state = None
+        self.seq = None
+        self.missed = 0
+
+    def update(self, message):
+        """ Apply one heartbeat message. Returns False if a delta was missed and a full snapshot is needed. """
+        if message['type'] == 'full':
+            self.state = dict(message['state'])
+            self.seq = message['seq']
+            return True
+        if self.state is None or message['seq'] != self.seq + 1:
+            # Deltas only make sense on top of everything before them: wait for the next full snapshot.
+            if self.state is not None:
+                self.missed += 1
+            self.state = None
+            self.seq = None
+            return False
+        self.state.update(message['state'])
+        self.seq = message['seq']
+        return True
@@ -0,0 +1,383 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Blocking hardware I/O for the control agents (GPIO reads and writes through bbio, the sensor's sysfs   #
+# or file reads) runs on a small pool of worker threads, so a slow or hung pin holds up the agent's      #
+# reactor, and with it every topic the agent handles, for at most 'timeout' seconds.                     #
+# Operations are queued by key (the pin). Operations on one key run one at a time, in the order they     #
+# were queued; operations on different keys run on different workers at the same time.                  #
+#   - call(key, function, *args) waits up to 'timeout' seconds for the operation and returns its result  #
+#     (or raises its exception) on the reactor thread, as if it had run there. An operation that takes   #
+#     longer is counted as stalled and IOStalled is raised; the caller carries on without it (a write    #
+#     that didn't happen reads back wrong, and is retried; see retry.py). A call still queued behind it  #
+#     is withdrawn, and until the stalled operation ends, calls on its key fail at once.                 #
+#   - call_all() queues several operations before waiting for any, so writes to different pins (both     #
+#     relays on a kill) happen together.                                                                 #
+#   - post(key, function, *args) queues an operation without waiting (an LED pattern step). A post still #
+#     queued when a newer post for the same key arrives is dropped: posts set a level, and only the      #
+#     newest one matters. A post running for longer than the timeout is found by check() and counted.    #
+# Waiting in call() blocks the reactor on purpose. The agents' write, read-back and retry steps use      #
+# each result in line, so the wait is kept short rather than turned into callbacks: a working GPIO or    #
+# ADC operation takes well under a millisecond, and 'timeout' defaults to 20 ms. A hung pin costs the    #
+# reactor that much once; later calls on its key fail at once until it ends.                             #
+# A stalled operation holds on to its worker, so another is started in its place; there are at most      #
+# 'workers' threads plus one per stalled key. When a stalled operation ends, the workers post it back to #
+# the reactor through a pipe the reactor watches (and check() picks it up on a timer too), and the agent #
+# is called back with its key: a write that ended late may have changed a pin after it was given up on.  #
+# Stalls and recoveries are logged and published on <prefix>/io:                                         #
+#     {'event': 'stalled', 'key': 'GPIO1_28', 'operation': 'digitalWrite', 'stalls': 3, 'stuck': [...]}  #
+#     {'event': 'recovered', 'key': 'GPIO1_28', 'operation': 'digitalWrite', 'seconds': 4.2, 'stuck': []} #
+# With 'enabled' false every operation runs inline on the reactor thread.                                #
+# ------------------------------------------------------------------------------------------------------ #
+import errno
+import fcntl
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+
+_log = logging.getLogger(__name__)
+
+# Real elapsed time for the workers: a simulation may replace time.time.
+_clock = getattr(time, 'monotonic', time.time)
+
+# Default I/O settings. Anything under "io" in the agent config overrides these.
+IO_DEFAULTS = {
+    'enabled': True,
+    'workers': 2,               # worker threads, besides one for each stalled key
+    'timeout': 0.02,            # seconds an operation may take before it is counted as stalled (and
+                                # the longest the reactor waits for a call)
+    'check_interval': 1.0,      # seconds between checks for stalled posts and ended stalls
+}
+
+
+def check_config(config):
+    """ Raise ValueError if the I/O settings can't be used. """
+    config = dict(IO_DEFAULTS, **config)
+    if int(config['workers']) < 1:
+        raise ValueError('The io workers must be at least 1')
+    if float(config['timeout']) <= 0 or float(config['check_interval']) <= 0:
+        raise ValueError('The io timeout and check_interval must be greater than 0')
+    return config
+
+
+class IOStalled(Exception):
+    """ Raised by call() when an operation didn't end within the timeout, or its key is stuck on one that
+        didn't. """
+
+
+class Operation(object):
+    """ One queued call or post. """
+    __slots__ = ('key', 'function', 'args', 'posted', 'started', 'ended', 'result', 'error', 'done', 'stalled')
+
+    def __init__(self, key, function, args, posted):
+        self.key = key
+        self.function = function
+        self.args = args
+        self.posted = posted
+        self.started = None
+        self.ended = None
+        self.result = None
+        self.error = None
+        self.done = None if posted else threading.Event()
+        self.stalled = False
+
+    def name(self):
+        return getattr(self.function, '__name__', repr(self.function))
+
+
+class Wakeup(object):
+    """ A pipe the workers write a byte to when a stalled operation has ended. fileno() lets the reactor
+        poll it. """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.read_fd
+
+    def set(self):
+        try:
+            os.write(self.write_fd, b'x')
+        except OSError as error:
+            # A full pipe already has the reactor's attention.
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def clear(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+
+class IOPool(object):
+    """ Runs agent's blocking I/O on worker threads, in order per key, with a timeout on each operation.
+        recovered(key) is called on the reactor when a stalled operation on key has ended. """
+
+    def __init__(self, agent, prefix, config, recovered=None):
+        self.agent = agent
+        self.prefix = prefix
+        self.recovered = recovered
+        self.config = check_config(config)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.queues = {}            # key -> operations waiting, oldest first
+        self.ready = deque()        # keys with operations waiting and none running, in the order they became so
+        self.busy = {}              # key -> operation running
+        self.stuck = {}             # key -> stalled operation still running
+        self.ended = deque()        # stalled operations that have ended, for the reactor
+        self.threads = 0
+        self.idle = 0
+        self.pipe = None
+        self.timer = None
+        # Counts for the agent's status: operations run, stalls, calls refused on a stuck key and posts
+        # dropped for a newer one.
+        self.operations = 0
+        self.stalls = 0
+        self.refused = 0
+        self.dropped = 0
+
+    def start(self):
+        """ Watch for ended stalls on the reactor, and check for stalled posts on a timer. """
+        if self.pipe is None:
+            self.pipe = Wakeup()
+            self.agent.reactor.register(self.pipe, self._readable)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.agent.periodic_timer(float(self.config['check_interval']), self.check)
+
+    def reconfigure(self, config):
+        """ Switch to new settings. Extra workers leave as they finish; queued operations still run. """
+        config = check_config(config)
+        restart = config['check_interval'] != self.config['check_interval']
+        with self.lock:
+            self.config = config
+            self.wakeup.notify_all()
+        if restart and self.timer is not None:
+            self.start()
+
+    def call(self, key, function, *args):
+        """ Run function(*args) after the operations already queued for key, and return its result. Raises
+            IOStalled if it takes longer than the timeout (or key is stuck). """
+        if not self.config['enabled']:
+            return function(*args)
+        operation = self._queue([Operation(key, function, args, False)])[0]
+        return self._result(operation, _clock() + float(self.config['timeout']))
+
+    def call_all(self, operations):
+        """ Queue (key, function, args) operations together, then wait for them all, up to one timeout.
+            Returns a list with each one's result, or the IOStalled (or other exception) it raised. """
+        if not self.config['enabled']:
+            results = []
+            for key, function, args in operations:
+                try:
+                    results.append(function(*args))
+                except Exception as error:
+                    results.append(error)
+            return results
+        results = []
+        deadline = _clock() + float(self.config['timeout'])
+        for operation in self._queue([Operation(key, function, args, False) for key, function, args in operations]):
+            try:
+                results.append(self._result(operation, deadline))
+            except Exception as error:
+                results.append(error)
+        return results
+
+    def post(self, key, function, *args):
+        """ Run function(*args) after the operations already queued for key, without waiting for it. """
+        if not self.config['enabled']:
+            function(*args)
+            return
+        self._queue([Operation(key, function, args, True)])
+
+    def check(self):
+        """ Deal with stalled operations that have ended, and count posts that have run past the timeout. """
+        self._finish_ended()
+        with self.lock:
+            stalled = self._overdue()
+        for operation in stalled:
+            self._report_stall(operation)
+
+    def stuck_keys(self):
+        """ Keys with a stalled operation that hasn't ended yet. """
+        with self.lock:
+            return sorted(str(key) for key in self.stuck)
+
+    def counts(self):
+        return {'operations': self.operations, 'stalls': self.stalls, 'refused': self.refused,
+                'dropped': self.dropped, 'stuck': self.stuck_keys()}
+
+    def _queue(self, operations):
+        """ Queue operations (refusing calls on a stuck key) and wake or start workers for them. Returns the
+            operations queued or refused, with the refused ones marked stalled. """
+        overdue = []
+        with self.lock:
+            if self.busy and not all(operation.posted for operation in operations):
+                # A call would wait behind an operation already past the timeout: find it now.
+                overdue = self._overdue()
+            for operation in operations:
+                if not operation.posted and operation.key in self.stuck:
+                    operation.stalled = True
+                    self.refused += 1
+                    continue
+                queue = self.queues.get(operation.key)
+                if queue is None:
+                    queue = self.queues[operation.key] = deque()
+                    if operation.key not in self.busy:
+                        self.ready.append(operation.key)
+                if operation.posted and queue and queue[-1].posted:
+                    queue[-1] = operation
+                    self.dropped += 1
+                else:
+                    queue.append(operation)
+            self._wake()
+        for earlier in overdue:
+            self._report_stall(earlier)
+        return operations
+
+    def _wake(self):
+        """ With the lock held: wake an idle worker for the ready keys, or start one if there is room. """
+        if not self.ready:
+            return
+        if self.idle:
+            self.wakeup.notify()
+        elif self.threads - len(self.stuck) < int(self.config['workers']):
+            self.threads += 1
+            thread = threading.Thread(target=self._work, name='{}-io-{}'.format(self.prefix, self.threads))
+            thread.daemon = True
+            thread.start()
+
+    def _result(self, operation, deadline):
+        """ Wait for a queued call, up to deadline. A call that hasn't started by then is withdrawn (it waited
+            behind another that stalled); one that has is counted as stalled. """
+        if operation.stalled:
+            raise IOStalled('{} is stuck on an earlier operation'.format(operation.key))
+        operation.done.wait(max(0.0, deadline - _clock()))
+        overdue = []
+        with self.lock:
+            withdrawn = operation.started is None
+            stalled = operation.ended is None and not withdrawn
+            if withdrawn:
+                self._withdraw(operation)
+                # Most likely a post ahead of it on the key has stalled: mark it now, not at the next check.
+                overdue = self._overdue()
+            elif stalled:
+                self._stall(operation)
+        for earlier in overdue:
+            self._report_stall(earlier)
+        if withdrawn:
+            raise IOStalled('{} on {} waited longer than {} seconds to start'.format(
+                operation.name(), operation.key, self.config['timeout']))
+        if stalled:
+            self._report_stall(operation)
+            raise IOStalled('{} on {} took longer than {} seconds'.format(
+                operation.name(), operation.key, self.config['timeout']))
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def _withdraw(self, operation):
+        """ With the lock held: take a call that hasn't started off its key's queue. """
+        queue = self.queues[operation.key]
+        queue.remove(operation)
+        if not queue:
+            del self.queues[operation.key]
+            if operation.key in self.ready:
+                self.ready.remove(operation.key)
+        self.refused += 1
+
+    def _overdue(self):
+        """ With the lock held: mark the running operations that have gone past the timeout stalled, and return
+            them. """
+        now = _clock()
+        overdue = [operation for operation in self.busy.values()
+                   if not operation.stalled and now - operation.started > float(self.config['timeout'])]
+        for operation in overdue:
+            self._stall(operation)
+        return overdue
+
+    def _stall(self, operation):
+        """ With the lock held: mark operation stalled, and start a worker in place of the one it holds. """
+        operation.stalled = True
+        self.stuck[operation.key] = operation
+        self.stalls += 1
+        self._wake()
+
+    def _report_stall(self, operation):
+        stuck = self.stuck_keys()
+        _log.warning("{} on {} has taken longer than {} seconds; {} stall(s) so far, stuck: {}.".format(
+            operation.name(), operation.key, self.config['timeout'], self.stalls, ', '.join(stuck)))
+        self.agent.publish_json(self.prefix + '/io', {}, {'event': 'stalled', 'key': str(operation.key),
+                                                          'operation': operation.name(), 'stalls': self.stalls,
+                                                          'stuck': stuck})
+
+    def _readable(self, pipe):
+        """ Called by the reactor when a stalled operation has ended. """
+        self._finish_ended()
+
+    def _finish_ended(self):
+        if self.pipe is not None:
+            self.pipe.clear()
+        while self.ended:
+            operation = self.ended.popleft()
+            seconds = operation.ended - operation.started
+            stuck = self.stuck_keys()
+            _log.info("{} on {} ended after {:.2f} seconds{}.".format(
+                operation.name(), operation.key, seconds,
+                '' if operation.error is None else ' with an error ({})'.format(operation.error)))
+            self.agent.publish_json(self.prefix + '/io', {}, {'event': 'recovered', 'key': str(operation.key),
+                                                              'operation': operation.name(),
+                                                              'seconds': round(seconds, 3), 'stuck': stuck})
+            if self.recovered is not None:
+                self.recovered(operation.key)
+
+    def _work(self):
+        """ A worker thread: run the operations of one ready key after another. """
+        self.lock.acquire()
+        try:
+            while True:
+                while not self.ready and self.threads - len(self.stuck) <= int(self.config['workers']):
+                    self.idle += 1
+                    self.wakeup.wait()
+                    self.idle -= 1
+                if self.threads - len(self.stuck) > int(self.config['workers']):
+                    # Fewer workers are wanted (a stall has ended, or the config changed).
+                    self.threads -= 1
+                    self._wake()
+                    return
+                key = self.ready.popleft()
+                queue = self.queues[key]
+                operation = queue.popleft()
+                if not queue:
+                    del self.queues[key]
+                self.busy[key] = operation
+                operation.started = _clock()
+                self.lock.release()
+                try:
+                    operation.result = operation.function(*operation.args)
+                except Exception as error:
+                    operation.error = error
+                    if operation.posted:
+                        _log.error("{} on {} failed: {}".format(operation.name(), key, error))
+                finally:
+                    self.lock.acquire()
+                operation.ended = _clock()
+                self.operations += 1
+                del self.busy[key]
+                if key in self.queues:
+                    self.ready.append(key)
+                if operation.stalled:
+                    del self.stuck[key]
+                    self.ended.append(operation)
+                    if self.pipe is not None:
+                        self.pipe.set()
+                if operation.done is not None:
+                    operation.done.set()
+        finally:
+            self.lock.release()
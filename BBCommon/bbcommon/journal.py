@@ -0,0 +1,136 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Write-ahead journal of the commands an input agent publishes, so a control agent that was down (or     #
+# restarting) when a command went out can catch up when it starts.                                       #
+# Before publishing a command, the input agent appends one JSON line to the journal:                      #
+#     {"epoch": "3f2a...", "seq": 42, "command": "run dehum",                                            #
+#      "desired": {"dehumidifier": true, "fan": false, "mode": "manual"}}                                #
+# and sends the epoch and seq with the command (JournalEpoch/JournalSeq headers). "desired" is the whole  #
+# state the input agent wants after the command, so the last record is all a control agent needs: it     #
+# saves the position of the last command it handled and, at start-up, applies the last record after that #
+# position (pending()), never the commands in between.                                                  #
+# Appending is a write() into the page cache, so handle_input doesn't wait for the disk. The journal is   #
+# fsynced in batches, sync_interval seconds after the first unsynced append. When the file grows past    #
+# max_bytes it is rewritten (at sync time) with only its last record. The epoch changes when the journal #
+# is started afresh, so a position from an older journal is never mistaken for one in this journal.      #
+# ------------------------------------------------------------------------------------------------------ #
+import json
+import logging
+import os
+import uuid
+
+
+_log = logging.getLogger(__name__)
+
+JOURNAL_EPOCH = 'JournalEpoch'
+JOURNAL_SEQ = 'JournalSeq'
+
+# Default journal settings. Anything under "journal" in the agent config overrides these.
+JOURNAL_DEFAULTS = {
+    'enabled': True,
+    # Absolute, since the writer (AskAgent) and the reader (DehumAgent) each run in their own directory.
+    'path': '/home/debian/startAtBoot/userinput.journal',
+    'sync_interval': 0.2,       # seconds from the first unsynced append to the fsync
+    'max_bytes': 65536,         # size at which the journal is compacted to its last record
+}
+
+_fsync = getattr(os, 'fdatasync', os.fsync)
+
+
+def read_last(path):
+    """ The last complete record in the journal at path, or None. Damaged lines are skipped. """
+    try:
+        with open(path, 'rb') as journal:
+            data = journal.read()
+    except IOError:
+        return None
+    for line in reversed(data.split(b'\n')):
+        if not line.strip():
+            continue
+        try:
+            return json.loads(line.decode('utf-8'))
+        except ValueError:
+            # Torn by a crash in the middle of an append, or damaged.
+            continue
+    return None
+
+
+def pending(path, position):
+    """ The last record in the journal that comes after position ([epoch, seq]), or None if there is none. """
+    record = read_last(path)
+    if record is None:
+        return None
+    if position and position[0] == record['epoch'] and record['seq'] <= position[1]:
+        return None
+    return record
+
+
+class CommandJournal(object):
+    """ Appends records to the journal for agent, syncing them to disk in batches on agent's timers. """
+
+    def __init__(self, agent, config):
+        self.agent = agent
+        self.config = dict(JOURNAL_DEFAULTS, **config)
+        self.path = self.config['path']
+        self.fd = None
+        self.last = None
+        self.epoch = None
+        self.seq = 0
+        self.size = 0
+        self.sync_timer = None
+        self.syncs = 0
+
+    def open(self):
+        """ Open the journal, returning its last record (the state wanted before a restart) or None. """
+        self.last = read_last(self.path)
+        if self.last is not None:
+            self.epoch, self.seq = self.last['epoch'], self.last['seq']
+        else:
+            self.epoch, self.seq = uuid.uuid4().hex, 0
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        if self.size and self.last is not None:
+            # Start from just the last good record (this also drops a line torn by a crash, which the
+            # next record would otherwise run into).
+            self.compact()
+        return self.last
+
+    def append(self, command, desired):
+        """ Journal a command and the state wanted after it. Returns the headers to publish it with. """
+        self.seq += 1
+        self.last = {'epoch': self.epoch, 'seq': self.seq, 'command': command, 'desired': desired}
+        line = (json.dumps(self.last, sort_keys=True) + '\n').encode('utf-8')
+        try:
+            os.write(self.fd, line)
+        except OSError as error:
+            _log.error("Could not write to the command journal {}: {}".format(self.path, error))
+        self.size += len(line)
+        if self.sync_timer is None:
+            self.sync_timer = self.agent.timer(float(self.config['sync_interval']), self.sync)
+        return {JOURNAL_EPOCH: self.epoch, JOURNAL_SEQ: self.seq}
+
+    def sync(self):
+        """ Flush the appended records to disk, compacting the journal if it has grown too large. """
+        self.sync_timer = None
+        try:
+            if self.size > int(self.config['max_bytes']):
+                self.compact()
+            else:
+                _fsync(self.fd)
+            self.syncs += 1
+        except OSError as error:
+            _log.error("Could not sync the command journal {}: {}".format(self.path, error))
+
+    def compact(self):
+        """ Replace the journal with its last record. """
+        temporary = self.path + '.tmp'
+        line = (json.dumps(self.last, sort_keys=True) + '\n').encode('utf-8')
+        descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(descriptor, line)
+            _fsync(descriptor)
+        finally:
+            os.close(descriptor)
+        os.rename(temporary, self.path)
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.size = len(line)
@@ -0,0 +1,109 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Last-value cache: the most recent message on each cached topic, so an agent that starts (or restarts)  #
+# after a command was sent can ask for the current value instead of waiting for the next one.            #
+# Which topics are cached is set by prefix. A prefix's rule can give a 'key': the index in the message   #
+# of a value that keeps separate entries within one topic (the component, for the status topics, whose   #
+# messages are ('SUCCESS', 'fan', 'ON')). With 'devices' as well, the entry is kept under the first      #
+# word of that value that names a device, or the whole value if none does: the commands on               #
+# 'userinput/state' are kept one per device ('run dehum' under 'dehum', 'green on' under 'green', 'auto' #
+# under 'auto'), so a command to one device doesn't replace the last command to another. A message       #
+# whose key is listed under 'clear' ('kill') replaces every entry of its topic. A rule can also 'skip'   #
+# messages whose last element is listed ('status' commands don't change the desired state).              #
+# Only the last value per topic and key is kept, never the history. A request names topic prefixes and   #
+# a reply topic:                                                                                         #
+#     cache/request  {'prefixes': ['userinput/state'], 'reply_to': 'cache/reply/DH_Control_1'}           #
+# and everything cached under those prefixes comes back in one message on the reply topic, each topic's  #
+# entries in the order they arrived, so applying them in turn gives the current state:                   #
+#     {'values': [{'topic': 'userinput/state', 'key': 'dehum', 'headers': {...}, 'message': [...]}]}     #
+# Cached topics are kept in a sorted list, so a prefix is found by bisection and a request costs         #
+# O(log n + matches) however many device topics are cached.                                              #
+# ------------------------------------------------------------------------------------------------------ #
+import bisect
+import logging
+
+
+_log = logging.getLogger(__name__)
+
+CACHE_REQUEST = 'cache/request'
+CACHE_REPLY = 'cache/reply/'
+
+# Default cache settings. Anything under "cache" in the cache agent's config overrides these.
+CACHE_DEFAULTS = {
+    'topics': {
+        'userinput/state': {'key': 1, 'devices': ['dehum', 'fan', 'green', 'red', 'leds'],
+                            'clear': ['kill'], 'skip': ['status']},
+        'dhcontrol/status': {'key': 1},
+        'LEDcontrol/status': {'key': 1},
+    },
+    'max_entries': 10000,       # entries (topic and key) kept; new ones beyond this are not cached
+}
+
+
+def request(agent, agent_id, prefixes):
+    """ Ask the cache agent for the values under prefixes. The reply comes on CACHE_REPLY + agent_id. """
+    agent.publish_json(CACHE_REQUEST, {}, {'prefixes': list(prefixes), 'reply_to': CACHE_REPLY + agent_id})
+
+
+class LastValueCache(object):
+    """ The last message on each cached topic (and key). """
+
+    def __init__(self, config):
+        self.config = dict(CACHE_DEFAULTS, **config)
+        # Longest prefix first, so the most specific rule wins.
+        self.rules = sorted(self.config['topics'].items(), key=lambda item: -len(item[0]))
+        self.values = {}        # topic -> {key: entry}
+        self.topics = []        # the cached topics, sorted
+        self.entries = 0
+        self.sequence = 0       # entries are numbered as they arrive, to send them back in that order
+        self.full = False
+
+    def rule(self, topic):
+        """ The caching rule for topic, or None if it isn't cached. """
+        for prefix, rule in self.rules:
+            if topic.startswith(prefix):
+                return rule
+        return None
+
+    def update(self, topic, headers, message, rule=None):
+        """ Keep message (decoded) as the last value on topic. Returns True if it was cached. """
+        rule = self.rule(topic) if rule is None else rule
+        if rule is None:
+            return False
+        if isinstance(message, list) and message and message[-1] in rule.get('skip', ()):
+            return False
+        key = None
+        if rule.get('key') is not None and isinstance(message, list) and len(message) > rule['key']:
+            key = message[rule['key']]
+            if rule.get('devices') and hasattr(key, 'split'):
+                key = next((word for word in key.split() if word in rule['devices']), key)
+        entries = self.values.get(topic)
+        if entries is not None and key in rule.get('clear', ()):
+            self.entries -= len(entries)
+            entries.clear()
+        if entries is None or key not in entries:
+            if self.entries >= int(self.config['max_entries']):
+                if not self.full:
+                    _log.warning("The cache is full ({} entries); new topics are not cached.".format(self.entries))
+                    self.full = True
+                return False
+            if entries is None:
+                entries = self.values[topic] = {}
+                bisect.insort(self.topics, topic)
+            self.entries += 1
+        self.sequence += 1
+        entries[key] = {'topic': topic, 'key': key, 'headers': headers, 'message': message, 'seq': self.sequence}
+        return True
+
+    def query(self, prefixes):
+        """ Every cached entry on a topic starting with one of prefixes, each topic's oldest first. """
+        found = []
+        seen = set()
+        for prefix in prefixes:
+            index = bisect.bisect_left(self.topics, prefix)
+            while index < len(self.topics) and self.topics[index].startswith(prefix):
+                topic = self.topics[index]
+                if topic not in seen:
+                    seen.add(topic)
+                    found.extend(sorted(self.values[topic].values(), key=lambda entry: entry['seq']))
+                index += 1
+        return found
@@ -0,0 +1,28 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Modules imported on first use instead of when the agent module is imported.                            #
+# bbio probes the BeagleBone hardware when it is imported, which takes most of an agent's start-up time. #
+# With                                                                                                   #
+#     bbio = LazyModule('bbio')                                                                          #
+# the agent can join the bus first and pay for the import the first time it touches bbio.HIGH,          #
+# bbio.digitalWrite and so on. Each attribute is looked up once and then kept on the LazyModule.         #
+# ------------------------------------------------------------------------------------------------------ #
+import importlib
+
+
+class LazyModule(object):
+    """ Stands in for the module called name until one of its attributes is needed. """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        value = getattr(self._module, attribute)
+        self.__dict__[attribute] = value
+        return value
@@ -0,0 +1,89 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Token-bucket rate limiting for the commands typed into an input agent, so a script looping over the   #
+# telnet port can't flood userinput/state and make the relays chatter.                                   #
+# Each connection has a bucket, and all connections share a global one. A bucket holds up to 'burst'     #
+# tokens and refills at 'rate' tokens per second; a command takes one token from both buckets, and is    #
+# rejected (taking none) if either is empty. Refilling is worked out from the time since the bucket was  #
+# last used, so a command costs O(1) and no timers are needed. Exempt commands ('kill') are never         #
+# limited.                                                                                               #
+# ------------------------------------------------------------------------------------------------------ #
+import logging
+import time
+
+
+_log = logging.getLogger(__name__)
+
+# Default limits. Anything under "rate_limit" in the agent config overrides these.
+RATE_LIMIT_DEFAULTS = {
+    'enabled': True,
+    'connection_burst': 5,      # commands a connection can send at once
+    'connection_rate': 1.0,     # commands per second a connection can keep up
+    'global_burst': 20,         # the same, for all connections together
+    'global_rate': 5.0,
+    'exempt': ['kill'],         # commands that are never limited
+}
+
+
+class TokenBucket(object):
+    """ Up to burst tokens, refilled at rate per second. """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'limited')
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = now
+        # True from a rejection until the next accepted command, so a flood is only logged once.
+        self.limited = False
+
+    def refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+
+class CommandLimiter(object):
+    """ Per-connection and global token buckets for an input agent. """
+
+    def __init__(self, config):
+        self.config = dict(RATE_LIMIT_DEFAULTS, **config)
+        if float(self.config['connection_rate']) <= 0 or float(self.config['global_rate']) <= 0:
+            raise ValueError('The rate_limit rates must be greater than 0')
+        if float(self.config['connection_burst']) < 1 or float(self.config['global_burst']) < 1:
+            raise ValueError('The rate_limit bursts must be at least 1')
+        self.enabled = bool(self.config['enabled'])
+        self.exempt = frozenset(self.config['exempt'])
+        self.buckets = {}
+        self.shared = TokenBucket(self.config['global_rate'], self.config['global_burst'], time.time())
+        self.rejected = 0
+
+    def check(self, connection, command):
+        """ Take a token for command from connection. Returns None if it may go ahead, or a message saying
+            which limit it is over. """
+        if not self.enabled or command in self.exempt:
+            return None
+        now = time.time()
+        bucket = self.buckets.get(connection)
+        if bucket is None:
+            bucket = self.buckets[connection] = TokenBucket(self.config['connection_rate'],
+                                                            self.config['connection_burst'], now)
+        if bucket.refill(now) < 1.0:
+            limit = 'this connection is limited to {} commands per second'.format(self.config['connection_rate'])
+        elif self.shared.refill(now) < 1.0:
+            limit = 'all connections together are limited to {} commands per second'.format(
+                self.config['global_rate'])
+        else:
+            bucket.tokens -= 1.0
+            self.shared.tokens -= 1.0
+            bucket.limited = False
+            return None
+        self.rejected += 1
+        if not bucket.limited:
+            bucket.limited = True
+            _log.warning("Rejecting commands from connection {}: {}.".format(connection, limit))
+        return limit
+
+    def forget(self, connection):
+        """ Drop a closed connection's bucket. """
+        self.buckets.pop(connection, None)
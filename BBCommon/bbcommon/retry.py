@@ -0,0 +1,128 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Retries for GPIO writes whose read-back doesn't match (a relay that didn't pull in, a loose wire).     #
+# An actuation is a function that writes a pin, reads it back and returns True if they match. When it    #
+# fails, RetryEngine calls it again after an exponential backoff with jitter:                            #
+#     delay = min(max_delay, base_delay * 2 ** (attempt - 1)) * uniform(1 - jitter, 1)                   #
+# up to 'budget' retries per device. When the budget is used up the device is marked degraded: commands  #
+# that turn it on then fail fast (nothing is written) until degraded_timeout has passed or the device    #
+# reads back correctly again. Commands that turn a device off are always attempted, since off is the     #
+# safe state.                                                                                            #
+# Every retry and outcome is counted per device and published on <prefix>/retry, e.g.                    #
+#     {'device': 'fan', 'event': 'recovered', 'attempt': 2, 'counts': {...}}                             #
+# ------------------------------------------------------------------------------------------------------ #
+import logging
+import random
+import time
+
+
+_log = logging.getLogger(__name__)
+
+# Default retry settings. Anything under "retry" in the agent config overrides these.
+RETRY_DEFAULTS = {
+    'budget': 4,                # retries per device before it is marked degraded
+    'base_delay': 0.5,          # seconds before the first retry
+    'max_delay': 30.0,
+    'jitter': 0.5,              # each delay is shortened by up to this fraction, at random
+    'degraded_timeout': 600.0,  # seconds a degraded device refuses commands
+}
+
+COUNTERS = ('retries', 'recovered', 'exhausted', 'fail_fast')
+
+
+def check_config(config):
+    """ Raise ValueError if the retry settings can't be used. """
+    config = dict(RETRY_DEFAULTS, **config)
+    if int(config['budget']) < 0:
+        raise ValueError('The retry budget must not be negative')
+    for key in ('base_delay', 'max_delay', 'degraded_timeout'):
+        if float(config[key]) < 0:
+            raise ValueError('The retry {} must not be negative'.format(key))
+    if not 0 <= float(config['jitter']) <= 1:
+        raise ValueError('The retry jitter must be between 0 and 1')
+
+
+class RetryEngine(object):
+    """ Performs actuations on behalf of agent, retrying failed ones with backoff. """
+
+    def __init__(self, agent, prefix, config):
+        self.agent = agent
+        self.prefix = prefix
+        self.config = dict(RETRY_DEFAULTS, **config)
+        self.attempts = {}      # device -> failed attempts since the last success
+        self.timers = {}        # device -> (timer for the pending retry, whether it is safe)
+        self.degraded = {}      # device -> time it was marked degraded
+        self.counts = {}        # device -> {counter: value}
+
+    def actuate(self, device, attempt, safe=False):
+        """ Call attempt(); retry it later if it returns False. Returns attempt()'s result.
+
+            safe actuations (turning something off) are made even while the device is degraded. """
+        if self.blocked(device) and not safe:
+            self._count(device, 'fail_fast')
+            _log.warning("The {} is degraded; command refused.".format(device))
+            self.agent.publish_json(self.prefix + '/status', {}, ('FAILED', device, 'DEGRADED'))
+            self._publish(device, 'fail_fast')
+            return False
+        # A new command replaces any retry still waiting for this device.
+        self.cancel(device)
+        return self._try(device, attempt, safe)
+
+    def blocked(self, device):
+        """ True if device is degraded and its timeout hasn't passed yet. """
+        since = self.degraded.get(device)
+        if since is None:
+            return False
+        if time.time() - since >= float(self.config['degraded_timeout']):
+            # Give the device a fresh budget.
+            del self.degraded[device]
+            self.attempts.pop(device, None)
+            _log.info("The {} is no longer marked degraded.".format(device))
+            return False
+        return True
+
+    def cancel(self, device=None, keep_safe=False):
+        """ Drop the pending retry for device (or for every device). keep_safe keeps retries that turn off. """
+        for name in ([device] if device is not None else list(self.timers)):
+            timer, safe = self.timers.get(name, (None, False))
+            if timer is not None and not (safe and keep_safe):
+                timer.cancel()
+                del self.timers[name]
+                self.attempts.pop(name, None)
+
+    def _try(self, device, attempt, safe):
+        if attempt():
+            failed = self.attempts.pop(device, 0)
+            if failed or device in self.degraded:
+                self.degraded.pop(device, None)
+                self._count(device, 'recovered')
+                _log.info("The {} recovered after {} failed attempt(s).".format(device, failed))
+                self._publish(device, 'recovered', failed + 1)
+            return True
+        failed = self.attempts.get(device, 0) + 1
+        self.attempts[device] = failed
+        if failed > int(self.config['budget']):
+            self.attempts.pop(device, None)
+            self.degraded[device] = time.time()
+            self._count(device, 'exhausted')
+            _log.error("The {} failed {} times; marking it degraded.".format(device, failed))
+            self._publish(device, 'degraded', failed)
+            return False
+        delay = min(float(self.config['max_delay']), float(self.config['base_delay']) * 2 ** (failed - 1))
+        delay *= random.uniform(1.0 - float(self.config['jitter']), 1.0)
+        self._count(device, 'retries')
+        _log.warning("The {} did not read back as expected; retry {} in {:.1f} s.".format(device, failed, delay))
+        self._publish(device, 'retry', failed)
+        self.timers[device] = (self.agent.timer(delay, self._retry, device, attempt, safe), safe)
+        return False
+
+    def _retry(self, device, attempt, safe):
+        self.timers.pop(device, None)
+        self._try(device, attempt, safe)
+
+    def _count(self, device, counter):
+        counts = self.counts.setdefault(device, dict.fromkeys(COUNTERS, 0))
+        counts[counter] += 1
+
+    def _publish(self, device, event, attempt=None):
+        self.agent.publish_json(self.prefix + '/retry', {}, {'device': device, 'event': event, 'attempt': attempt,
+                                                             'counts': self.counts.get(device, {})})
@@ -0,0 +1,257 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Calendar timers for the input agents, e.g. "run the fan 02:00-05:00 every weekday".                    #
+# A timer sends its command at the start time and, if it has an end time, the matching "off" command at  #
+# the end time, on the chosen days (local time). Timers are typed at the input agent's prompt:           #
+#     at 02:00-05:00 weekdays run fan      (days: daily, weekdays, weekends or e.g. mon,wed,fri)         #
+#     timers                               (list timers)                                                 #
+#     cancel 3                             (remove timer 3)                                              #
+# TimerBook keeps the timers in a file so they survive restarts, and keeps the next event of every timer #
+# in one heap-ordered AgentTimerQueue, so the agent has a single timer however many timers exist.        #
+# The file is a change log, one JSON object per line: a snapshot of every timer, then each change since  #
+#     {"next_id": 4, "timers": [...]}    {"add": {"id": 4, ...}}    {"cancel": 2}                        #
+# Adding or cancelling a timer appends one line, and the log is compacted to a new snapshot once it      #
+# holds more changes than timers (and at least COMPACT_MIN), so either costs O(log n) (amortized).       #
+# ------------------------------------------------------------------------------------------------------ #
+import json
+import logging
+import os
+import time
+
+from bbcommon.timerqueue import AgentTimerQueue
+
+
+_log = logging.getLogger(__name__)
+
+# Changes the timers file may hold before it is compacted, however few timers there are.
+COMPACT_MIN = 32
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+DAY_GROUPS = {'daily': range(7), 'weekdays': range(5), 'weekends': (5, 6)}
+HELP = ("   Timers...\n"
+        "     at HH:MM[-HH:MM] [daily|weekdays|weekends|mon,tue,...] <command>\n"
+        "     timers              (list timers)\n"
+        "     cancel <number>     (remove a timer)\n")
+
+
+class ReplyLog(object):
+    """ Stands in for the client's connection when a timer sends a command: replies go to the log. """
+
+    def write(self, text):
+        text = text.strip()
+        if text:
+            _log.info(text)
+
+
+def parse_time(text):
+    """ 'HH:MM' -> minutes after midnight. Raises ValueError. """
+    hours, minutes = text.split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError('{} is not a valid time'.format(text))
+    return hours * 60 + minutes
+
+
+def parse_days(text):
+    """ 'weekdays', 'mon,wed' ... -> sorted list of day numbers (0 = Monday). Raises ValueError. """
+    if text in DAY_GROUPS:
+        return list(DAY_GROUPS[text])
+    try:
+        return sorted(set(DAY_NAMES.index(day) for day in text.split(',')))
+    except ValueError:
+        raise ValueError('{} is not a valid list of days'.format(text))
+
+
+def parse_timer(text, commands):
+    """ Parse 'at HH:MM[-HH:MM] [days] <command>' into a timer dict.
+
+        commands maps each command a timer may send to its "off" command (or None if it has none).
+        Raises ValueError with a message for the user. """
+    words = text.split()
+    if len(words) < 3 or words[0] != 'at':
+        raise ValueError('Timers look like: at 02:00-05:00 weekdays run fan')
+    times = words[1].split('-')
+    if len(times) > 2:
+        raise ValueError('{} is not a valid time range'.format(words[1]))
+    start = parse_time(times[0])
+    end = parse_time(times[1]) if len(times) == 2 else None
+    rest = words[2:]
+    days = list(range(7))
+    if rest and (rest[0] in DAY_GROUPS or rest[0].split(',')[0] in DAY_NAMES):
+        days = parse_days(rest[0])
+        rest = rest[1:]
+    command = ' '.join(rest)
+    if command not in commands:
+        raise ValueError("'{}' can't be timed. Timed commands are: {}".format(command, ', '.join(sorted(commands))))
+    if end is not None and commands[command] is None:
+        raise ValueError("'{}' has no off command, so it can't have an end time".format(command))
+    if end == start:
+        raise ValueError('The end time must be different from the start time')
+    return {'start': start, 'end': end, 'days': days, 'command': command,
+            'end_command': commands[command] if end is not None else None}
+
+
+def describe(timer):
+    """ Human readable form of a timer, in the same syntax used to add it. """
+    times = '{:02d}:{:02d}'.format(*divmod(timer['start'], 60))
+    if timer['end'] is not None:
+        times += '-{:02d}:{:02d}'.format(*divmod(timer['end'], 60))
+    days = timer['days']
+    for name in ('daily', 'weekdays', 'weekends'):
+        if days == list(DAY_GROUPS[name]):
+            days = name
+            break
+    else:
+        days = ','.join(DAY_NAMES[day] for day in days)
+    return 'at {} {} {}'.format(times, days, timer['command'])
+
+
+def _at(day_start, minutes):
+    """ Local time minutes after midnight of the day starting at day_start (a struct_time). """
+    return time.mktime((day_start.tm_year, day_start.tm_mon, day_start.tm_mday,
+                        minutes // 60, minutes % 60, 0, 0, 0, -1))
+
+
+def next_occurrence(minutes, days, after):
+    """ First time after 'after' that is 'minutes' past midnight on one of 'days' (local time). """
+    today = time.localtime(after)
+    for offset in range(8):
+        day = time.localtime(time.mktime((today.tm_year, today.tm_mon, today.tm_mday + offset,
+                                          12, 0, 0, 0, 0, -1)))
+        if day.tm_wday in days:
+            moment = _at(day, minutes)
+            if moment > after:
+                return moment
+    return None
+
+
+def previous_occurrence(minutes, days, before):
+    """ Last time at or before 'before' that is 'minutes' past midnight on one of 'days'. """
+    today = time.localtime(before)
+    for offset in range(8):
+        day = time.localtime(time.mktime((today.tm_year, today.tm_mon, today.tm_mday - offset,
+                                          12, 0, 0, 0, 0, -1)))
+        if day.tm_wday in days:
+            moment = _at(day, minutes)
+            if moment <= before:
+                return moment
+    return None
+
+
+class TimerBook(object):
+    """ Persistent set of timers, each with its next event waiting in one timer queue.
+
+        send(command) is called when a timer's start or end time arrives. """
+
+    def __init__(self, agent, path, send):
+        self.path = path
+        self.send = send
+        self.timers = {}
+        self._events = {}
+        self._next_id = 1
+        self._changes = 0           # changes appended to the file since its snapshot
+        self.queue = AgentTimerQueue(agent, self._fire)
+
+    def load(self):
+        """ Read the timers file and queue every timer. A timer whose window is in progress is started now. """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as timers_file:
+                text = timers_file.read()
+        except IOError as error:
+            _log.error('Could not read timers from {}: {}'.format(self.path, error))
+            return
+        legacy = False
+        try:
+            # A file written before the change log: one (indented) snapshot. It is rewritten as a log below.
+            records = [json.loads(text)]
+            legacy = True
+        except ValueError:
+            records = []
+            for number, line in enumerate(text.splitlines(), 1):
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Most likely a change cut short by a crash.
+                    _log.error('Skipping a damaged line ({}) in the timers file {}.'.format(number, self.path))
+        for record in records:
+            if not isinstance(record, dict):
+                continue
+            if 'timers' in record:
+                self.timers = dict((timer['id'], timer) for timer in record['timers'])
+                self._next_id = record.get('next_id', 1)
+                self._changes = 0
+            elif 'add' in record:
+                self.timers[record['add']['id']] = record['add']
+                self._next_id = max(self._next_id, record['add']['id'] + 1)
+                self._changes += 1
+            elif 'cancel' in record:
+                self.timers.pop(record['cancel'], None)
+                self._changes += 1
+        now = time.time()
+        for timer in sorted(self.timers.values(), key=lambda t: t['id']):
+            self._schedule(timer, now, catch_up=True)
+        self._next_id = max([self._next_id] + [number + 1 for number in self.timers])
+        if legacy or self._changes > max(COMPACT_MIN, len(self.timers)):
+            self.save()
+
+    def save(self):
+        """ Compact the timers file to a snapshot of the timers (written to a temporary file first, so a crash
+            never leaves it half written). """
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as timers_file:
+            timers_file.write(json.dumps({'next_id': self._next_id,
+                                          'timers': sorted(self.timers.values(), key=lambda t: t['id'])}) + '\n')
+        os.rename(temporary, self.path)
+        self._changes = 0
+
+    def add(self, timer):
+        timer = dict(timer, id=self._next_id)
+        self._next_id += 1
+        self.timers[timer['id']] = timer
+        self._schedule(timer, time.time())
+        self._append({'add': timer})
+        return timer
+
+    def cancel(self, number):
+        """ Remove timer number. Returns False if there is no such timer. """
+        timer = self.timers.pop(number, None)
+        if timer is None:
+            return False
+        self.queue.cancel(self._events.pop(number))
+        self._append({'cancel': number})
+        return True
+
+    def _append(self, change):
+        """ Add one change to the end of the timers file, compacting it when it holds too many. """
+        self._changes += 1
+        if self._changes > max(COMPACT_MIN, len(self.timers)):
+            self.save()
+            return
+        with open(self.path, 'a') as timers_file:
+            timers_file.write(json.dumps(change) + '\n')
+
+    def _schedule(self, timer, after, catch_up=False):
+        """ Queue the next start or end event of timer. """
+        start = next_occurrence(timer['start'], timer['days'], after)
+        event = (start, timer['command'])
+        if timer['end'] is not None:
+            last_start = previous_occurrence(timer['start'], timer['days'], after)
+            # The end event belongs to the most recent start, and may fall on the next day.
+            end = next_occurrence(timer['end'], range(7), last_start) if last_start is not None else None
+            if end is not None and end > after and (start is None or end < start):
+                event = (end, timer['end_command'])
+                if catch_up:
+                    # Restarted in the middle of the window: send the start command again now.
+                    self.send(timer['command'])
+        if event[0] is not None:
+            self._events[timer['id']] = self.queue.push(event[0], (timer['id'], event[1]))
+
+    def _fire(self, item):
+        number, command = item
+        timer = self.timers.get(number)
+        if timer is None:
+            return
+        _log.info('Timer {} ({}): sending {!r}.'.format(number, describe(timer), command))
+        self.send(command)
+        self._schedule(timer, time.time())
@@ -0,0 +1,175 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Shadow mode: new control logic runs beside the production control agent on the same commands, without  #
+# driving any relays, and its decisions are compared with what production actually did.                  #
+#   - Input agents tag every command they publish on 'userinput/state' with a CommandID header and the    #
+#     time it was sent (CommandTime); see CommandIds.                                                    #
+#   - The shadow agent (ControlAgent with "shadow" enabled) publishes what it decided on                 #
+#     'shadow/decision', and the production agent (DehumAgent with "shadow" enabled) publishes the        #
+#     transitions it made and verified on 'shadow/actual'. Both use outcome():                           #
+#         {'id': ..., 'command': 'run dehum', 'transitions': [['dehumidifier', 'ON']],                    #
+#          'state': {'dehumidifier': True, 'fan': False}, 'latency': 0.0012}                             #
+#     latency is the seconds from CommandTime to the decision.                                           #
+#   - ShadowComparator pairs the two outcomes by id and counts divergences and latency differences.       #
+# The comparator has to keep up with the bus at full rate, so each message costs O(1) and its memory is   #
+# bounded: outcomes waiting for their pair are kept (oldest first) up to max_pending and match_timeout,   #
+# and latency differences go into a fixed histogram rather than a list.                                  #
+# ------------------------------------------------------------------------------------------------------ #
+import itertools
+import math
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+
+
+COMMAND_ID = 'CommandID'
+COMMAND_TIME = 'CommandTime'
+
+# Default comparator settings. Anything under "comparator" in the shadow agent's config overrides these.
+COMPARATOR_DEFAULTS = {
+    'max_pending': 4096,        # outcomes waiting for their pair
+    'match_timeout': 30.0,      # seconds an outcome waits for its pair
+    'keep_divergences': 20,     # most recent divergences kept for the report
+    'max_commands': 32,         # distinct commands counted separately; the rest count as '(other)'
+}
+
+# Latency-difference histogram: bucket edges are +/- 10 ** (k / 4) microseconds (4 buckets per decade),
+# from 1 us to 100 s, with 0 in the middle.
+BUCKETS_PER_DECADE = 4
+DECADES = 8
+
+
+class CommandIds(object):
+    """ Makes CommandID/CommandTime headers: a prefix unique to this process and a counter. """
+
+    def __init__(self, source):
+        self.prefix = '{}-{}-{}'.format(source, os.getpid(), uuid.uuid4().hex[:6])
+        self.counter = itertools.count(1)
+
+    def headers(self):
+        return {COMMAND_ID: '{}-{}'.format(self.prefix, next(self.counter)), COMMAND_TIME: time.time()}
+
+
+def outcome(headers, command, before, after):
+    """ The shadow message for a command that took the outputs from before to after ({name: on}).
+        Returns None for commands published without a CommandID. """
+    command_id = headers.get(COMMAND_ID)
+    if command_id is None:
+        return None
+    transitions = [[name, 'ON' if after[name] else 'OFF'] for name in sorted(after) if after[name] != before.get(name)]
+    sent = headers.get(COMMAND_TIME)
+    return {'id': command_id, 'command': command, 'transitions': transitions, 'state': after,
+            'latency': time.time() - float(sent) if sent is not None else None}
+
+
+class LatencyHistogram(object):
+    """ Counts of signed latency differences in logarithmic buckets, for percentiles in fixed memory. """
+
+    def __init__(self):
+        self.size = BUCKETS_PER_DECADE * DECADES
+        self.counts = [0] * (2 * self.size + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        micros = abs(value) * 1e6
+        if micros < 1.0:
+            index = 0
+        else:
+            index = min(self.size, int(math.log10(micros) * BUCKETS_PER_DECADE) + 1)
+        self.counts[self.size + (index if value > 0 else -index)] += 1
+
+    def _value(self, index):
+        """ Upper edge (in seconds) of the bucket at index. """
+        k = index - self.size
+        if k == 0:
+            return 0.0
+        edge = 10 ** (abs(k) / float(BUCKETS_PER_DECADE)) / 1e6
+        return edge if k > 0 else -edge / 10 ** (1.0 / BUCKETS_PER_DECADE)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self._value(index)
+        return self._value(len(self.counts) - 1)
+
+
+class ShadowComparator(object):
+    """ Pairs shadow decisions with production outcomes by command id. """
+
+    def __init__(self, config):
+        self.config = dict(COMPARATOR_DEFAULTS, **config)
+        # id -> (time received, 'decision' or 'actual', outcome), oldest first.
+        self.pending = OrderedDict()
+        self.latency = LatencyHistogram()
+        self.divergences = deque(maxlen=int(self.config['keep_divergences']))
+        self.by_command = {}
+        self.counts = dict.fromkeys(('matched', 'diverged', 'unmatched_decision', 'unmatched_actual',
+                                     'evicted', 'duplicate'), 0)
+
+    def add(self, kind, message, now=None):
+        """ Add a 'decision' (shadow) or 'actual' (production) outcome. Returns the comparison when this
+            completes a pair: {'id', 'command', 'diverged', 'latency_delta', 'decision', 'actual'}. """
+        now = time.time() if now is None else now
+        self.expire(now)
+        key = message['id']
+        waiting = self.pending.pop(key, None)
+        if waiting is None:
+            if len(self.pending) >= int(self.config['max_pending']):
+                _, (_, old_kind, _) = self.pending.popitem(last=False)
+                self.counts['evicted'] += 1
+                self.counts['unmatched_' + old_kind] += 1
+            self.pending[key] = (now, kind, message)
+            return None
+        if waiting[1] == kind:
+            # The same side twice (a re-delivered message): keep the first.
+            self.counts['duplicate'] += 1
+            self.pending[key] = waiting
+            return None
+        decision, actual = (message, waiting[2]) if kind == 'decision' else (waiting[2], message)
+        return self._compare(decision, actual)
+
+    def expire(self, now=None):
+        """ Drop outcomes that have waited longer than match_timeout for their pair. """
+        now = time.time() if now is None else now
+        timeout = float(self.config['match_timeout'])
+        while self.pending:
+            key, (received, kind, _) = next(iter(self.pending.items()))
+            if now - received < timeout:
+                break
+            del self.pending[key]
+            self.counts['unmatched_' + kind] += 1
+
+    def _compare(self, decision, actual):
+        diverged = decision['transitions'] != actual['transitions'] or decision['state'] != actual['state']
+        delta = None
+        if decision.get('latency') is not None and actual.get('latency') is not None:
+            delta = decision['latency'] - actual['latency']
+            self.latency.add(delta)
+        self.counts['diverged' if diverged else 'matched'] += 1
+        command = actual.get('command')
+        if command not in self.by_command and len(self.by_command) >= int(self.config['max_commands']):
+            command = '(other)'
+        counts = self.by_command.setdefault(command, {'matched': 0, 'diverged': 0})
+        counts['diverged' if diverged else 'matched'] += 1
+        result = {'id': actual['id'], 'command': actual.get('command'), 'diverged': diverged,
+                  'latency_delta': delta, 'decision': decision['transitions'], 'actual': actual['transitions']}
+        if diverged:
+            self.divergences.append(result)
+        return result
+
+    def report(self):
+        """ Counts, latency-difference summary (shadow minus production, seconds) and recent divergences. """
+        latency = self.latency
+        return {'counts': dict(self.counts), 'pending': len(self.pending), 'by_command': dict(self.by_command),
+                'latency_delta': {'count': latency.count,
+                                  'mean': latency.total / latency.count if latency.count else None,
+                                  'p50': latency.percentile(0.5), 'p99': latency.percentile(0.99)},
+                'recent_divergences': list(self.divergences)}
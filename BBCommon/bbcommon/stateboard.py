@@ -0,0 +1,145 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# A state board: a small shared-memory file in which a control agent keeps its authoritative device      #
+# state, so agents on the same machine can read it directly instead of keeping their own copies or       #
+# asking over the bus.                                                                                   #
+# The file (in /dev/shm where there is one) holds one record, guarded by a sequence number (a seqlock):  #
+#     magic 'BBSB' | writer pid (4 bytes) | sequence (8 bytes) | length (4 bytes) | CRC-32 (4 bytes) | JSON#
+# The writer makes the sequence odd, writes the JSON, length and CRC, then makes the sequence even again. #
+# A reader never takes a lock and never makes the writer wait: it reads the sequence, copies the record   #
+# and reads the sequence again. If the sequence was odd or changed, or the CRC doesn't match (which also  #
+# catches writes that became visible out of order on a weakly ordered CPU), the read was torn and it      #
+# tries again. A record whose writer is no longer running is ignored.                                   #
+# The writer puts the CommandID of the last command it handled in the record (as 'command'), so an input #
+# agent can tell whether the board has caught up with the command it just sent (see settled()).          #
+# ------------------------------------------------------------------------------------------------------ #
+import errno
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+
+_log = logging.getLogger(__name__)
+
+MAGIC = b'BBSB'
+HEADER = struct.Struct('<4sIQII')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+BOARD_SIZE = 512
+# Relative board paths are in shared memory (or the temp directory where there is no /dev/shm).
+BOARD_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def board_path(path):
+    return os.path.join(BOARD_DIR, path)
+
+
+class StateBoard(object):
+    """ The writing side: the one agent that owns the state. """
+
+    def __init__(self, path):
+        self.path = board_path(path)
+        self.sequence = 0
+        self.pid = os.getpid()
+        self._map = None
+
+    def publish(self, state):
+        """ Replace the state on the board. """
+        payload = json.dumps(state, sort_keys=True).encode('utf-8')
+        if HEADER.size + len(payload) > BOARD_SIZE:
+            raise ValueError('The state is too large for the board ({} bytes)'.format(len(payload)))
+        if self._map is None:
+            self._open()
+        board = self._map
+        SEQUENCE.pack_into(board, SEQUENCE_OFFSET, self.sequence + 1)
+        board[HEADER.size:HEADER.size + len(payload)] = payload
+        HEADER.pack_into(board, 0, MAGIC, self.pid, self.sequence + 1, len(payload), zlib.crc32(payload) & 0xffffffff)
+        self.sequence += 2
+        SEQUENCE.pack_into(board, SEQUENCE_OFFSET, self.sequence)
+
+    def _open(self):
+        descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(descriptor).st_size < BOARD_SIZE:
+                os.ftruncate(descriptor, BOARD_SIZE)
+            self._map = mmap.mmap(descriptor, BOARD_SIZE)
+        finally:
+            os.close(descriptor)
+        # Carry on from the last sequence number (even), so readers see that the state changed.
+        self.sequence = (SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0] + 1) & ~1
+
+
+class BoardReader(object):
+    """ The reading side. Any number of agents can read the same board. """
+
+    def __init__(self, path, attempts=100):
+        self.path = board_path(path)
+        self.attempts = attempts
+        self.torn = 0
+        self._map = None
+        self._sequence = None
+        self._state = None
+
+    def read(self):
+        """ The state on the board, or None if there is none yet or its writer isn't running. """
+        board = self._map
+        if board is None:
+            board = self._open()
+            if board is None:
+                return None
+        for _ in range(self.attempts):
+            sequence = SEQUENCE.unpack_from(board, SEQUENCE_OFFSET)[0]
+            if sequence & 1:
+                # A write is in progress; let the writer get on with it.
+                self.torn += 1
+                time.sleep(0)
+                continue
+            if sequence == 0:
+                return None
+            if sequence == self._sequence:
+                # Nothing has changed since the last read.
+                return self._state if self._alive(self._state['pid']) else None
+            magic, pid, _, length, crc = HEADER.unpack_from(board)
+            payload = board[HEADER.size:HEADER.size + min(length, BOARD_SIZE - HEADER.size)]
+            if (SEQUENCE.unpack_from(board, SEQUENCE_OFFSET)[0] != sequence or magic != MAGIC
+                    or zlib.crc32(payload) & 0xffffffff != crc):
+                self.torn += 1
+                time.sleep(0)
+                continue
+            state = json.loads(payload.decode('utf-8'))
+            state['pid'] = pid
+            self._sequence, self._state = sequence, state
+            return state if self._alive(pid) else None
+        _log.warning("Could not get a consistent read of {} in {} attempts.".format(self.path, self.attempts))
+        return None
+
+    def settled(self, command_id, sent, grace=1.0):
+        """ The state, once it takes account of the last command this reader's agent sent (command_id, sent at
+            time sent): the writer has handled it, or grace seconds have passed (it was refused, or another
+            agent's command came after it). Until then None, and the reader's own idea of the state stands. """
+        state = self.read()
+        if state is None or command_id is None or state.get('command') == command_id or time.time() - sent >= grace:
+            return state
+        return None
+
+    def _open(self):
+        try:
+            with open(self.path, 'rb') as board_file:
+                self._map = mmap.mmap(board_file.fileno(), BOARD_SIZE, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            # No board yet (or it is still being created).
+            return None
+        return self._map
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as error:
+            # EPERM: it is running, as another user.
+            return error.errno == errno.EPERM
+        return True
@@ -0,0 +1,85 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# A small memory-mapped file holding an agent's desired output state, so a restarted agent can pick up   #
+# where it left off instead of switching everything off.                                                 #
+# The file has two slots. Each save() writes the state (as JSON) into the slot not holding the newest    #
+# state, with a sequence number and a CRC:                                                               #
+#     sequence (8 bytes) | length (4 bytes) | CRC-32 of sequence and JSON (4 bytes) | JSON                #
+# load() returns the valid slot with the highest sequence number, so a save cut short by a crash leaves  #
+# the previous state readable. Writing to the mapping is a memory copy (the kernel writes the page back) #
+# so saving costs microseconds instead of a file create and rename per relay change.                     #
+# ------------------------------------------------------------------------------------------------------ #
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+
+_log = logging.getLogger(__name__)
+
+SLOT_SIZE = 512
+HEADER = struct.Struct('<QII')
+
+
+class StateFile(object):
+    """ Desired state kept in the two-slot file at path. """
+
+    def __init__(self, path):
+        self.path = path
+        self.saved = None
+        self.sequence = 0
+        self._map = None
+
+    def load(self):
+        """ Return the saved state, or None if there is none (or it can't be read). """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as state_file:
+                data = state_file.read(2 * SLOT_SIZE)
+        except IOError as error:
+            _log.error('Could not read the saved state from {}: {}'.format(self.path, error))
+            return None
+        newest = None
+        for slot in range(2):
+            record = data[slot * SLOT_SIZE:(slot + 1) * SLOT_SIZE]
+            if len(record) < HEADER.size:
+                continue
+            sequence, length, crc = HEADER.unpack_from(record)
+            payload = record[HEADER.size:HEADER.size + length]
+            if len(payload) != length or zlib.crc32(record[:8] + payload) & 0xffffffff != crc:
+                continue
+            if newest is None or sequence > newest[0]:
+                newest = (sequence, payload)
+        if newest is None:
+            _log.error('The saved state in {} is damaged; ignoring it.'.format(self.path))
+            return None
+        self.sequence = newest[0]
+        self.saved = json.loads(newest[1].decode('utf-8'))
+        return dict(self.saved)
+
+    def save(self, state):
+        if state == self.saved:
+            return
+        payload = json.dumps(state, sort_keys=True).encode('utf-8')
+        if HEADER.size + len(payload) > SLOT_SIZE:
+            raise ValueError('The state is too large to save ({} bytes)'.format(len(payload)))
+        if self._map is None:
+            self._open()
+        self.sequence += 1
+        sequence = struct.pack('<Q', self.sequence)
+        record = HEADER.pack(self.sequence, len(payload), zlib.crc32(sequence + payload) & 0xffffffff) + payload
+        start = (self.sequence % 2) * SLOT_SIZE
+        self._map[start:start + len(record)] = record
+        self.saved = dict(state)
+
+    def _open(self):
+        """ Map the file (creating it, or extending a short one, first). """
+        descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(descriptor).st_size < 2 * SLOT_SIZE:
+                os.ftruncate(descriptor, 2 * SLOT_SIZE)
+            self._map = mmap.mmap(descriptor, 2 * SLOT_SIZE)
+        finally:
+            os.close(descriptor)
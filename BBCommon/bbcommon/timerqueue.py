@@ -0,0 +1,121 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Timer queues kept as a min-heap ordered by deadline.                                                   #
+# TimerQueue holds any number of (deadline, item) entries. Adding an entry is O(log n); cancelling one   #
+# is O(1) (it is marked and dropped when it reaches the top of the heap).                                #
+# AgentTimerQueue runs a TimerQueue on an agent: it keeps one agent timer, set for the earliest          #
+# deadline, however many entries are queued, and calls back with each item when it is due. Items pushed  #
+# by those callbacks (a repeating item queuing its next run) are timed once the due items have all run.  #
+# ------------------------------------------------------------------------------------------------------ #
+import heapq
+import itertools
+import time
+
+
+class TimerEntry(object):
+    """ One queued item. Returned by TimerQueue.push() so the caller can cancel it. """
+    __slots__ = ('deadline', 'seq', 'item', 'canceled')
+
+    def __init__(self, deadline, seq, item):
+        self.deadline = deadline
+        self.seq = seq
+        self.item = item
+        self.canceled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+
+class TimerQueue(object):
+    """ Items ordered by deadline. Items with equal deadlines come out in the order they were pushed. """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._canceled = 0
+
+    def __len__(self):
+        return len(self._heap) - self._canceled
+
+    def push(self, deadline, item):
+        entry = TimerEntry(deadline, next(self._seq), item)
+        heapq.heappush(self._heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        if not entry.canceled:
+            entry.canceled = True
+            self._canceled += 1
+            # Rebuild when most of the heap is canceled entries, so it can't grow without bound.
+            if self._canceled > 32 and self._canceled * 2 > len(self._heap):
+                self._heap = [live for live in self._heap if not live.canceled]
+                heapq.heapify(self._heap)
+                self._canceled = 0
+
+    def clear(self):
+        for entry in self._heap:
+            entry.canceled = True
+        self._heap = []
+        self._canceled = 0
+
+    def next_deadline(self):
+        """ Deadline of the earliest entry, or None if the queue is empty. """
+        self._drop_canceled()
+        return self._heap[0].deadline if self._heap else None
+
+    def pop_due(self, now):
+        """ Remove and return the items whose deadline is at or before now, earliest first. """
+        due = []
+        self._drop_canceled()
+        while self._heap and self._heap[0].deadline <= now:
+            entry = heapq.heappop(self._heap)
+            entry.canceled = True
+            due.append(entry.item)
+            self._drop_canceled()
+        return due
+
+    def _drop_canceled(self):
+        while self._heap and self._heap[0].canceled:
+            heapq.heappop(self._heap)
+            self._canceled -= 1
+
+
+class AgentTimerQueue(TimerQueue):
+    """ A TimerQueue that calls callback(item) when each item is due, using one timer on agent. """
+
+    def __init__(self, agent, callback):
+        super(AgentTimerQueue, self).__init__()
+        self.agent = agent
+        self.callback = callback
+        self._timer = None
+        self._timer_deadline = None
+        self._running = False
+
+    def push(self, deadline, item):
+        entry = super(AgentTimerQueue, self).push(deadline, item)
+        if not self._running and (self._timer_deadline is None or deadline < self._timer_deadline):
+            self._set_timer()
+        return entry
+
+    def clear(self):
+        super(AgentTimerQueue, self).clear()
+        self._set_timer()
+
+    def _set_timer(self):
+        """ Point the agent timer at the earliest deadline (or stop it if the queue is empty). """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._timer_deadline = self.next_deadline()
+        if self._timer_deadline is not None:
+            self._timer = self.agent.timer(max(0.0, self._timer_deadline - time.time()), self._run_due)
+
+    def _run_due(self):
+        self._timer = None
+        self._timer_deadline = None
+        self._running = True
+        try:
+            for item in self.pop_due(time.time()):
+                self.callback(item)
+        finally:
+            self._running = False
+        self._set_timer()
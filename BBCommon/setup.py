@@ -0,0 +1,10 @@
+from setuptools import setup, find_packages
+
+packages = find_packages('.')
+
+# Helpers shared by the agents in this repository. Installed alongside them, not run as an agent.
+setup(
+    name = 'bbcommon',
+    version = "0.1",
+    packages = packages,
+)
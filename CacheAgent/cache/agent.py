@@ -0,0 +1,88 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# This agent keeps the last value on the command and status topics (see bbcommon/lastvalue.py), so an    #
+# agent that starts after the input agent's last command can catch up without waiting for the next one:  #
+#   - it watches the bus and keeps the latest message on each cached topic (one per device on            #
+#     'userinput/state', and one per component on 'dhcontrol/status' and 'LEDcontrol/status' by          #
+#     default), and                                                                                      #
+#   - on 'cache/request' it publishes every cached value under the requested prefixes, in one message,   #
+#     on the requester's reply topic.                                                                    #
+# The control agents ask for 'userinput/state' at start-up and carry out the commands for their devices. #
+# ------------------------------------------------------------------------------------------------------ #
+
+
+# --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
+# more import statements may be needed for other agents, but these work for this agent
+import logging
+import sys
+
+from zmq.utils import jsonapi
+from volttron.platform.agent import BaseAgent, PublishMixin
+from volttron.platform.agent import utils, matching
+
+from bbcommon.lastvalue import CACHE_REPLY, CACHE_REQUEST, LastValueCache
+
+_log = logging.getLogger(__name__)
+# --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
+
+
+# Create a class with the convention: NameAgent
+# and always include "PublishMixin, BaseAgent" as its arguments.
+class CacheAgent(PublishMixin, BaseAgent):
+    """ Keeps the last value on each cached topic and hands them out on request. """
+
+    # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
+    def __init__(self, config_path, **kwargs):
+        super(CacheAgent, self).__init__(**kwargs)
+        self.config = utils.load_config(config_path)
+        self.cache = LastValueCache(self.config.get('cache', {}))
+
+    def setup(self):
+        # Demonstrate accessing a value from the config file
+        _log.info(self.config['message'])
+        self._agent_id = self.config['agentid']
+        super(CacheAgent, self).setup()
+    # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
+
+    # Every message on the bus comes through here; only the cached topics are decoded.
+    @matching.match_all
+    def watch(self, topic, headers, message, match):
+        rule = self.cache.rule(topic)
+        if rule is None or topic.startswith('cache/'):
+            return
+        try:
+            value = jsonapi.loads(message[0])
+        except (ValueError, IndexError):
+            return
+        self.cache.update(topic, dict(headers), value, rule)
+
+    @matching.match_exact(CACHE_REQUEST)
+    def on_request(self, topic, headers, message, match):
+        """A new subscriber wants the current values."""
+        request = jsonapi.loads(message[0])
+        reply_to = request.get('reply_to', '')
+        if not reply_to.startswith(CACHE_REPLY):
+            _log.warning("Cache request without a reply topic under {}: {}".format(CACHE_REPLY, request))
+            return
+        values = self.cache.query(request.get('prefixes', []))
+        _log.info("Sending {} cached value(s) to {}.".format(len(values), reply_to))
+        self.publish_json(reply_to, {}, {'values': values})
+
+
+# --------------------------------------- ALWAYS INCLUDE --------------------------------------- #
+# Include this section in every agent, but adjust the agent name and description.
+def main(argv=sys.argv):
+    '''Main method called by the eggsecutable.'''
+    # Enable information and debug logging
+    utils.setup_logging()
+    utils.default_main(CacheAgent,
+                   description='Keep the last value on the command and status topics',
+                   argv=argv)
+
+
+if __name__ == '__main__':
+    # Entry point for script
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
+# --------------------------------------- ALWAYS INCLUDE --------------------------------------- #
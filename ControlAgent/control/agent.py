@@ -7,7 +7,21 @@
 # Only messages under that topic name are read.                                                          #
 # The received message is assigned to a variable called command.                                         #
 # The command is then processed and the necessary action is performed.                                   #
-# Possible actions include turning on or off the dehumidifier or fan, using BBB GPIO pins.               #
+# Possible actions include turning on or off the dehumidifier or fan.                                    #
+# No GPIO pins are used: this agent is a digital twin of the dehumidifier control agent. It switches the #
+# relays of a simulated room (see room.py) relay_delay seconds after each command, and publishes the     #
+# same messages the real hardware does:                                                                  #
+#   - '<prefix>/status' (e.g. ('SUCCESS', 'dehumidifier', 'ON')) when a relay switches, and              #
+#   - '<prefix>/sensor' ({'time', 'humidity', 'humidity_rate', 'temperature'}) every sensor_interval,     #
+# plus '<prefix>/twin' every report_interval with the power draw and energy used so far.                 #
+# The prefix is 'twin/dhcontrol' unless the config says otherwise, so the twin can run beside the real   #
+# agent without its simulated messages being taken for the hardware's. Publishing on the real agent's    #
+# 'dhcontrol' topics (to stand in for it) needs "replace_hardware": true as well. Simulated time runs    #
+# time_scale times faster than the clock, so a week can be simulated in minutes; every time in the       #
+# messages is simulated time.                                                                            #
+# With "shadow" enabled the agent runs as the shadow of the real control agent: each command's decision  #
+# is published on 'shadow/decision' (see bbcommon/shadow.py), and the simulated status and sensor        #
+# messages move to 'shadow/<prefix>'.                                                                    #
 # ------------------------------------------------------------------------------------------------------ #
 
 
@@ -15,17 +29,35 @@
 # more import statements may be needed for other agents, but these work for this agent
 import logging
 import sys
+import time
 
 from zmq.utils import jsonapi
 from volttron.platform.agent import BaseAgent, PublishMixin
 from volttron.platform.agent import utils, matching
 
-# Enable information and debug logging
-utils.setup_logging()
+from bbcommon.lastvalue import CACHE_REPLY, request as request_cached
+from bbcommon.shadow import outcome
+
+from control.room import Room
+
 _log = logging.getLogger(__name__)
 # --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
 
 
+# Default simulation settings. Anything under "twin" in the config overrides these. Times are simulated
+# seconds unless noted.
+TWIN_DEFAULTS = {
+    'topic_prefix': 'twin/dhcontrol',
+    'replace_hardware': False,  # must be true to publish on the real control agent's 'dhcontrol' topics
+    'time_scale': 1.0,          # simulated seconds per real second
+    'start_time': None,         # simulated time (Unix time) at start-up; None starts at the current time
+    'relay_delay': 0.05,        # between a command and its relay switching
+    'sensor_interval': 5.0,
+    'report_interval': 300.0,
+    'min_tick': 0.01,           # real seconds; the shortest time between simulation steps
+}
+
+
 # Create a class with the convention: NameAgent
 # and always include "PublishMixin, BaseAgent" as its arguments.
 class ControlAgent(PublishMixin, BaseAgent):
@@ -35,41 +67,132 @@ class ControlAgent(PublishMixin, BaseAgent):
     def __init__(self, config_path, **kwargs):
         super(ControlAgent, self).__init__(**kwargs)
         self.config = utils.load_config(config_path)
-        # Initialize flags to be false.
+        self.twin_config = dict(TWIN_DEFAULTS, **self.config.get('twin', {}))
+        if float(self.twin_config['time_scale']) <= 0:
+            raise ValueError('The twin time_scale must be greater than 0')
+        self.prefix = self.twin_config['topic_prefix']
+        if self.prefix == 'dhcontrol' and self.twin_config['replace_hardware'] is not True:
+            raise ValueError("The twin's topic_prefix 'dhcontrol' is the real control agent's; set "
+                             "replace_hardware to true as well to publish simulated messages there")
+        # Shadow mode: publish each command's decision on shadow/decision.
+        self.shadow = bool(self.config.get('shadow', {}).get('enabled', False))
+        if self.shadow:
+            self.prefix = 'shadow/' + self.prefix
+        # Initialize flags to be false. The flags are what was last commanded; the room's relays follow
+        # relay_delay later.
         self.dehumidifierOn = False
         self.fanOn = False
+        self.room = None
+        # Whether a command has been received since start-up.
+        self.commanded = False
 
     def setup(self):
         # Demonstrate accessing a value from the config file
         _log.info(self.config['message'])
         self._agent_id = self.config['agentid']
         super(ControlAgent, self).setup()
+        config = self.twin_config
+        # Simulated time is start + (clock - wall_start) * time_scale.
+        self.wall_start = time.time()
+        self.start = self.wall_start if config['start_time'] is None else float(config['start_time'])
+        self.scale = float(config['time_scale'])
+        self.room = Room(self.config.get('room', {}), self.start)
+        self.nextSample = self.start + float(config['sensor_interval'])
+        self.nextReport = self.start + float(config['report_interval'])
+        # One step per sensor reading, but no more often than min_tick real seconds.
+        tick = max(float(config['min_tick']), float(config['sensor_interval']) / self.scale)
+        self.periodic_timer(tick, self.step)
+        _log.info("Simulating at {}x: humidity {:.1f} %RH, temperature {:.1f} C.".format(
+            self.scale, self.room.humidity, self.room.temperature))
+        # Start from the last command sent (see cache_reply()).
+        request_cached(self, self._agent_id, ['userinput/state'])
     # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
 
+    def now(self):
+        """ The simulated time. """
+        return self.start + (time.time() - self.wall_start) * self.scale
+
+    def step(self):
+        """ Move the room on to the simulated time, publishing each sensor reading and report on the way. """
+        now = self.now()
+        while min(self.nextSample, self.nextReport) <= now:
+            if self.nextSample <= self.nextReport:
+                self.room.advance(self.nextSample)
+                self.publish_sensor()
+                self.nextSample += float(self.twin_config['sensor_interval'])
+            else:
+                self.room.advance(self.nextReport)
+                self.publish_report()
+                self.nextReport += float(self.twin_config['report_interval'])
+        self.room.advance(now)
+
+    def publish_sensor(self):
+        humidity, temperature = self.room.read()
+        self.publish_json(self.prefix + '/sensor', {}, {'time': self.room.time, 'humidity': humidity,
+                                                        'humidity_rate': self.room.humidity_rate(),
+                                                        'temperature': temperature})
+
+    def publish_report(self):
+        room = self.room
+        self.publish_json(self.prefix + '/twin', {}, {'time': room.time, 'humidity': room.humidity,
+                                                      'temperature': room.temperature,
+                                                      'power_kw': room.power_kw(), 'energy_kwh': room.energy_kwh,
+                                                      'compressor_starts': room.compressor_starts,
+                                                      'compressor_hours': room.compressor_seconds / 3600.0,
+                                                      'dehumidifierOn': room.compressor, 'fanOn': room.fan})
+
+    def actuate(self, component, on):
+        """ Switch a relay after relay_delay (simulated) seconds, as the real relay board would. """
+        self.timer(float(self.twin_config['relay_delay']) / self.scale, self.switch, component, on)
+
+    def switch(self, component, on):
+        """ Called when a relay switches: change the room and publish the status the hardware would. """
+        # Readings due before now were taken with the relays as they were.
+        self.step()
+        if component == 'dehumidifier':
+            self.room.switch(self.room.time, compressor=on)
+        else:
+            self.room.switch(self.room.time, fan=on)
+        self.publish_json(self.prefix + '/status', {}, ('SUCCESS', component, 'ON' if on else 'OFF'))
+
     def run_dehum(self):
         """Turn on dehumidifier"""
         # Set flag, so know dehumidifier is on, and log transition
         self.dehumidifierOn = True
+        self.actuate('dehumidifier', True)
         _log.info("SUCCESS - The dehumidifier (compressor and fan) is now on.")
 
     def shed_dehum(self):
         """Turn off dehumidifier"""
         # Set flag, so know dehumidifier is off, and log transition
         self.dehumidifierOn = False
+        self.actuate('dehumidifier', False)
         _log.info("SUCCESS - The dehumidifier (compressor and fan) is now off.")
 
     def run_fan(self):
         """Turn on fan"""
         # Set flag, so know fan is on, and log transition
         self.fanOn = True
+        self.actuate('fan', True)
         _log.info("SUCCESS - The fan is now on.")
 
     def shed_fan(self):
         """Turn off fan"""
         # Set flag, so know fan is off, and log transition
         self.fanOn = False
+        self.actuate('fan', False)
         _log.info("SUCCESS - The fan is now off.")
 
+    def get_output_status(self):
+        """ Log the simulated room and relays. """
+        self.step()
+        room = self.room
+        _log.info("Dehumidifier: {}".format('ON' if room.compressor else 'OFF'))
+        _log.info("         Fan: {}".format('ON' if room.fan else 'OFF'))
+        _log.info("    Humidity: {:.1f} %RH, temperature {:.1f} C".format(room.humidity, room.temperature))
+        _log.info("       Power: {:.2f} kW, {:.2f} kWh used, {} compressor start(s)".format(
+            room.power_kw(), room.energy_kwh, room.compressor_starts))
+
     # If a message with the subscription name "userinput/state" is in the message bus,
     # execute the text below.
     # The matching.match_start function looks for messages starting with the specified argument.
@@ -84,11 +207,33 @@ class ControlAgent(PublishMixin, BaseAgent):
         command = jsonapi.loads(message[0])
         command = command[1]
         _log.info("Received the command {}.".format(command))
+        self.commanded = True
+        before = {'dehumidifier': self.dehumidifierOn, 'fan': self.fanOn}
+        self.process_command(command)
+        if self.shadow:
+            result = outcome(headers, command, before, {'dehumidifier': self.dehumidifierOn, 'fan': self.fanOn})
+            if result is not None:
+                self.publish_json('shadow/decision', {}, result)
+
+    @matching.match_start(CACHE_REPLY)
+    def cache_reply(self, topic, headers, message, match):
+        """The last command sent to each device, from the cache agent, asked for at start-up. They come oldest
+        first (after the last 'kill', if there was one), and are carried out in that order."""
+        if topic != CACHE_REPLY + self._agent_id or self.commanded:
+            return
+        for entry in jsonapi.loads(message[0])['values']:
+            if entry['topic'] == 'userinput/state' and entry['message'][1] in (
+                    'kill', 'run dehum', 'shed dehum', 'run fan', 'shed fan'):
+                self.control_dehum(entry['topic'], entry['headers'], [jsonapi.dumps(entry['message'])], None)
 
+    def process_command(self, command):
+        """ Perform a command, allowing only the transitions that are safe from the current state. """
         # Now, process the command that was sent.
         if command == 'kill':
             self.shed_dehum()
             self.shed_fan()
+        elif command == 'status':
+            self.get_output_status()
         elif self.dehumidifierOn is True:
             # The dehumidifier (compressor and fan) is currently turned on.
             if command == 'shed dehum':
@@ -124,8 +269,10 @@ class ControlAgent(PublishMixin, BaseAgent):
 # Include this section in every agent, but adjust the agent name and description.
 def main(argv=sys.argv):
     '''Main method called by the eggsecutable.'''
+    # Enable information and debug logging
+    utils.setup_logging()
     utils.default_main(ControlAgent,
-                   description='Control dehumidifier',
+                   description='Simulate the dehumidifier and the room it dries',
                    argv=argv)
 
 
@@ -0,0 +1,111 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Physics of the simulated room and dehumidifier for the control agent's digital twin.                   #
+# Humidity H (%RH) and temperature T (degrees C) each relax towards an equilibrium:                      #
+#     dH/dt = (ambient_humidity - H) / leak_hours + moisture_gain - dry_rate (compressor on)             #
+#                                                 - fan_dry_rate (fan on its own)                        #
+#     dT/dt = (ambient_temperature - T) / thermal_hours + compressor_heat (compressor on)                #
+# (rates per hour). With the relays fixed these are linear, so advance() uses the exact solution           #
+#     X(t + dt) = X_eq + (X(t) - X_eq) * exp(-dt / tau),   X_eq = ambient + tau * (sum of the rates)     #
+# and a step of any length costs the same. The relays only change between steps.                         #
+# Power is compressor_kw while the compressor runs plus fan_kw while the fan runs (the dehumidifier's    #
+# fan runs with its compressor); energy_kwh is its integral.                                             #
+# ------------------------------------------------------------------------------------------------------ #
+import math
+import random
+
+
+# Default room settings. Anything under "room" in the agent config overrides these.
+ROOM_DEFAULTS = {
+    'initial_humidity': 60.0,       # %RH
+    'ambient_humidity': 75.0,       # %RH the room drifts towards through leaks
+    'leak_hours': 8.0,              # time constant of that drift
+    'moisture_gain': 0.5,           # %RH per hour added by occupants, cooking, ...
+    'dry_rate': 6.0,                # %RH per hour removed while the compressor runs
+    'fan_dry_rate': 0.0,            # %RH per hour removed by the fan on its own
+    'initial_temperature': 21.0,    # degrees C
+    'ambient_temperature': 21.0,
+    'thermal_hours': 3.0,
+    'compressor_heat': 1.5,         # degrees C per hour added while the compressor runs
+    'compressor_kw': 0.55,
+    'fan_kw': 0.05,
+    'sensor_noise': 0.0,            # standard deviation of the noise added to each reading (%RH, degrees C)
+    'seed': None,                   # seed for the sensor noise, for repeatable runs
+}
+
+
+class Room(object):
+    """ Humidity, temperature and power of a room with one dehumidifier. """
+
+    def __init__(self, config, now):
+        self.config = dict(ROOM_DEFAULTS, **config)
+        for key in ('leak_hours', 'thermal_hours'):
+            if float(self.config[key]) <= 0:
+                raise ValueError('The room {} must be greater than 0'.format(key))
+        self.time = now
+        self.humidity = float(self.config['initial_humidity'])
+        self.temperature = float(self.config['initial_temperature'])
+        # Relay states, as actually switched (not as commanded).
+        self.compressor = False
+        self.fan = False
+        self.energy_kwh = 0.0
+        self.compressor_starts = 0
+        self.compressor_seconds = 0.0
+        self.random = random.Random(self.config['seed'])
+
+    def _humidity_equilibrium(self):
+        config = self.config
+        rate = float(config['moisture_gain'])
+        if self.compressor:
+            rate -= float(config['dry_rate'])
+        elif self.fan:
+            rate -= float(config['fan_dry_rate'])
+        return float(config['ambient_humidity']) + float(config['leak_hours']) * rate
+
+    def _temperature_equilibrium(self):
+        config = self.config
+        rate = float(config['compressor_heat']) if self.compressor else 0.0
+        return float(config['ambient_temperature']) + float(config['thermal_hours']) * rate
+
+    def power_kw(self):
+        config = self.config
+        return ((float(config['compressor_kw']) if self.compressor else 0.0) +
+                (float(config['fan_kw']) if self.fan or self.compressor else 0.0))
+
+    def advance(self, now):
+        """ Move the room on to time now (seconds) with the relays as they are. """
+        dt = now - self.time
+        if dt <= 0:
+            return
+        hours = dt / 3600.0
+        equilibrium = self._humidity_equilibrium()
+        self.humidity = equilibrium + (self.humidity - equilibrium) * math.exp(
+            -hours / float(self.config['leak_hours']))
+        self.humidity = min(100.0, max(0.0, self.humidity))
+        equilibrium = self._temperature_equilibrium()
+        self.temperature = equilibrium + (self.temperature - equilibrium) * math.exp(
+            -hours / float(self.config['thermal_hours']))
+        self.energy_kwh += self.power_kw() * hours
+        if self.compressor:
+            self.compressor_seconds += dt
+        self.time = now
+
+    def switch(self, now, compressor=None, fan=None):
+        """ Switch the relays at time now. None leaves a relay as it is. """
+        self.advance(now)
+        if compressor is not None:
+            if compressor and not self.compressor:
+                self.compressor_starts += 1
+            self.compressor = compressor
+        if fan is not None:
+            self.fan = fan
+
+    def humidity_rate(self):
+        """ Rate of change of the humidity now, in %RH per second. """
+        return (self._humidity_equilibrium() - self.humidity) / (float(self.config['leak_hours']) * 3600.0)
+
+    def read(self):
+        """ A sensor reading: (humidity, temperature), with noise if configured. """
+        noise = float(self.config['sensor_noise'])
+        if not noise:
+            return self.humidity, self.temperature
+        return (self.humidity + self.random.gauss(0.0, noise), self.temperature + self.random.gauss(0.0, noise))
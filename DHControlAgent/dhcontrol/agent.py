@@ -8,27 +8,134 @@
 # The received message is assigned to a variable called command.                                         #
 # The command is then processed and the necessary action is performed.                                   #
 # Possible actions include turning on or off the dehumidifier or fan, using BBB GPIO pins.               #
+# When the "sensor" section of the config is enabled, the agent also samples room humidity/temperature  #
+# on a timer, filters the samples in blocks (see filters.py) and publishes the latest filtered value     #
+# under 'dhcontrol/sensor'.                                                                              #
+# The 'auto' command hands control to the humidistat (see humidistat.py), which decides each time a new  #
+# filtered sample arrives. The 'schedule' command hands control to the time-of-use planner (see tou.py),  #
+# which runs the dehumidifier in the cheapest tariff periods that keep the humidity under a ceiling.      #
+# Any manual command ('run dehum', 'shed fan', 'kill', ...) returns to manual control.                    #
+# Demand-response events on 'fleet/demand_response' shed the compressor and fan at once; when the event  #
+# is released, each unit restores its prior state after its own (staggered and/or random) delay.         #
+# The agent watches its config file (see bbcommon/configwatch.py). An edited config is checked and, if it #
+# is usable, switched to as a whole; otherwise the current config stays in use. Outputs are only written  #
+# on a reload when the pin map changes.                                                                  #
+# With "shadow" enabled, the transitions each command made (and verified) are published on               #
+# 'shadow/actual', for comparison with a shadow agent's decisions (see bbcommon/shadow.py).              #
+# Every metrics.interval seconds the compressor's total run hours and starts (kept in the state file)    #
+# and the latest filtered reading are published on 'dhcontrol/metrics'. With "fleet" enabled, the        #
+# heartbeat, status and metrics are also republished under 'fleet/unit/<unit>/', for the fleet agent     #
+# (see bbcommon/fleet.py).                                                                               #
+# GPIO and sensor reads and writes run on a small pool of I/O threads (see bbcommon/iopool.py), so a     #
+# hung pin holds up the bus for at most io.timeout (20 ms). One that takes longer is treated as failed   #
+# (the read-back and retries deal with it), and the stall is published on 'dhcontrol/io'.                #
 # ------------------------------------------------------------------------------------------------------ #
 
 
 # --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
 # more import statements may be needed for other agents, but these work for this agent
 import logging
+import random
 import sys
+import time
 
 from zmq.utils import jsonapi
 from volttron.platform.agent import BaseAgent, PublishMixin
 from volttron.platform.agent import utils, matching
 #from volttron.platform.messaging import headers as headers_mod
 
-from bbio import *     # For BeagleBone
+from bbcommon.configwatch import ConfigWatcher, log_level
+from bbcommon.dispatch import CommandDispatcher, check_config as check_dispatch_config
+from bbcommon.fleet import check_forward_config, unit_prefix
+from bbcommon.heartbeat import Heartbeat, check_config as check_heartbeat_config
+from bbcommon.iopool import IOPool, IOStalled, check_config as check_io_config
+from bbcommon.journal import JOURNAL_DEFAULTS, JOURNAL_EPOCH, JOURNAL_SEQ, pending
+from bbcommon.lastvalue import CACHE_REPLY, request as request_cached
+from bbcommon.lazy import LazyModule
+from bbcommon.retry import RETRY_DEFAULTS, RetryEngine, check_config as check_retry_config
+from bbcommon.shadow import COMMAND_ID, outcome
+from bbcommon.stateboard import StateBoard, board_path
+from bbcommon.statefile import StateFile
+from bbcommon.timerqueue import AgentTimerQueue
+
+from dhcontrol import filters, humidistat, sensor, tou
 
-# Enable information and debug logging
-utils.setup_logging()
 _log = logging.getLogger(__name__)
+
+# For BeagleBone. bbio probes the hardware when it is imported, so it is imported the first time a pin
+# is used (in setup(), after the agent has joined the bus) instead of here.
+bbio = LazyModule('bbio')
 # --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
 
 
+# Default demand-response settings. Anything under "demand_response" in the config overrides these.
+# A unit restores its prior state restore_delay + unit_index * stagger + random(0, random_delay) seconds
+# after the event is released, so the fleet's compressors don't all start at once.
+DR_DEFAULTS = {
+    'unit_index': 0,
+    'restore_delay': 0.0,
+    'stagger': 30.0,
+    'random_delay': 60.0,
+}
+
+# GPIO pins, by their bbio names. Anything under "pins" in the config overrides these.
+PIN_DEFAULTS = {
+    'dehumidifier': 'GPIO1_28',             # P9.12 on BeagleBone, output
+    'fan': 'GPIO1_18',                      # P9.14 on BeagleBone, output
+    'dehumidifier_feedback': 'GPIO1_16',    # P9.15 on BeagleBone, input wired to P9.12
+    'fan_feedback': 'GPIO1_19',             # P9.16 on BeagleBone, input wired to P9.14
+}
+
+
+def load_settings(config):
+    """ Check config and build the settings the agent takes from it. Raises ValueError (or KeyError, TypeError
+        for missing or mistyped values) before anything is used, so a bad config changes nothing. """
+    sensor_config = dict(sensor.SENSOR_DEFAULTS, **config.get('sensor', {}))
+    if sensor_config['source'] not in sensor.SOURCES:
+        raise ValueError("Unknown sensor source {!r}. Valid sources are {}".format(
+            sensor_config['source'], sorted(sensor.SOURCES)))
+    if float(sensor_config['interval']) <= 0:
+        raise ValueError('The sensor interval must be greater than 0')
+    if not 1 <= int(sensor_config['block_size']) <= int(sensor_config['buffer_size']):
+        raise ValueError("The sensor block_size must be at least 1 and can't be larger than its buffer_size")
+    filters.check_config(dict(filters.FILTER_DEFAULTS, **sensor_config['filters']))
+    schedule_config = dict(tou.SCHEDULE_DEFAULTS, **config.get('schedule', {}))
+    dr_config = dict(DR_DEFAULTS, **config.get('demand_response', {}))
+    int(dr_config['unit_index'])
+    for key in ('restore_delay', 'stagger', 'random_delay'):
+        if float(dr_config[key]) < 0:
+            raise ValueError('The demand_response {} must not be negative'.format(key))
+    check_retry_config(config.get('retry', {}))
+    check_heartbeat_config(config.get('heartbeat', {}))
+    check_dispatch_config(config.get('dispatch', {}))
+    check_io_config(config.get('io', {}))
+    metrics_config = dict({'enabled': True, 'interval': 60.0}, **config.get('metrics', {}))
+    if float(metrics_config['interval']) <= 0:
+        raise ValueError('The metrics interval must be greater than 0')
+    pins = dict(PIN_DEFAULTS, **config.get('pins', {}))
+    if len(set(pins.values())) != len(pins):
+        raise ValueError('Each GPIO pin can only be used once: {}'.format(pins))
+    # The names can only be checked once bbio is imported; at start-up setup_pins() checks them.
+    if bbio.loaded:
+        unknown = sorted(name for name in pins.values() if not hasattr(bbio, name))
+        if unknown:
+            raise ValueError('Unknown GPIO pin(s) {}'.format(', '.join(unknown)))
+    return {'sensor': sensor_config,
+            'humidistat': humidistat.Humidistat(dict(humidistat.HUMIDISTAT_DEFAULTS,
+                                                     **config.get('humidistat', {}))),
+            'schedule': schedule_config,
+            'planner': tou.Planner(schedule_config),
+            'demand_response': dr_config,
+            'pins': pins,
+            'log_level': log_level(config.get('log_level')),
+            'shadow': bool(config.get('shadow', {}).get('enabled', False)),
+            'metrics': metrics_config,
+            'fleet': check_forward_config(config.get('fleet', {})),
+            'journal': dict(JOURNAL_DEFAULTS, **config.get('journal', {})),
+            'state_file': config.get('state_file', '/home/debian/startAtBoot/dhcontrol.state'),
+            'state_board': dict({'enabled': True, 'path': 'dhcontrol.board'}, **config.get('state_board', {}))}
+
+
 # Create a class with the convention: NameAgent
 # and always include "PublishMixin, BaseAgent" as its arguments.
 class DehumAgent(PublishMixin, BaseAgent):
@@ -38,73 +145,474 @@ class DehumAgent(PublishMixin, BaseAgent):
     def __init__(self, config_path, **kwargs):
         super(DehumAgent, self).__init__(**kwargs)
         self.config = utils.load_config(config_path)
-        # Assign address of GPIO to variable
-        self.portDehumWrite = GPIO1_28      # P9.12 on BeagleBone
-        self.portFanWrite = GPIO1_18        # P9.14 on BeagleBone
-        self.portDehumRead = GPIO1_16       # P9.15 on BeagleBone
-        self.portFanRead = GPIO1_19         # P9.16 on BeagleBone
-        # Initialize GPIO pins to be either output or input
-        pinMode(self.portDehumWrite, OUTPUT)     # P9.12 on BeagleBone is output
-        pinMode(self.portFanWrite, OUTPUT)       # P9.14 on BeagleBone is output
-        pinMode(self.portDehumRead, INPUT)       # P9.15 on BeagleBone is input
-        pinMode(self.portFanRead, INPUT)         # P9.16 on BeagleBone is input
-        # Initialize GPIO output pins to be off (low)
-        digitalWrite(self.portDehumWrite, LOW)
-        digitalWrite(self.portFanWrite, LOW)
+        settings = load_settings(self.config)
+        _log.setLevel(settings['log_level'])
         # Initialize flags to be false.
         self.dehumidifierOn = False
         self.fanOn = False
+        # GPIO pin names; the pins themselves are set up in setup_pins().
+        self.pins = settings['pins']
+        # Pin and sensor I/O runs on worker threads, in order per pin, with a timeout (see bbcommon/iopool.py).
+        self.io = IOPool(self, 'dhcontrol', self.config.get('io', {}), self.io_recovered)
+        # Humidity/temperature sampling (see sensor.py). Samples are kept in a ring buffer.
+        self.sensor_config = settings['sensor']
+        self.sensor_source = None
+        self.sensor_timer = None
+        self.samples = sensor.RingBuffer(int(self.sensor_config['buffer_size']))
+        self.sensor_errors = 0
+        # Samples taken since the last filtered block, and the filters (with their state) for each value.
+        # The filters are made in setup(), since making the first one imports NumPy.
+        self.unfiltered_samples = 0
+        self.humidity_filter = None
+        self.temperature_filter = None
+        # Humidistat ('auto' mode). lastDehumChange is when the compressor was last turned on or off.
+        self.humidistat = settings['humidistat']
+        self.lastDehumChange = None
+        # Compressor run time (up to lastDehumChange, if it is running now) and starts, for dhcontrol/metrics.
+        self.runSeconds = 0.0
+        self.compressorStarts = 0
+        self.lastReading = (None, None)
+        self.metrics_config = settings['metrics']
+        self.metrics_timer = None
+        # The heartbeat, status and metrics are republished under fleetPrefix for the fleet agent (None: not).
+        self.fleet_config = settings['fleet']
+        self.fleetPrefix = None
+        # Time-of-use schedule ('schedule' mode). Planned run windows wait in a heap-ordered timer queue.
+        self.schedule_config = settings['schedule']
+        self.planner = settings['planner']
+        self.schedule_queue = AgentTimerQueue(self, self.run_scheduled)
+        # The queued window edges, (time, command) -> queue entry, so a plan update only changes the ones
+        # that moved.
+        self.scheduleEntries = {}
+        # Who decides when the dehumidifier runs: 'manual', 'auto' (humidistat) or 'schedule'.
+        self.controlMode = 'manual'
+        # Demand response. While drActive, nothing may be turned on. drPrior is the (dehumidifier, fan)
+        # state to restore when the event is released.
+        self.dr_config = settings['demand_response']
+        self.drActive = False
+        self.drPrior = (False, False)
+        self.drRestoreTimer = None
+        # Writes that don't read back as expected are retried with backoff (see bbcommon/retry.py).
+        self.retries = RetryEngine(self, 'dhcontrol', self.config.get('retry', {}))
+        # Commands go through two lanes: 'kill' (and a demand-response shed) skips ahead of routine work
+        # and drops every output before anything else (see bbcommon/dispatch.py).
+        self.dispatcher = CommandDispatcher(self, 'dhcontrol', self.perform_command, self.stop_outputs,
+                                            self.config.get('dispatch', {}))
+        # The desired outputs and mode, saved on every change so a restart can resume them.
+        self.state_file = StateFile(settings['state_file'])
+        # The input agent's command journal (see bbcommon/journal.py), and the [epoch, seq] of the last
+        # journaled command handled here. Saved with the state, so a restart only applies what it missed.
+        self.journal_config = settings['journal']
+        self.journalPosition = None
+        # The outputs and mode in shared memory, for the input agents on this machine to read
+        # (see bbcommon/stateboard.py), with the id of the last command handled.
+        self.board = StateBoard(settings['state_board']['path']) if settings['state_board']['enabled'] else None
+        self.lastCommandId = None
+        # Shadow mode: publish each command's transitions on shadow/actual.
+        self.shadow = settings['shadow']
+        # Heartbeat: a full snapshot of the pins and flags now and then, and deltas when they change.
+        self.heartbeat = Heartbeat(self, 'dhcontrol/heartbeat', self.snapshot, self.config.get('heartbeat', {}))
+        # Edits to the config file are picked up without a restart (see reload_config()).
+        self.config_watch = ConfigWatcher(self, config_path, self.reload_config, self.config.get('config_watch', {}))
 
     def setup(self):
         # Demonstrate accessing a value from the config file
         _log.info(self.config['message'])
         self._agent_id = self.config['agentid']
         super(DehumAgent, self).setup()
+        self.set_fleet_prefix()
+        self.io.start()
+        self.setup_pins()
+        if self.sensor_config['enabled']:
+            self.sensor_source = sensor.make_source(self.sensor_config)
+            block_size = self.sensor_config['block_size']
+            self.humidity_filter = filters.make_filter(self.sensor_config['filters'], block_size)
+            self.temperature_filter = filters.make_filter(self.sensor_config['filters'], block_size)
+            # Sample on a reactor timer, so sampling runs between (never during) command handling.
+            self.sensor_timer = self.periodic_timer(float(self.sensor_config['interval']), self.sample_sensor)
+        self.reconcile()
+        self.replay_journal()
+        self.heartbeat.start()
+        self.start_metrics()
+        self.config_watch.start()
+        # In case a command was sent while this agent was down (see cache_reply()).
+        request_cached(self, self._agent_id, ['userinput/state'])
     # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
 
+    def setup_pins(self, previous=None):
+        """ Set up the GPIO pins named in the config. The first call imports bbio.
+            previous is the pin map before a reload: pins that haven't moved are left alone, since setting a
+            pin's mode again can reset its level. """
+        # Assign address of GPIO to variable (by default P9.12, P9.14, P9.15 and P9.16 on BeagleBone)
+        self.portDehumWrite = getattr(bbio, self.pins['dehumidifier'])
+        self.portFanWrite = getattr(bbio, self.pins['fan'])
+        self.portDehumRead = getattr(bbio, self.pins['dehumidifier_feedback'])
+        self.portFanRead = getattr(bbio, self.pins['fan_feedback'])
+        # Initialize GPIO pins to be either output or input
+        for name, port, mode in (('dehumidifier', self.portDehumWrite, bbio.OUTPUT),
+                                 ('fan', self.portFanWrite, bbio.OUTPUT),
+                                 ('dehumidifier_feedback', self.portDehumRead, bbio.INPUT),
+                                 ('fan_feedback', self.portFanRead, bbio.INPUT)):
+            if previous is None or previous[name] != self.pins[name]:
+                try:
+                    self.io.call(port, bbio.pinMode, port, mode)
+                except IOStalled:
+                    _log.error("Setting up the {} pin stalled; it will read back wrong until it is done.".format(name))
+        # The output levels are left alone here; reconcile() decides what they should be.
+
+    def write_pin(self, port, level):
+        """ Write an output pin on the I/O pool. A write that stalls is left for the read-back to catch. """
+        try:
+            self.io.call(port, bbio.digitalWrite, port, level)
+        except IOStalled:
+            pass
+
+    def read_pin(self, port):
+        """ Read a feedback pin on the I/O pool. Returns None if the read stalled. """
+        try:
+            return self.io.call(port, bbio.digitalRead, port)
+        except IOStalled:
+            return None
+
+    def io_recovered(self, port):
+        """ Called by the I/O pool when a stalled operation on port has ended. A write given up on may have
+            changed the output since, so it is set back to the state last verified, unless a retry is waiting
+            to set it. """
+        for component, output, on in (('dehumidifier', self.portDehumWrite, self.dehumidifierOn),
+                                      ('fan', self.portFanWrite, self.fanOn)):
+            if port == output and component not in self.retries.timers:
+                level = bbio.HIGH if on else bbio.LOW
+                self.write_pin(output, level)
+                self.check_output(component, level)
+        self.heartbeat.check()
+
+    def reconcile(self):
+        """ Match the outputs to the saved state, leaving alone any relay that is already right. """
+        saved = self.state_file.load()
+        if saved is None:
+            # Nothing to resume (first start): initialize GPIO output pins to be off (low)
+            _log.info("No saved state in {}; starting with everything off.".format(self.state_file.path))
+            self.write_pin(self.portDehumWrite, bbio.LOW)
+            self.write_pin(self.portFanWrite, bbio.LOW)
+            self.save_state()
+            return
+        # Start from what the feedback pins say is really on.
+        self.dehumidifierOn = self.read_pin(self.portDehumRead) == bbio.HIGH
+        self.fanOn = self.read_pin(self.portFanRead) == bbio.HIGH
+        self.lastDehumChange = saved.get('lastDehumChange')
+        self.runSeconds = float(saved.get('runSeconds', 0.0))
+        self.compressorStarts = int(saved.get('compressorStarts', 0))
+        self.journalPosition = saved.get('journalPosition')
+        dehumidifier = saved.get('dehumidifierOn', False) is True
+        # The fan on its own and the dehumidifier are never both on.
+        fan = saved.get('fanOn', False) is True and not dehumidifier
+        if (self.dehumidifierOn, self.fanOn) == (dehumidifier, fan):
+            _log.info("Resumed the saved state (dehumidifier on: {}, fan on: {}) without changing the outputs.".format(
+                dehumidifier, fan))
+        else:
+            _log.warning("The outputs don't match the saved state: dehumidifier {} (saved {}), fan {} (saved {}).".format(
+                self.dehumidifierOn, dehumidifier, self.fanOn, fan))
+            # Turn off whatever shouldn't be on before turning anything on.
+            if self.dehumidifierOn is True and dehumidifier is False:
+                self.shed_dehum()
+            if self.fanOn is True and fan is False:
+                self.shed_fan()
+            if dehumidifier is True and self.dehumidifierOn is False and self.fanOn is False:
+                self.run_dehum()
+            elif fan is True and self.fanOn is False and self.dehumidifierOn is False:
+                self.run_fan()
+        if saved.get('controlMode', 'manual') != 'manual':
+            self.set_control_mode(saved['controlMode'])
+        self.save_state()
+
+    def replay_journal(self):
+        """ Catch up with the commands sent while this agent wasn't running. Only the state wanted after the
+            last of them is applied, not each command in turn. """
+        if not self.journal_config['enabled']:
+            return
+        record = pending(self.journal_config['path'], self.journalPosition)
+        if record is None:
+            return
+        desired = record['desired']
+        _log.info("Catching up with the command journal: after '{}' the wanted state is {}.".format(
+            record['command'], desired))
+        if desired['mode'] != 'manual':
+            self.handle_command(desired['mode'])
+        else:
+            self.handle_command('manual')
+            # Turn off whatever shouldn't be on before turning anything on.
+            if self.dehumidifierOn is True and desired['dehumidifier'] is False:
+                self.handle_command('shed dehum')
+            if self.fanOn is True and desired['fan'] is False:
+                self.handle_command('shed fan')
+            if desired['dehumidifier'] is True:
+                self.handle_command('run dehum')
+            elif desired['fan'] is True:
+                self.handle_command('run fan')
+        self.journalPosition = [record['epoch'], record['seq']]
+        self.save_state()
+
+    def reload_config(self, path):
+        """ Called by the config watcher when the config file has changed. The new config is checked in full
+            first; if anything in it is wrong, the current config stays in use. """
+        try:
+            config = utils.load_config(path)
+            settings = load_settings(config)
+            sensor_config = settings['sensor']
+            source = humidity_filter = temperature_filter = None
+            if sensor_config['enabled']:
+                source = self.sensor_source
+                if source is None or sensor_config != self.sensor_config:
+                    source = sensor.make_source(sensor_config)
+                humidity_filter, temperature_filter = self.humidity_filter, self.temperature_filter
+                if (humidity_filter is None or sensor_config['filters'] != self.sensor_config['filters']
+                        or sensor_config['block_size'] != self.sensor_config['block_size']):
+                    humidity_filter = filters.make_filter(sensor_config['filters'], sensor_config['block_size'])
+                    temperature_filter = filters.make_filter(sensor_config['filters'], sensor_config['block_size'])
+        except (IOError, ValueError, KeyError, TypeError, AttributeError) as error:
+            _log.error("The changed config in {} can't be used ({}); keeping the current config.".format(path, error))
+            self.publish_json('dhcontrol/status', {}, ('FAILED', 'config', 'RELOAD'))
+            return
+
+        # Everything checked out: switch to the new settings in one go.
+        self.config = config
+        self._agent_id = config['agentid']
+        _log.setLevel(settings['log_level'])
+        if settings['pins'] != self.pins:
+            self.move_pins(settings['pins'])
+        if sensor_config != self.sensor_config or source is not self.sensor_source:
+            self.reload_sensor(sensor_config, source, humidity_filter, temperature_filter)
+        self.humidistat = settings['humidistat']
+        if settings['schedule'] != self.schedule_config:
+            ceiling = settings['schedule']['humidity_ceiling']
+            if dict(settings['schedule'], humidity_ceiling=self.schedule_config['humidity_ceiling']) == \
+                    self.schedule_config:
+                # Only the ceiling changed: the current plan is updated for it, not made again.
+                self.schedule_config = settings['schedule']
+                if self.controlMode == 'schedule' and self.planner.start is not None:
+                    self.update_schedule(self.lastReading[0], time.time(), ceiling)
+                else:
+                    self.planner.ceiling = float(ceiling)
+            else:
+                # The queued windows came from the old plan; a new one is made from the next filtered sample.
+                self.schedule_config = settings['schedule']
+                self.planner = settings['planner']
+                self.clear_schedule()
+        self.dr_config = settings['demand_response']
+        self.shadow = settings['shadow']
+        if settings['metrics'] != self.metrics_config:
+            self.metrics_config = settings['metrics']
+            self.start_metrics()
+        self.fleet_config = settings['fleet']
+        self.set_fleet_prefix()
+        self.journal_config = settings['journal']
+        self.retries.config = dict(RETRY_DEFAULTS, **config.get('retry', {}))
+        self.heartbeat.reconfigure(config.get('heartbeat', {}))
+        self.dispatcher.reconfigure(config.get('dispatch', {}))
+        self.io.reconfigure(config.get('io', {}))
+        if settings['state_file'] != self.state_file.path:
+            self.state_file = StateFile(settings['state_file'])
+            self.save_state()
+        board = settings['state_board']
+        if not board['enabled']:
+            self.board = None
+        elif self.board is None or self.board.path != board_path(board['path']):
+            self.board = StateBoard(board['path'])
+            self.update_board()
+        _log.info("Reloaded the config from {}.".format(path))
+        self.publish_json('dhcontrol/status', {}, ('SUCCESS', 'config', 'RELOAD'))
+        self.heartbeat.check()
+
+    def move_pins(self, pins):
+        """ Switch to a new pin map. A moved output is set to the device's current state and an output that
+            is no longer used is set low; no other pin is written. """
+        old_outputs = (self.portDehumWrite, self.portFanWrite)
+        previous, self.pins = self.pins, pins
+        self.setup_pins(previous)
+        for port in old_outputs:
+            if port not in (self.portDehumWrite, self.portFanWrite):
+                self.write_pin(port, bbio.LOW)
+        for component, port, old_port, on in (('dehumidifier', self.portDehumWrite, old_outputs[0], self.dehumidifierOn),
+                                              ('fan', self.portFanWrite, old_outputs[1], self.fanOn)):
+            if port != old_port:
+                level = bbio.HIGH if on else bbio.LOW
+                self.write_pin(port, level)
+                self.check_output(component, level)
+        _log.info("Now using the GPIO pins {}.".format(pins))
+
+    def reload_sensor(self, sensor_config, source, humidity_filter, temperature_filter):
+        """ Switch to new sensor settings, keeping the samples (and the filters, if their settings are the same). """
+        if self.sensor_timer is not None:
+            self.sensor_timer.cancel()
+            self.sensor_timer = None
+        if int(sensor_config['buffer_size']) != self.samples.size:
+            samples = sensor.RingBuffer(int(sensor_config['buffer_size']))
+            for sample in self.samples.latest(samples.size):
+                samples.append(*sample)
+            self.samples = samples
+        self.unfiltered_samples = min(self.unfiltered_samples, len(self.samples))
+        self.sensor_config = sensor_config
+        self.sensor_source = source
+        self.humidity_filter = humidity_filter
+        self.temperature_filter = temperature_filter
+        if source is not None:
+            self.sensor_timer = self.periodic_timer(float(sensor_config['interval']), self.sample_sensor)
+        elif self.controlMode != 'manual':
+            _log.warning("The sensor is now disabled; returning to manual control.")
+            self.set_control_mode('manual')
+
+    def save_state(self):
+        """ Save the outputs and mode for the next start. """
+        try:
+            self.state_file.save({'dehumidifierOn': self.dehumidifierOn, 'fanOn': self.fanOn,
+                                  'controlMode': self.controlMode, 'lastDehumChange': self.lastDehumChange,
+                                  'runSeconds': self.runSeconds, 'compressorStarts': self.compressorStarts,
+                                  'journalPosition': self.journalPosition})
+        except (IOError, OSError) as error:
+            _log.error("Could not save the state to {}: {}".format(self.state_file.path, error))
+        self.update_board()
+
+    def update_board(self):
+        """ Put the outputs and mode on the state board. """
+        if self.board is None:
+            return
+        try:
+            self.board.publish({'dehumidifier': self.dehumidifierOn, 'fan': self.fanOn, 'mode': self.controlMode,
+                                'dr': self.drActive, 'command': self.lastCommandId, 'time': time.time()})
+        except (IOError, OSError, ValueError) as error:
+            _log.error("Could not update the state board {}: {}".format(self.board.path, error))
+
     def run_dehum(self):
-        """Set P9.12 high"""
-        digitalWrite(self.portDehumWrite, HIGH)     # For BeagleBone
+        """Set P9.12 high, retrying if it doesn't read back high"""
+        self.retries.actuate('dehumidifier', self._run_dehum)
+
+    def _run_dehum(self):
+        self.write_pin(self.portDehumWrite, bbio.HIGH)     # For BeagleBone
         # Check that the command has been correctly implemented.
-        if self.check_output('dehumidifier', HIGH) is True:
+        if self.check_output('dehumidifier', bbio.HIGH) is True:
             # Set flag, so know dehumidifier is on, and log transition
+            if self.dehumidifierOn is False:
+                self.compressorStarts += 1
+                self.lastDehumChange = time.time()
             self.dehumidifierOn = True
+            self.save_state()
             _log.info("SUCCESS - The dehumidifier (compressor and fan) is now on.")
+            return True
+        return False
 
     def shed_dehum(self):
-        """Set P9.12 low"""
-        digitalWrite(self.portDehumWrite, LOW)      # For BeagleBone
+        """Set P9.12 low, retrying if it doesn't read back low"""
+        self.retries.actuate('dehumidifier', self._shed_dehum, safe=True)
+
+    def _shed_dehum(self):
+        self.write_pin(self.portDehumWrite, bbio.LOW)      # For BeagleBone
         # Check that the command has been correctly implemented.
-        if self.check_output('dehumidifier', LOW) is True:
+        if self.check_output('dehumidifier', bbio.LOW) is True:
             # Set flag, so know dehumidifier is off, and log transition
+            if self.dehumidifierOn is True:
+                self.end_run()
             self.dehumidifierOn = False
+            self.save_state()
             _log.info("SUCCESS - The dehumidifier (compressor and fan) is now off.")
+            return True
+        return False
 
     def run_fan(self):
-        """Set P9.14 high"""
-        digitalWrite(self.portFanWrite, HIGH)       # For BeagleBone
+        """Set P9.14 high, retrying if it doesn't read back high"""
+        self.retries.actuate('fan', self._run_fan)
+
+    def _run_fan(self):
+        self.write_pin(self.portFanWrite, bbio.HIGH)       # For BeagleBone
         # Check that the command has been correctly implemented.
-        if self.check_output('fan', HIGH) is True:
+        if self.check_output('fan', bbio.HIGH) is True:
             # Set flag, so know fan is on, and log transition
             self.fanOn = True
+            self.save_state()
             _log.info("SUCCESS - The fan is now on.")
+            return True
+        return False
 
     def shed_fan(self):
-        """Set P9.14 low"""
-        digitalWrite(self.portFanWrite, LOW)        # For BeagleBone
+        """Set P9.14 low, retrying if it doesn't read back low"""
+        self.retries.actuate('fan', self._shed_fan, safe=True)
+
+    def _shed_fan(self):
+        self.write_pin(self.portFanWrite, bbio.LOW)        # For BeagleBone
         # Check that the command has been correctly implemented.
-        if self.check_output('fan', LOW) is True:
+        if self.check_output('fan', bbio.LOW) is True:
             # Set flag, so know fan is off, and log transition
             self.fanOn = False
+            self.save_state()
             _log.info("SUCCESS - The fan is now off.")
+            return True
+        return False
+
+    def end_run(self):
+        """ The compressor has stopped: add the run to its total run time. """
+        now = time.time()
+        if self.lastDehumChange is not None:
+            self.runSeconds += max(0.0, now - self.lastDehumChange)
+        self.lastDehumChange = now
+
+    def run_hours(self):
+        """ Total compressor run time, in hours, including the current run. """
+        running = 0.0
+        if self.dehumidifierOn is True and self.lastDehumChange is not None:
+            running = max(0.0, time.time() - self.lastDehumChange)
+        return (self.runSeconds + running) / 3600.0
+
+    def start_metrics(self):
+        if self.metrics_timer is not None:
+            self.metrics_timer.cancel()
+            self.metrics_timer = None
+        if self.metrics_config['enabled']:
+            self.metrics_timer = self.periodic_timer(float(self.metrics_config['interval']), self.publish_metrics)
+
+    def publish_metrics(self):
+        humidity, temperature = self.lastReading
+        self.publish_json('dhcontrol/metrics', {}, {'time': time.time(), 'run_hours': round(self.run_hours(), 4),
+                                                    'starts': self.compressorStarts, 'humidity': humidity,
+                                                    'temperature': temperature})
+
+    def set_fleet_prefix(self):
+        """ Take the prefix to forward to the fleet agent under from the config. """
+        config = self.fleet_config
+        self.fleetPrefix = unit_prefix(config['unit'] or self._agent_id) if config['enabled'] else None
+
+    def stop_outputs(self, reason=None):
+        """ Cancel whatever is pending that could turn an output on, and set P9.12 and P9.14 low. Nothing
+            is read back or published here, so it is as quick as it can be; shed_all() verifies. """
+        self.retries.cancel()
+        self.clear_schedule()
+        # Both relays are written before either is read back, so they drop as close together as possible
+        # (on two I/O workers at once).
+        self.io.call_all([(self.portDehumWrite, bbio.digitalWrite, (self.portDehumWrite, bbio.LOW)),
+                          (self.portFanWrite, bbio.digitalWrite, (self.portFanWrite, bbio.LOW))])
+
+    def shed_all(self):
+        """ Set P9.12 and P9.14 low together, then verify both. """
+        self.stop_outputs()
+        if self.check_output('dehumidifier', bbio.LOW) is True:
+            if self.dehumidifierOn is True:
+                self.end_run()
+            self.dehumidifierOn = False
+        else:
+            self.shed_dehum()
+        if self.check_output('fan', bbio.LOW) is True:
+            self.fanOn = False
+        else:
+            self.shed_fan()
+        self.save_state()
+        _log.info("Shed the dehumidifier and fan (dehumidifier on: {}, fan on: {}).".format(
+            self.dehumidifierOn, self.fanOn))
 
     def check_output(self, component, expected_status):
         """ Verify that the output from GPIO pins is what is expected based on the user's command.
             Input pins connected to output pins - check if output voltage matches what is expected. """
         if component == 'dehumidifier':
             # Read input pins
-            pin_status = digitalRead(self.portDehumRead)
-            if pin_status == HIGH:
+            pin_status = self.read_pin(self.portDehumRead)
+            if pin_status == bbio.HIGH:
                 mode = 'ON'
             else:
                 mode = 'OFF'
@@ -120,8 +628,8 @@ class DehumAgent(PublishMixin, BaseAgent):
                 self.publish_json('dhcontrol/status', {}, ('FAILED', component, mode))
                 return False
         elif component == 'fan':
-            pin_status = digitalRead(self.portFanRead)
-            if pin_status == HIGH:
+            pin_status = self.read_pin(self.portFanRead)
+            if pin_status == bbio.HIGH:
                 mode = 'ON'
             else:
                 mode = 'OFF'
@@ -135,23 +643,161 @@ class DehumAgent(PublishMixin, BaseAgent):
                 self.publish_json('dhcontrol/status', {}, ('FAILED', component, mode))
                 return False
 
+    def sample_sensor(self):
+        """ Take one humidity/temperature sample and store it. Filter each full block of samples. """
+        try:
+            humidity, temperature = self.io.call('sensor', self.sensor_source.read)
+        except (IOError, OSError, ValueError, IndexError, IOStalled) as error:
+            # A bad read is skipped; the next timer tick tries again.
+            self.sensor_errors += 1
+            _log.warning("Sensor read failed ({} so far): {}".format(self.sensor_errors, error))
+            return
+        self.samples.append(time.time(), humidity, temperature)
+        self.unfiltered_samples += 1
+        if self.unfiltered_samples >= int(self.sensor_config['block_size']):
+            self.filter_samples()
+
+    def filter_samples(self):
+        """ Filter the samples taken since the last block and publish the newest filtered value. """
+        block = self.samples.latest(self.unfiltered_samples)
+        self.unfiltered_samples = 0
+        timestamps = [sample[0] for sample in block]
+        humidity, humidity_rate = self.humidity_filter.process(timestamps, [sample[1] for sample in block])
+        humidity, humidity_rate = float(humidity[-1]), float(humidity_rate[-1])
+        temperatures = [sample[2] for sample in block]
+        temperature = None
+        if None not in temperatures:
+            temperature = float(self.temperature_filter.process(timestamps, temperatures)[0][-1])
+        timestamp = timestamps[-1]
+        self.lastReading = (humidity, temperature)
+        self.publish_json('dhcontrol/sensor', {}, {'time': timestamp, 'humidity': humidity,
+                                                   'humidity_rate': humidity_rate,
+                                                   'temperature': temperature})
+        if self.controlMode == 'auto':
+            self.run_humidistat(humidity, timestamp)
+        elif self.controlMode == 'schedule':
+            self.update_schedule(humidity, timestamp)
+
+    def run_humidistat(self, humidity, now):
+        """ In auto mode, turn the dehumidifier on or off based on the latest filtered humidity. """
+        deferred = self.humidistat.deferred
+        command = self.humidistat.decide(humidity, self.dehumidifierOn, self.lastDehumChange, now)
+        if self.humidistat.deferred:
+            _log.info("Humidistat: {:.1f} %RH, change deferred to protect the compressor.".format(humidity))
+        if command is None:
+            if self.humidistat.deferred != deferred:
+                # Deferral is on the heartbeat (for the LED agent's health mode), so publish the change now.
+                self.heartbeat.check()
+            return
+        _log.info("Humidistat: {:.1f} %RH, sending '{}'.".format(humidity, command))
+        self.process_automatic(command)
+        self.heartbeat.check()
+
+    def process_automatic(self, command):
+        """ Perform a command decided by the humidistat or the schedule. """
+        if command == 'run dehum' and self.fanOn is True:
+            # The fan and dehumidifier can't both be controlled, so turn the fan off first.
+            self.process_command('shed fan')
+        self.process_command(command)
+
+    def update_schedule(self, humidity, now, ceiling=None):
+        """ In schedule mode, update the plan with the latest humidity (and a new ceiling, if given) and queue
+            its run windows. """
+        if not self.planner.update(now, humidity, ceiling=ceiling):
+            return
+        windows = self.planner.windows(now)
+        _log.info("Schedule: {} run window(s) planned, estimated cost {:.2f}.".format(
+            len(windows), self.planner.cost(float(self.schedule_config['power_kw']))))
+        if self.planner.infeasible:
+            _log.warning("Schedule: the humidity ceiling can't be met even running continuously.")
+        # Queue the edges of the windows still to come (a window under way starts now). Edges already queued
+        # are left alone; only the ones the update added or removed are queued or canceled.
+        edges = {}
+        for start, end in self.planner.windows():
+            if end > now:
+                edges[(start, 'run dehum')] = max(start, now)
+                edges[(end, 'shed dehum')] = end
+        for edge in list(self.scheduleEntries):
+            if edge not in edges:
+                self.schedule_queue.cancel(self.scheduleEntries.pop(edge))
+        if self.dehumidifierOn is True and not (windows and windows[0][0] <= now):
+            self.schedule_queue.push(now, 'shed dehum')
+        for edge, deadline in sorted(edges.items(), key=lambda item: item[1]):
+            if edge not in self.scheduleEntries:
+                self.scheduleEntries[edge] = self.schedule_queue.push(deadline, edge[1])
+
+    def clear_schedule(self):
+        """ Drop the queued run windows. A new plan is made from the next filtered sample. """
+        self.schedule_queue.clear()
+        self.scheduleEntries = {}
+        self.planner.start = None
+
+    def run_scheduled(self, command):
+        """ Called by the schedule's timer queue when a planned window starts or ends. """
+        if self.controlMode == 'schedule':
+            _log.info("Schedule: sending '{}'.".format(command))
+            self.process_automatic(command)
+            self.heartbeat.check()
+
+    def set_control_mode(self, mode):
+        """ Switch between manual, humidistat ('auto') and time-of-use ('schedule') control. """
+        if mode != 'manual' and self.sensor_source is None:
+            _log.warning("'{}' mode needs the humidity sensor; enable it under 'sensor' in the config.".format(mode))
+            self.publish_json('dhcontrol/status', {}, ('FAILED', 'mode', mode.upper()))
+        elif mode != self.controlMode:
+            self.controlMode = mode
+            # A new schedule is planned from the next filtered sample.
+            self.clear_schedule()
+            self.save_state()
+            _log.info("Control mode is now {}.".format(mode))
+            self.publish_json('dhcontrol/status', {}, ('SUCCESS', 'mode', mode.upper()))
+
     def get_output_status(self):
         """ Log the output status of each GPIO pin. """
-        pin_status_dehum = digitalRead(self.portDehumRead)
-        if pin_status_dehum == HIGH:
+        pin_status_dehum = self.read_pin(self.portDehumRead)
+        if pin_status_dehum == bbio.HIGH:
             mode = 'ON'
         else:
             mode = 'OFF'
         # Log the input pin status
         _log.info("Dehumidifier: {}".format(mode))
 
-        pin_status_fan = digitalRead(self.portFanRead)
-        if pin_status_fan == HIGH:
+        pin_status_fan = self.read_pin(self.portFanRead)
+        if pin_status_fan == bbio.HIGH:
             mode = 'ON'
         else:
             mode = 'OFF'
         # Log the input pin status
         _log.info("         Fan: {}".format(mode))
+        _log.info("        Mode: {}".format(self.controlMode.upper()))
+
+        latest = self.samples.last()
+        if latest is not None:
+            _log.info("    Humidity: {:.1f} %RH (sampled {:.0f} s ago)".format(latest[1], time.time() - latest[0]))
+        for device, counts in sorted(self.retries.counts.items()):
+            _log.info("     Retries: {} {}{}".format(device, counts,
+                                                     ' (DEGRADED)' if self.retries.blocked(device) else ''))
+        if self.io.stalls:
+            _log.info("   I/O stalls: {}".format(self.io.counts()))
+
+    def outputs(self):
+        """ The outputs as last verified, for shadow/actual. """
+        return {'dehumidifier': self.dehumidifierOn, 'fan': self.fanOn}
+
+    def snapshot(self):
+        """ Compact state for the heartbeat: the feedback pins and the agent's flags. """
+        # Both pins are read at once; a read that stalled (an IOStalled in place of a level) shows as UNKNOWN.
+        dehum, fan = self.io.call_all([(self.portDehumRead, bbio.digitalRead, (self.portDehumRead,)),
+                                       (self.portFanRead, bbio.digitalRead, (self.portFanRead,))])
+        return {'dehum': 'ON' if dehum == bbio.HIGH else 'OFF' if dehum == bbio.LOW else 'UNKNOWN',
+                'fan': 'ON' if fan == bbio.HIGH else 'OFF' if fan == bbio.LOW else 'UNKNOWN',
+                'dehumOn': self.dehumidifierOn,
+                'fanOn': self.fanOn,
+                'mode': self.controlMode,
+                'dr': self.drActive,
+                'deferred': self.controlMode == 'auto' and self.humidistat.deferred,
+                'degraded': sorted(device for device in list(self.retries.degraded) if self.retries.blocked(device)),
+                'io_stuck': self.io.stuck_keys()}
 
     # If a message with the subscription name "userinput/state" is in the message bus,
     # execute the text below.
@@ -166,12 +812,134 @@ class DehumAgent(PublishMixin, BaseAgent):
         # message has format [prev_state, state]
         command = jsonapi.loads(message[0])
         command = command[1]
+        self.dispatcher.submit(command, headers)
+
+    def perform_command(self, command, headers):
+        """ Called by the dispatcher with a command from the bus, in its turn: perform it and record it. """
+        before = self.outputs()
+        self.handle_command(command)
+        if self.shadow:
+            result = outcome(headers, command, before, self.outputs())
+            if result is not None:
+                self.publish_json('shadow/actual', {}, result)
+        if headers.get(JOURNAL_EPOCH) is not None:
+            self.journalPosition = [headers[JOURNAL_EPOCH], headers[JOURNAL_SEQ]]
+        # Readers of the board can now tell that this command has been dealt with.
+        self.lastCommandId = headers.get(COMMAND_ID)
+        self.save_state()
+        self.heartbeat.check()
+
+    def handle_command(self, command):
+        """ Switch the control mode if command calls for it, then perform it. """
         _log.info("Received the command {}.".format(command))
+        if command in ('auto', 'schedule'):
+            self.set_control_mode(command)
+        elif command in ('kill', 'run dehum', 'shed dehum', 'run fan', 'shed fan', 'manual'):
+            # Manual commands override the humidistat and the schedule.
+            self.set_control_mode('manual')
+        self.process_command(command)
 
-        # Now, process the command that was sent.
+    @matching.match_start(CACHE_REPLY)
+    def cache_reply(self, topic, headers, message, match):
+        """The last command sent to each device, from the cache agent, asked for at start-up. They come oldest
+        first (after the last 'kill', if there was one), and are carried out in that order."""
+        if topic != CACHE_REPLY + self._agent_id or self.lastCommandId is not None:
+            # Not for this agent, or a command has arrived since start-up (and is at least as new).
+            return
+        for entry in jsonapi.loads(message[0])['values']:
+            if entry['topic'] != 'userinput/state' or entry['message'][1] not in (
+                    'kill', 'run dehum', 'shed dehum', 'run fan', 'shed fan', 'auto', 'schedule', 'manual'):
+                # Not a command for the dehumidifier (an LED command, say).
+                continue
+            epoch, seq = entry['headers'].get(JOURNAL_EPOCH), entry['headers'].get(JOURNAL_SEQ)
+            if epoch is not None and self.journalPosition and self.journalPosition[0] == epoch \
+                    and seq <= self.journalPosition[1]:
+                # Already applied from the command journal.
+                continue
+            _log.info("Catching up with the last command sent to the {}: {}.".format(entry['key'], entry['message'][1]))
+            self.control_dehum(entry['topic'], entry['headers'], [jsonapi.dumps(entry['message'])], None)
+
+    @matching.match_exact("dhcontrol/snapshot/request")
+    def heartbeat_request(self, topic, headers, message, match):
+        """A subscriber missed a heartbeat delta and asked for a full snapshot."""
+        self.heartbeat.publish_full()
+
+    @matching.match_start("dhcontrol/")
+    def fleet_forward(self, topic, headers, message, match):
+        """Republish this unit's heartbeat, status and metrics for the fleet agent, as they are."""
+        if self.fleetPrefix is not None and topic in self.fleet_config['topics']:
+            self.publish(self.fleetPrefix + topic, headers, *message)
+
+    @matching.match_start("fleet/demand_response")
+    def demand_response(self, topic, headers, message, match):
+        """Shed on a demand-response event, restore after it is released."""
+        # message published as... self.publish_json('fleet/demand_response', {}, {'event': 'shed', 'id': ...})
+        # 'units' (a list of agent ids) limits the event to those units.
+        event = jsonapi.loads(message[0])
+        units = event.get('units')
+        if units is not None and self._agent_id not in units:
+            return
+        _log.info("Received demand-response event {} ({}).".format(event.get('id'), event.get('event')))
+        if event.get('event') == 'shed':
+            # A safety event: the outputs drop first, ahead of any queued command.
+            self.dispatcher.urgent('demand response', headers, self.start_demand_response)
+        elif event.get('event') == 'release' and self.drActive is True and self.drRestoreTimer is None:
+            config = self.dr_config
+            delay = (float(config['restore_delay']) + int(config['unit_index']) * float(config['stagger']) +
+                     random.uniform(0, float(config['random_delay'])))
+            _log.info("Demand response released; restoring in {:.0f} s.".format(delay))
+            self.drRestoreTimer = self.timer(delay, self.end_demand_response)
+
+    def start_demand_response(self):
+        """ Shed everything until the demand-response event is released. """
+        if self.drRestoreTimer is not None:
+            # A new event arrived before the last one's restore: keep waiting.
+            self.drRestoreTimer.cancel()
+            self.drRestoreTimer = None
+        if self.drActive is False:
+            # The flags still hold what was on before stop_outputs() dropped the relays.
+            self.drPrior = (self.dehumidifierOn, self.fanOn)
+            self.drActive = True
+        self.shed_all()
+        self.publish_json('dhcontrol/status', {}, ('SUCCESS', 'demand response', 'ON'))
+        self.heartbeat.check()
+
+    def end_demand_response(self):
+        """ Restore the state from before the demand-response event. """
+        self.drRestoreTimer = None
+        self.drActive = False
+        self.publish_json('dhcontrol/status', {}, ('SUCCESS', 'demand response', 'OFF'))
+        if self.controlMode == 'manual':
+            dehumidifier, fan = self.drPrior
+            if dehumidifier is True:
+                self.process_command('run dehum')
+            elif fan is True:
+                self.process_command('run fan')
+        elif self.controlMode == 'schedule':
+            # Windows were missed during the event, so plan again from the next sample.
+            self.clear_schedule()
+        # In auto mode the humidistat decides at the next sample.
+        self.heartbeat.check()
+
+    def process_command(self, command):
+        """ Perform a command, allowing only the transitions that are safe from the current state. """
+        if self.drActive is True:
+            if command in ('run dehum', 'run fan'):
+                # Nothing may be turned on during a demand-response event.
+                _log.info("'{}' refused during a demand-response event.".format(command))
+                component = 'dehumidifier' if command == 'run dehum' else 'fan'
+                self.publish_json('dhcontrol/status', {}, ('FAILED', component, 'OFF'))
+                return
+            # Turning something off now also means it stays off once the event is released.
+            dehumidifier, fan = self.drPrior
+            self.drPrior = (dehumidifier and command not in ('kill', 'shed dehum'),
+                            fan and command not in ('kill', 'shed fan'))
+        if command != 'status':
+            # A new command replaces any retry waiting to turn something on, so an old command can't fight
+            # the interlock. Retries that turn something off carry on.
+            self.retries.cancel(keep_safe=True)
         if command == 'kill':
-            self.shed_dehum()
-            self.shed_fan()
+            self.shed_all()
         elif command == 'status':
             self.get_output_status()
 
@@ -210,6 +978,8 @@ class DehumAgent(PublishMixin, BaseAgent):
 # Include this section in every agent, but adjust the agent name and description.
 def main(argv=sys.argv):
     '''Main method called by the eggsecutable.'''
+    # Enable information and debug logging
+    utils.setup_logging()
     utils.default_main(DehumAgent,
                    description='Control dehumidifier',
                    argv=argv)
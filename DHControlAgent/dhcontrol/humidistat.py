@@ -0,0 +1,47 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Humidistat decisions for the dehumidifier control agent's 'auto' mode.                                 #
+# The dehumidifier (compressor and fan) is turned on when the filtered humidity rises to                 #
+# setpoint + hysteresis and turned off when it falls to setpoint - hysteresis. In between, it stays as   #
+# it is, so small swings around the setpoint do not cycle the compressor.                                #
+# min_on/min_off (seconds) protect the compressor from short cycling: a decision that would turn it off  #
+# (or back on) too soon after the last transition is deferred until a later sample.                      #
+# ------------------------------------------------------------------------------------------------------ #
+
+# Default humidistat settings. Anything under "humidistat" in the agent config overrides these.
+HUMIDISTAT_DEFAULTS = {
+    'setpoint': 50.0,       # %RH
+    'hysteresis': 5.0,      # %RH either side of the setpoint
+    'min_on': 300.0,        # seconds the compressor must run before it can be turned off
+    'min_off': 300.0,       # seconds the compressor must rest before it can be turned on again
+}
+
+
+class Humidistat(object):
+    """ Decides whether the dehumidifier should run, given the latest filtered humidity. """
+
+    def __init__(self, config):
+        self.setpoint = float(config['setpoint'])
+        self.hysteresis = float(config['hysteresis'])
+        self.min_on = float(config['min_on'])
+        self.min_off = float(config['min_off'])
+        if self.hysteresis < 0:
+            raise ValueError('Humidistat hysteresis must not be negative')
+        # True while the last decision was held back by min_on/min_off.
+        self.deferred = False
+
+    def decide(self, humidity, running, last_change, now):
+        """ Return 'run dehum', 'shed dehum' or None (no change).
+
+            running is whether the dehumidifier is on, last_change the time it was last turned on or
+            off (None if never). """
+        self.deferred = False
+        if not running and humidity >= self.setpoint + self.hysteresis:
+            command, hold = 'run dehum', self.min_off
+        elif running and humidity <= self.setpoint - self.hysteresis:
+            command, hold = 'shed dehum', self.min_on
+        else:
+            return None
+        if last_change is not None and now - last_change < hold:
+            self.deferred = True
+            return None
+        return command
@@ -0,0 +1,110 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Humidity/temperature acquisition for the dehumidifier control agent.                                   #
+# A source returns one (humidity, temperature) reading each time it is read:                             #
+#   - ADCSource reads the BeagleBone's analog inputs with bbio analogRead (millivolts) and scales them.   #
+#   - FileSource reads a small text file holding "humidity temperature", so tests and bench setups can   #
+#     stand in for the sensor by writing that file.                                                      #
+# Readings are stored with their timestamp in a fixed-size RingBuffer, oldest first.                     #
+# ------------------------------------------------------------------------------------------------------ #
+
+# Default sensor settings. Anything under "sensor" in the agent config overrides these.
+SENSOR_DEFAULTS = {
+    'enabled': False,
+    'source': 'adc',            # 'adc' or 'file'
+    'interval': 0.5,            # seconds between samples
+    'buffer_size': 120,         # samples kept in the ring buffer
+    'block_size': 10,           # samples filtered together; the filtered value is published once per block
+    'filters': {},              # filter settings, see filters.FILTER_DEFAULTS
+    'humidity_pin': 'AIN0',     # P9.39 on BeagleBone
+    'temperature_pin': 'AIN1',  # P9.40 on BeagleBone
+    # Linear conversion from millivolts: value = slope * mV + offset
+    'humidity_slope': 0.0555,   # 0-1800 mV -> 0-100 %RH
+    'humidity_offset': 0.0,
+    'temperature_slope': 0.1,   # TMP36: (mV - 500) / 10 degrees C
+    'temperature_offset': -50.0,
+    'file': '/tmp/dhcontrol_sensor',
+}
+
+
+class ADCSource(object):
+    """ Reads humidity and temperature from the BeagleBone's analog inputs. """
+
+    def __init__(self, config):
+        import bbio     # For BeagleBone
+        self.analogRead = bbio.analogRead
+        self.humidity_pin = getattr(bbio, config['humidity_pin'])
+        self.temperature_pin = getattr(bbio, config['temperature_pin']) if config['temperature_pin'] else None
+        self.config = config
+
+    def read(self):
+        config = self.config
+        humidity = config['humidity_slope'] * self.analogRead(self.humidity_pin) + config['humidity_offset']
+        temperature = None
+        if self.temperature_pin is not None:
+            temperature = (config['temperature_slope'] * self.analogRead(self.temperature_pin) +
+                           config['temperature_offset'])
+        return humidity, temperature
+
+
+class FileSource(object):
+    """ Reads "humidity [temperature]" from the first line of a file. """
+
+    def __init__(self, config):
+        self.path = config['file']
+
+    def read(self):
+        with open(self.path) as sensor_file:
+            values = sensor_file.readline().split()
+        humidity = float(values[0])
+        temperature = float(values[1]) if len(values) > 1 else None
+        return humidity, temperature
+
+
+SOURCES = {'adc': ADCSource, 'file': FileSource}
+
+
+def make_source(config):
+    """ Create the source named by config['source']. Raises ValueError for an unknown source. """
+    try:
+        source = SOURCES[config['source']]
+    except KeyError:
+        raise ValueError("Unknown sensor source {!r}. Valid sources are {}".format(
+            config['source'], sorted(SOURCES)))
+    return source(config)
+
+
+class RingBuffer(object):
+    """ Fixed-size buffer of (timestamp, humidity, temperature) samples. The oldest sample is overwritten. """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('Ring buffer size must be at least 1')
+        self.size = size
+        self._samples = [None] * size
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, humidity, temperature):
+        self._samples[self._next] = (timestamp, humidity, temperature)
+        self._next = (self._next + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def latest(self, n=None):
+        """ Return the newest n samples (all of them if n is None), oldest first. """
+        if n is None or n > self._count:
+            n = self._count
+        start = (self._next - n) % self.size
+        if start + n <= self.size:
+            return self._samples[start:start + n]
+        return self._samples[start:] + self._samples[:(start + n) % self.size]
+
+    def last(self):
+        """ Return the newest sample, or None if the buffer is empty. """
+        if not self._count:
+            return None
+        return self._samples[self._next - 1]
+
@@ -0,0 +1,186 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Time-of-use planning for the dehumidifier control agent's 'schedule' mode.                             #
+# The planning horizon (the next horizon_hours) is split into slots of slot_minutes. Each slot has a     #
+# tariff price, and the dehumidifier either runs for the whole slot or not at all. Humidity is predicted #
+# with a simple linear model: it falls by dry_rate %RH/hour while the dehumidifier runs and rises by     #
+# rise_rate %RH/hour while it is off.                                                                    #
+# The plan keeps the predicted humidity at or below humidity_ceiling as cheaply as possible: walking     #
+# forward through the slots, whenever the prediction goes over the ceiling the cheapest slot not yet     #
+# used (up to that point) is switched on. Any slot before the violation lowers it by the same amount,   #
+# so picking the cheapest one (a heap of candidates) gives the lowest-cost plan for this model.          #
+# The plan is updated incrementally: when a new humidity reading differs from the prediction by more     #
+# than replan_tolerance, or the ceiling changes, the remaining predictions are shifted by the difference #
+# and only the slots needed to fix the new violations (or no longer needed) are changed.                 #
+# ------------------------------------------------------------------------------------------------------ #
+import heapq
+import time
+
+
+# Default schedule settings. Anything under "schedule" in the agent config overrides these.
+SCHEDULE_DEFAULTS = {
+    'humidity_ceiling': 60.0,   # %RH the room must stay at or below
+    'horizon_hours': 24,
+    'slot_minutes': 30,
+    'dry_rate': 4.0,            # %RH per hour the humidity falls while the dehumidifier runs
+    'rise_rate': 1.0,           # %RH per hour the humidity rises while it is off
+    'replan_tolerance': 2.0,    # %RH difference from the prediction that triggers a plan update
+    # Tariff: price per kWh for each period of the day (local time). Periods may wrap past midnight.
+    # "days" (0 = Monday) limits a period to certain days. Times not covered cost default_price.
+    'tariff': [],
+    'default_price': 0.10,
+    'power_kw': 0.6,            # power drawn by the dehumidifier, for the plan's cost estimate
+}
+
+
+def _minutes(text):
+    hours, minutes = text.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class Tariff(object):
+    """ Price per kWh at any time, from a table of daily periods. """
+
+    def __init__(self, periods, default_price):
+        self.default_price = float(default_price)
+        self.periods = []
+        for period in periods:
+            days = period.get('days')
+            self.periods.append((_minutes(period['start']), _minutes(period['end']),
+                                 float(period['price']), set(days) if days is not None else None))
+
+    def price(self, timestamp):
+        local = time.localtime(timestamp)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, price, days in self.periods:
+            if start <= end:
+                inside, day = start <= minute < end, local.tm_wday
+            elif minute >= start:
+                inside, day = True, local.tm_wday
+            else:
+                # Early-morning part of a period that started the previous day.
+                inside, day = minute < end, (local.tm_wday - 1) % 7
+            if inside and (days is None or day in days):
+                return price
+        return self.default_price
+
+
+class Planner(object):
+    """ Plans which slots the dehumidifier runs in, and keeps the plan up to date. """
+
+    def __init__(self, config):
+        self.ceiling = float(config['humidity_ceiling'])
+        self.slot = float(config['slot_minutes']) * 60.0
+        self.slots = int(float(config['horizon_hours']) * 3600.0 / self.slot)
+        self.dry = float(config['dry_rate']) * self.slot / 3600.0       # %RH per slot
+        self.rise = float(config['rise_rate']) * self.slot / 3600.0     # %RH per slot
+        self.tolerance = float(config['replan_tolerance'])
+        self.tariff = Tariff(config['tariff'], config['default_price'])
+        if self.slots < 1:
+            raise ValueError('The schedule horizon must be at least one slot long')
+        self.start = None
+        self.running = []       # running[k] is True if the dehumidifier runs in slot k
+        self.predicted = []     # predicted[k] is the humidity at the end of slot k
+        self.prices = []
+        self.infeasible = False
+
+    def slot_start(self, k):
+        return self.start + k * self.slot
+
+    def slot_at(self, timestamp):
+        return int((timestamp - self.start) // self.slot)
+
+    def plan(self, now, humidity):
+        """ Make a new plan for the horizon starting with the slot that contains now. """
+        self.start = now - now % self.slot
+        self.prices = [self.tariff.price(self.slot_start(k)) for k in range(self.slots)]
+        self.running = [False] * self.slots
+        self.predicted = []
+        level = humidity
+        for k in range(self.slots):
+            level += self.rise
+            self.predicted.append(level)
+        self._add_slots(0)
+
+    def predicted_at(self, timestamp):
+        """ Predicted humidity at timestamp (linear within a slot). """
+        k = self.slot_at(timestamp)
+        before = self.predicted[k - 1] if k > 0 else self.predicted[0] - self._change(0)
+        fraction = (timestamp - self.slot_start(k)) / self.slot
+        return before + fraction * (self.predicted[k] - before)
+
+    def update(self, now, humidity, ceiling=None):
+        """ Bring the plan up to date with a humidity reading (and optionally a new ceiling).
+
+            Returns True if the plan changed. Makes a new plan when the horizon is half used up. """
+        if self.start is None or self.slot_at(now) >= self.slots // 2:
+            if ceiling is not None:
+                self.ceiling = float(ceiling)
+            self.plan(now, humidity)
+            return True
+        k = self.slot_at(now)
+        error = humidity - self.predicted_at(now)
+        ceiling_change = 0.0 if ceiling is None else float(ceiling) - self.ceiling
+        if abs(error) <= self.tolerance and ceiling_change == 0.0:
+            return False
+        if ceiling is not None:
+            self.ceiling = float(ceiling)
+        for m in range(k, self.slots):
+            self.predicted[m] += error
+        before = list(self.running)
+        self._add_slots(k)
+        self._remove_slots(k)
+        return self.running != before
+
+    def _change(self, k):
+        return -self.dry if self.running[k] else self.rise
+
+    def _set(self, k, running):
+        """ Switch slot k on or off and shift the predictions from slot k onwards. """
+        step = self.dry + self.rise
+        self.running[k] = running
+        shift = -step if running else step
+        for m in range(k, self.slots):
+            self.predicted[m] += shift
+
+    def _add_slots(self, first):
+        """ Switch on the cheapest slots needed to keep slots first.. at or below the ceiling. """
+        candidates = []
+        self.infeasible = False
+        for k in range(first, self.slots):
+            if not self.running[k]:
+                heapq.heappush(candidates, (self.prices[k], k))
+            while self.predicted[k] > self.ceiling:
+                if not candidates:
+                    # Even running in every slot so far can't keep the humidity under the ceiling.
+                    self.infeasible = True
+                    break
+                price, chosen = heapq.heappop(candidates)
+                self._set(chosen, True)
+
+    def _remove_slots(self, first):
+        """ Switch off the most expensive slots from first onwards that are no longer needed. """
+        step = self.dry + self.rise
+        chosen = sorted((k for k in range(first, self.slots) if self.running[k]),
+                        key=lambda k: -self.prices[k])
+        for k in chosen:
+            if max(self.predicted[k:]) + step <= self.ceiling:
+                self._set(k, False)
+
+    def windows(self, now=None):
+        """ Run windows as (start, end) times, merged from consecutive running slots. """
+        result = []
+        for k in range(self.slots):
+            if self.running[k]:
+                start, end = self.slot_start(k), self.slot_start(k + 1)
+                if result and result[-1][1] == start:
+                    result[-1] = (result[-1][0], end)
+                else:
+                    result.append((start, end))
+        if now is not None:
+            result = [(max(start, now), end) for start, end in result if end > now]
+        return result
+
+    def cost(self, power_kw):
+        """ Energy cost of the plan for a dehumidifier drawing power_kw. """
+        hours = self.slot / 3600.0
+        return sum(price * power_kw * hours for price, running in zip(self.prices, self.running) if running)
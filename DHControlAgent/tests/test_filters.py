@@ -0,0 +1,93 @@
+import os
+import random
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dhcontrol import filters
+
+
+def make_stream(samples=200, seed=3):
+    """ About 50 %RH with noise and a few spikes, one sample every 0.5 seconds. """
+    rng = random.Random(seed)
+    values = []
+    for i in range(samples):
+        value = 50.0 + rng.gauss(0.0, 0.8)
+        if i % 37 == 5:
+            value += 30.0
+        values.append(value)
+    return [i * 0.5 for i in range(samples)], values
+
+
+def scalar_results(timestamps, values):
+    return filters.ScalarFilter(dict(filters.FILTER_DEFAULTS)).process(timestamps, values)
+
+
+@pytest.mark.skipif(not filters.load_numpy(), reason='NumPy is not installed')
+def test_block_filter_mixes_blocks_and_single_samples():
+    timestamps, values = make_stream()
+    expected_filtered, expected_rates = scalar_results(timestamps, values)
+    block_filter = filters.BlockFilter(dict(filters.FILTER_DEFAULTS))
+    filtered = []
+    rates = []
+    first = 0
+    sizes = [1, 10, 1, 1, 7, 1, 25]
+    while first < len(values):
+        size = sizes[0]
+        sizes = sizes[1:] + sizes[:1]
+        if size == 1:
+            value, rate = block_filter.update(timestamps[first], values[first])
+            filtered.append(value)
+            rates.append(rate)
+        else:
+            block_filtered, block_rates = block_filter.process(timestamps[first:first + size],
+                                                               values[first:first + size])
+            filtered.extend(map(float, block_filtered))
+            rates.extend(map(float, block_rates))
+        first += size
+    assert filtered == expected_filtered
+    assert rates == expected_rates
+    assert 48 < filtered[-1] < 52
+
+
+@pytest.mark.skipif(not filters.load_numpy(), reason='NumPy is not installed')
+def test_block_filter_starts_with_a_single_sample():
+    timestamps, values = make_stream(20)
+    expected_filtered, expected_rates = scalar_results(timestamps, values)
+    block_filter = filters.BlockFilter(dict(filters.FILTER_DEFAULTS))
+    value, rate = block_filter.update(timestamps[0], values[0])
+    filtered, rates = block_filter.process(timestamps[1:], values[1:])
+    assert [value] + list(map(float, filtered)) == expected_filtered
+    assert [rate] + list(map(float, rates)) == expected_rates
+
+
+def test_make_filter_is_scalar_below_the_block_threshold(monkeypatch):
+    def no_numpy():
+        raise AssertionError('NumPy was loaded for a block smaller than BLOCK_FILTER_MIN_SIZE')
+    monkeypatch.setattr(filters, 'load_numpy', no_numpy)
+    for block_size in (1, 10, filters.BLOCK_FILTER_MIN_SIZE - 1):
+        assert type(filters.make_filter({}, block_size)) is filters.ScalarFilter
+    assert type(filters.make_filter({})) is filters.ScalarFilter
+
+
+@pytest.mark.skipif(not filters.load_numpy(), reason='NumPy is not installed')
+def test_make_filter_is_block_from_the_block_threshold():
+    assert type(filters.make_filter({}, filters.BLOCK_FILTER_MIN_SIZE)) is filters.BlockFilter
+    assert type(filters.make_filter({}, 1000)) is filters.BlockFilter
+
+
+@pytest.mark.skipif(not filters.load_numpy(), reason='NumPy is not installed')
+def test_block_filter_is_not_faster_below_the_block_threshold():
+    timestamps, values = make_stream(20000)
+
+    def seconds(filter_class, block_size):
+        stream_filter = filter_class(dict(filters.FILTER_DEFAULTS))
+        start = time.time()
+        for first in range(0, len(values), block_size):
+            stream_filter.process(timestamps[first:first + block_size], values[first:first + block_size])
+        return time.time() - start
+
+    # The shipped block_size (10) is well below the crossover; the scalar filter must win there clearly.
+    assert seconds(filters.BlockFilter, 10) > seconds(filters.ScalarFilter, 10)
@@ -0,0 +1,104 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# This agent keeps a snapshot of the whole fleet (see bbcommon/fleet.py):                                 #
+#   - it watches 'fleet/unit/<unit>/...', where each board's heartbeat, status and metrics topics arrive, #
+#     and updates the unit's record and the indexes with the fields that changed;                        #
+#   - on a timer it marks silent units offline and drops units silent for much longer, and publishes     #
+#     how many units have each value of each indexed field on 'fleet/summary';                           #
+#   - on 'fleet/query' it answers on the requester's reply topic, from the indexes.                      #
+# ------------------------------------------------------------------------------------------------------ #
+
+
+# --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
+# more import statements may be needed for other agents, but these work for this agent
+import logging
+import sys
+import time
+
+from zmq.utils import jsonapi
+from volttron.platform.agent import BaseAgent, PublishMixin
+from volttron.platform.agent import utils, matching
+
+from bbcommon.fleet import FLEET_PREFIX, FLEET_QUERY, FLEET_REPLY, FLEET_SUMMARY, FleetIndex, translate
+
+_log = logging.getLogger(__name__)
+# --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
+
+
+# Create a class with the convention: NameAgent
+# and always include "PublishMixin, BaseAgent" as its arguments.
+class FleetAgent(PublishMixin, BaseAgent):
+    """ Keeps an indexed snapshot of every unit in the fleet and answers queries on it. """
+
+    # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
+    def __init__(self, config_path, **kwargs):
+        super(FleetAgent, self).__init__(**kwargs)
+        self.config = utils.load_config(config_path)
+        self.fleet = FleetIndex(self.config.get('fleet', {}))
+
+    def setup(self):
+        # Demonstrate accessing a value from the config file
+        _log.info(self.config['message'])
+        self._agent_id = self.config['agentid']
+        super(FleetAgent, self).setup()
+        self.periodic_timer(float(self.fleet.config['sweep_interval']), self.sweep)
+        if float(self.fleet.config['summary_interval']) > 0:
+            self.periodic_timer(float(self.fleet.config['summary_interval']), self.publish_summary)
+    # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
+
+    @matching.match_start(FLEET_PREFIX)
+    def observe(self, topic, headers, message, match):
+        """A message from one of the fleet's units: fleet/unit/<unit>/<topic>."""
+        unit, _, source = topic[len(FLEET_PREFIX):].partition('/')
+        if not unit:
+            return
+        try:
+            value = jsonapi.loads(message[0])
+        except (ValueError, IndexError):
+            value = None
+        self.fleet.update(unit, translate(source, value), time.time())
+
+    def sweep(self):
+        marked, dropped = self.fleet.sweep(time.time())
+        if marked or dropped:
+            _log.info("{} unit(s) went offline and {} silent unit(s) were dropped; {} units.".format(
+                marked, dropped, len(self.fleet)))
+
+    def publish_summary(self):
+        self.publish_json(FLEET_SUMMARY, {}, self.fleet.summary())
+
+    @matching.match_exact(FLEET_QUERY)
+    def on_query(self, topic, headers, message, match):
+        """A query on the fleet snapshot."""
+        request = jsonapi.loads(message[0])
+        reply_to = request.get('reply_to', '')
+        if not reply_to.startswith(FLEET_REPLY):
+            _log.warning("Fleet query without a reply topic under {}: {}".format(FLEET_REPLY, request))
+            return
+        if request.get('summary'):
+            self.publish_json(reply_to, {}, self.fleet.summary())
+            return
+        try:
+            reply = self.fleet.query(request.get('where'), request.get('top'), request.get('limit'))
+        except (ValueError, TypeError) as error:
+            reply = {'error': str(error)}
+        self.publish_json(reply_to, {}, reply)
+
+
+# --------------------------------------- ALWAYS INCLUDE --------------------------------------- #
+# Include this section in every agent, but adjust the agent name and description.
+def main(argv=sys.argv):
+    '''Main method called by the eggsecutable.'''
+    # Enable information and debug logging
+    utils.setup_logging()
+    utils.default_main(FleetAgent,
+                   description='Keep an indexed snapshot of the fleet',
+                   argv=argv)
+
+
+if __name__ == '__main__':
+    # Entry point for script
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
+# --------------------------------------- ALWAYS INCLUDE --------------------------------------- #
@@ -0,0 +1,224 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# This agent runs several other agents (DehumAgent, LEDAgent, an input agent, ...) inside one process,  #
+# so they share one Python interpreter, one copy of VOLTTRON and zmq, and one bus connection.            #
+# The agents to host are listed in the config file by class and config path:                             #
+#     "agents": [{"class": "dhcontrol.agent.DehumAgent", "config": "../DHControlAgent/config"}, ...]    #
+# Relative config paths are relative to this agent's config file.                                        #
+# Each hosted agent is an instance of its usual class, with the bus-facing parts (subscribing,           #
+# publishing, timers, the reactor) handed to this agent:                                                 #
+#   - The host subscribes to every topic and passes each message to the hosted handlers whose            #
+#     matching decorator (match_start, match_exact, ...) matches the topic.                              #
+#   - When a hosted agent publishes, its message frames are handed straight to the co-hosted handlers,   #
+#     without going out to the message bus and back, and are published once on the bus for everyone      #
+#     else. The copy that comes back from the bus is recognised by a header and dropped.                 #
+#   - Messages are delivered in the order they were published, one at a time, as on the bus.            #
+# Hosted agents may not share a GPIO pin (in their 'pins' and 'pwm' maps): the host refuses to start     #
+# if two of them do, since each would switch the other's outputs (an LED command turning a relay on).    #
+# At start-up the host logs its resident memory and publishes it on host/status.                         #
+# ------------------------------------------------------------------------------------------------------ #
+
+
+# --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
+# more import statements may be needed for other agents, but these work for this agent
+import importlib
+import logging
+import os
+import re
+import sys
+import uuid
+from collections import deque
+
+from zmq.utils import jsonapi
+from volttron.platform.agent import BaseAgent, PublishMixin
+from volttron.platform.agent import utils, matching
+
+_log = logging.getLogger(__name__)
+# --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
+
+
+# Header added to messages the host publishes for its hosted agents, so it can drop them when the bus
+# delivers them back (the hosted subscribers already have them).
+ORIGIN_HEADER = 'X-Host-Origin'
+# Attribute the wrapped matching decorators store each handler's topic tests in.
+HOST_TESTS = '_host_topic_tests'
+
+
+def _wrap_matching():
+    """ Make the matching decorators also record a topic test the host can run itself.
+
+        Must run before the hosted agents' modules are imported, since the decorators run at import. """
+    def tag(func, test):
+        setattr(func, HOST_TESTS, getattr(func, HOST_TESTS, ()) + (test,))
+        return func
+
+    def wrap(decorator, make_test):
+        def tagged(argument):
+            def decorate(func):
+                return tag(decorator(argument)(func), make_test(argument))
+            return decorate
+        return tagged
+
+    if getattr(matching, '_host_wrapped', False):
+        return
+    match_all = matching.match_all
+    matching.match_start = wrap(matching.match_start,
+                                lambda prefix: lambda topic: topic if topic.startswith(prefix) else None)
+    matching.match_exact = wrap(matching.match_exact, lambda name: lambda topic: topic if topic == name else None)
+    matching.match_regex = wrap(matching.match_regex, lambda pattern: re.compile(pattern).match)
+    matching.match_all = lambda func: tag(match_all(func), lambda topic: topic)
+    matching._host_wrapped = True
+
+
+def resident_memory():
+    """ Resident memory of this process in kB, or None where /proc isn't available. """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+class Hosted(PublishMixin, BaseAgent):
+    """ Mixed into each hosted agent's class: sends its bus traffic and timers through the host. """
+
+    def __init__(self, host=None, **kwargs):
+        # BaseAgent/PublishMixin are not initialized: the hosted agent has no sockets of its own.
+        self.host = host
+        self.reactor = host.reactor
+
+    def setup(self):
+        self.host.subscribe_hosted(self)
+
+    def publish(self, topic, headers, *message):
+        self.host.forward(topic, headers, list(message))
+
+    def publish_json(self, topic, headers, *message):
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/json'
+        self.host.forward(topic, headers, [jsonapi.dumps(part) for part in message])
+
+    def timer(self, interval, function, *args, **kwargs):
+        return self.host.timer(interval, function, *args, **kwargs)
+
+    def periodic_timer(self, period, function, *args, **kwargs):
+        return self.host.periodic_timer(period, function, *args, **kwargs)
+
+
+# Create a class with the convention: NameAgent
+# and always include "PublishMixin, BaseAgent" as its arguments.
+class HostAgent(PublishMixin, BaseAgent):
+    """ Runs the agents listed in its config in this process, sharing its bus connection. """
+
+    # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
+    def __init__(self, config_path, **kwargs):
+        super(HostAgent, self).__init__(**kwargs)
+        self.config = utils.load_config(config_path)
+        self.origin = uuid.uuid4().hex
+        # (topic test, handler) for every hosted subscription, and the messages waiting to be delivered.
+        self.subscriptions = []
+        self.queue = deque()
+        self.delivering = False
+        _wrap_matching()
+        directory = os.path.dirname(os.path.abspath(config_path))
+        self.agents = []
+        for entry in self.config['agents']:
+            module_name, class_name = entry['class'].rsplit('.', 1)
+            cls = getattr(importlib.import_module(module_name), class_name)
+            hosted_class = type('Hosted' + class_name, (cls, Hosted), {})
+            agent_config = entry.get('config')
+            if agent_config is not None:
+                agent_config = os.path.join(directory, agent_config)
+            self.agents.append(hosted_class(agent_config, host=self))
+        self.check_pins()
+
+    def setup(self):
+        # Demonstrate accessing a value from the config file
+        _log.info(self.config['message'])
+        self._agent_id = self.config['agentid']
+        super(HostAgent, self).setup()
+        for agent in self.agents:
+            agent.setup()
+        names = [type(agent).__name__[len('Hosted'):] for agent in self.agents]
+        memory = resident_memory()
+        _log.info("Hosting {} ({} subscriptions); resident memory {} kB.".format(
+            ', '.join(names), len(self.subscriptions), memory))
+        self.publish_json('host/status', {}, {'agents': names, 'resident_kb': memory})
+    # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
+
+    def check_pins(self):
+        """ Raise ValueError if two hosted agents use the same GPIO pin. """
+        claimed = {}
+        for agent in self.agents:
+            name = type(agent).__name__[len('Hosted'):]
+            pins = set(getattr(agent, 'pins', {}).values()) | set(getattr(agent, 'pwm', {}).values())
+            for pin in sorted(pins):
+                if pin in claimed:
+                    raise ValueError("{} and {} both use the GPIO pin {}; they can't be hosted together".format(
+                        claimed[pin], name, pin))
+                claimed[pin] = name
+
+    def subscribe_hosted(self, agent):
+        """ Register every matching-decorated handler of a hosted agent. """
+        for name in dir(type(agent)):
+            for test in getattr(getattr(type(agent), name, None), HOST_TESTS, ()):
+                self.subscriptions.append((test, getattr(agent, name)))
+
+    def forward(self, topic, headers, message):
+        """ Publish for a hosted agent: to the co-hosted subscribers directly, and to the bus. """
+        self.queue.append((topic, headers, message, True))
+        self.deliver()
+
+    # Every message on the bus comes through here.
+    @matching.match_all
+    def route(self, topic, headers, message, match):
+        if headers.get(ORIGIN_HEADER) == self.origin:
+            # Published by a hosted agent; the hosted subscribers already have it.
+            return
+        self.queue.append((topic, headers, message, False))
+        self.deliver()
+
+    def deliver(self):
+        """ Deliver queued messages in order. A message published while delivering waits its turn. """
+        if self.delivering:
+            return
+        self.delivering = True
+        try:
+            while self.queue:
+                topic, headers, message, outgoing = self.queue.popleft()
+                if outgoing:
+                    bus_headers = dict(headers)
+                    bus_headers[ORIGIN_HEADER] = self.origin
+                    self.publish(topic, bus_headers, *message)
+                for test, handler in self.subscriptions:
+                    match = test(topic)
+                    if match:
+                        try:
+                            handler(topic, dict(headers), message, match)
+                        except Exception:
+                            # One hosted agent's error must not stop delivery to the others.
+                            _log.exception("Error in {} handling {}".format(handler, topic))
+        finally:
+            self.delivering = False
+
+
+# --------------------------------------- ALWAYS INCLUDE --------------------------------------- #
+# Include this section in every agent, but adjust the agent name and description.
+def main(argv=sys.argv):
+    '''Main method called by the eggsecutable.'''
+    # Enable information and debug logging
+    utils.setup_logging()
+    utils.default_main(HostAgent,
+                   description='Run several agents in one process',
+                   argv=argv)
+
+
+if __name__ == '__main__':
+    # Entry point for script
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
+# --------------------------------------- ALWAYS INCLUDE --------------------------------------- #
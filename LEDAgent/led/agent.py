@@ -7,7 +7,18 @@
 # Only messages under that topic name are read.                                                          #
 # The received message is assigned to a variable called command.                                         #
 # The command is then processed and the necessary action is performed.                                   #
-# Possible actions include turning on or off a green or red LED, using BeagleBone GPIO pins.             #
+# Possible actions include turning on or off a green or red LED, using BeagleBone GPIO pins, or running a #
+# blink code or brightness level on one ('green pattern degraded'; see patterns.py). An LED whose pin is  #
+# given a PWM pin under patterns.pwm is dimmed with PWM; others blink fully on and off.                   #
+# In health mode ('leds health', or health.enabled in the config) the LEDs show how the dehumidifier is   #
+# doing instead, from its status and heartbeat topics (see health.py), and the commands for each LED are  #
+# refused until 'leds manual' (or 'kill').                                                               #
+# The agent watches its config file (see bbcommon/configwatch.py). An edited config is checked and, if it #
+# is usable, switched to as a whole; otherwise the current config stays in use. Outputs are only written  #
+# on a reload when the pin map changes.                                                                  #
+# GPIO and PWM reads and writes run on a small pool of I/O threads (see bbcommon/iopool.py), so a hung   #
+# pin holds up the bus for at most io.timeout (20 ms). Pattern steps are queued without waiting; stalls  #
+# are published on 'LEDcontrol/io'.                                                                      #
 # ------------------------------------------------------------------------------------------------------ #
 
 
@@ -15,20 +26,73 @@
 # more import statements may be needed for other agents, but these work for this agent
 import logging
 import sys
+import time
 
 from zmq.utils import jsonapi
 from volttron.platform.agent import BaseAgent, PublishMixin
 from volttron.platform.agent import utils, matching
 #from volttron.platform.messaging import headers as headers_mod
 
-from bbio import *     # For BeagleBone
+from bbcommon.configwatch import ConfigWatcher, log_level
+from bbcommon.dispatch import CommandDispatcher, check_config as check_dispatch_config
+from bbcommon.heartbeat import Heartbeat, check_config as check_heartbeat_config
+from bbcommon.iopool import IOPool, IOStalled, check_config as check_io_config
+from bbcommon.lastvalue import CACHE_REPLY, request as request_cached
+from bbcommon.lazy import LazyModule
+from bbcommon.retry import RETRY_DEFAULTS, RetryEngine, check_config as check_retry_config
+from bbcommon.shadow import COMMAND_ID
+from bbcommon.statefile import StateFile
+from bbcommon.stateboard import StateBoard, board_path
+
+from led.health import HealthIndicator, check_config as check_health_config, shared_pins
+from led.patterns import PATTERN_DEFAULTS, PatternEngine, check_config as check_pattern_config
 
-# Enable information and debug logging
-utils.setup_logging()
 _log = logging.getLogger(__name__)
+
+# For BeagleBone. bbio probes the hardware when it is imported, so it is imported the first time a pin
+# is used (in setup(), after the agent has joined the bus) instead of here.
+bbio = LazyModule('bbio')
 # --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
 
 
+# GPIO pins, by their bbio names. Anything under "pins" in the config overrides these.
+PIN_DEFAULTS = {
+    'green': 'GPIO1_13',                # P8.11 on BeagleBone, output
+    'red': 'GPIO0_23',                  # P8.13 on BeagleBone, output (PWM2B)
+    'green_feedback': 'GPIO1_12',       # P8.12 on BeagleBone, input wired to P8.11
+    'red_feedback': 'GPIO0_26',         # P8.14 on BeagleBone, input wired to P8.13
+}
+
+
+def load_settings(config):
+    """ Check config and build the settings the agent takes from it. Raises ValueError (or KeyError, TypeError
+        for missing or mistyped values) before anything is used, so a bad config changes nothing. """
+    check_retry_config(config.get('retry', {}))
+    check_heartbeat_config(config.get('heartbeat', {}))
+    check_dispatch_config(config.get('dispatch', {}))
+    check_io_config(config.get('io', {}))
+    pattern_config = check_pattern_config(config.get('patterns', {}))
+    pwm = dict(pattern_config['pwm'])
+    pins = dict(PIN_DEFAULTS, **config.get('pins', {}))
+    if len(set(pins.values())) != len(pins):
+        raise ValueError('Each GPIO pin can only be used once: {}'.format(pins))
+    if not set(pwm) <= set(['green', 'red']) or len(set(pwm.values())) != len(pwm):
+        raise ValueError('PWM pins can only be given for the green and red LEDs, one each: {}'.format(pwm))
+    outputs = [pins['green'], pins['red']] + list(pwm.values())
+    check_health_config(config.get('health', {}), set(PATTERN_DEFAULTS) | set(pattern_config['patterns']), outputs)
+    # The names can only be checked once bbio is imported; at start-up setup_pins() checks them.
+    if bbio.loaded:
+        unknown = sorted(name for name in list(pins.values()) + list(pwm.values()) if not hasattr(bbio, name))
+        if unknown:
+            raise ValueError('Unknown GPIO pin(s) {}'.format(', '.join(unknown)))
+    return {'pins': pins,
+            'pwm': pwm,
+            'relay_pins': shared_pins(config.get('health', {}), outputs),
+            'log_level': log_level(config.get('log_level')),
+            'state_file': config.get('state_file', 'led.state'),
+            'state_board': dict({'enabled': True, 'path': 'led.board'}, **config.get('state_board', {}))}
+
+
 # Create a class with the convention: NameAgent
 # and always include "PublishMixin, BaseAgent" as its arguments.
 class LEDAgent(PublishMixin, BaseAgent):
@@ -38,72 +102,400 @@ class LEDAgent(PublishMixin, BaseAgent):
     def __init__(self, config_path, **kwargs):
         super(LEDAgent, self).__init__(**kwargs)
         self.config = utils.load_config(config_path)
-        # Assign address of GPIO to variable
-        self.portGreenLED_Write = GPIO1_28      # P9.12 on BeagleBone
-        self.portRedLED_Write = GPIO1_18        # P9.14 on BeagleBone
-        self.portGreenLED_Read = GPIO1_16       # P9.15 on BeagleBone
-        self.portRedLED_Read = GPIO1_19         # P9.16 on BeagleBone
-        # Initialize GPIO pins to be either output or input
-        pinMode(self.portGreenLED_Write, OUTPUT)     # P9.12 on BeagleBone is output
-        pinMode(self.portRedLED_Write, OUTPUT)       # P9.14 on BeagleBone is output
-        pinMode(self.portGreenLED_Read, INPUT)       # P9.15 on BeagleBone is input
-        pinMode(self.portRedLED_Read, INPUT)         # P9.16 on BeagleBone is input
-        # Initialize GPIO output pins to be off (low)
-        digitalWrite(self.portGreenLED_Write, LOW)
-        digitalWrite(self.portRedLED_Write, LOW)
+        settings = load_settings(self.config)
+        _log.setLevel(settings['log_level'])
         # Initialize flags to be false.
         self.GreenOn = False
         self.RedOn = False
+        # GPIO pin names; the pins themselves are set up in setup_pins().
+        self.pins = settings['pins']
+        # Pin I/O runs on worker threads, in order per pin, with a timeout (see bbcommon/iopool.py).
+        self.io = IOPool(self, 'LEDcontrol', self.config.get('io', {}), self.io_recovered)
+        # Blink codes and brightness levels, all stepped from one timer queue (see patterns.py). An LED with a
+        # PWM pin is switched over to it while a pattern runs (pwmActive), and back to GPIO afterwards.
+        self.patterns = PatternEngine(self, self.write_led, self.config.get('patterns', {}))
+        self.pwm = settings['pwm']
+        self.pwmActive = set()
+        # Health mode: the LEDs show the unit's health (see health.py). reconcile() decides whether to start in it.
+        self.health = HealthIndicator(self, self.show_health, self.config.get('health', {}),
+                                      self.patterns.patterns)
+        self.healthMode = False
+        # LED pins that are also the dehumidifier's: health mode stays off while there are any.
+        self.relayPins = settings['relay_pins']
+        # Writes that don't read back as expected are retried with backoff (see bbcommon/retry.py).
+        self.retries = RetryEngine(self, 'LEDcontrol', self.config.get('retry', {}))
+        # 'kill' skips ahead of routine commands and drops both LEDs first (see bbcommon/dispatch.py).
+        self.dispatcher = CommandDispatcher(self, 'LEDcontrol', self.perform_command, self.stop_outputs,
+                                            self.config.get('dispatch', {}))
+        # The desired LED states, saved on every change so a restart can resume them.
+        self.state_file = StateFile(settings['state_file'])
+        # The LED states in shared memory, for the input agents on this machine to read
+        # (see bbcommon/stateboard.py), with the id of the last command handled.
+        self.board = StateBoard(settings['state_board']['path']) if settings['state_board']['enabled'] else None
+        self.lastCommandId = None
+        # Heartbeat: a full snapshot of the pins and flags now and then, and deltas when they change.
+        self.heartbeat = Heartbeat(self, 'LEDcontrol/heartbeat', self.snapshot, self.config.get('heartbeat', {}))
+        # Edits to the config file are picked up without a restart (see reload_config()).
+        self.config_watch = ConfigWatcher(self, config_path, self.reload_config, self.config.get('config_watch', {}))
 
     def setup(self):
         # Demonstrate accessing a value from the config file
         _log.info(self.config['message'])
         self._agent_id = self.config['agentid']
         super(LEDAgent, self).setup()
+        self.io.start()
+        self.setup_pins()
+        self.reconcile()
+        if self.healthMode:
+            self.health.start()
+        self.heartbeat.start()
+        self.config_watch.start()
+        # In case a command was sent while this agent was down (see cache_reply()).
+        request_cached(self, self._agent_id, ['userinput/state'])
     # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
 
+    def setup_pins(self, previous=None):
+        """ Set up the GPIO pins named in the config. The first call imports bbio.
+            previous is the pin map before a reload: pins that haven't moved are left alone, since setting a
+            pin's mode again can reset its level. """
+        # Assign address of GPIO to variable (by default P9.12, P9.14, P9.15 and P9.16 on BeagleBone)
+        self.portGreenLED_Write = getattr(bbio, self.pins['green'])
+        self.portRedLED_Write = getattr(bbio, self.pins['red'])
+        self.portGreenLED_Read = getattr(bbio, self.pins['green_feedback'])
+        self.portRedLED_Read = getattr(bbio, self.pins['red_feedback'])
+        # Initialize GPIO pins to be either output or input
+        for name, port, mode in (('green', self.portGreenLED_Write, bbio.OUTPUT),
+                                 ('red', self.portRedLED_Write, bbio.OUTPUT),
+                                 ('green_feedback', self.portGreenLED_Read, bbio.INPUT),
+                                 ('red_feedback', self.portRedLED_Read, bbio.INPUT)):
+            if previous is None or previous[name] != self.pins[name]:
+                try:
+                    self.io.call(port, bbio.pinMode, port, mode)
+                except IOStalled:
+                    _log.error("Setting up the {} pin stalled; it will read back wrong until it is done.".format(name))
+        # The output levels are left alone here; reconcile() decides what they should be.
+
+    def write_pin(self, port, level):
+        """ Write an output pin on the I/O pool. A write that stalls is left for the read-back to catch. """
+        try:
+            self.io.call(port, bbio.digitalWrite, port, level)
+        except IOStalled:
+            pass
+
+    def read_pin(self, port):
+        """ Read a feedback pin on the I/O pool. Returns None if the read stalled. """
+        try:
+            return self.io.call(port, bbio.digitalRead, port)
+        except IOStalled:
+            return None
+
+    def io_recovered(self, port):
+        """ Called by the I/O pool when a stalled operation on port has ended. A write given up on may have
+            changed the LED since, so it is set back to the state last verified, unless a retry is waiting to
+            set it or a pattern is running on it (its next step writes it anyway). """
+        for led, output, on in (('green', self.portGreenLED_Write, self.GreenOn),
+                                ('red', self.portRedLED_Write, self.RedOn)):
+            component = '{} LED'.format(led)
+            if port == output and component not in self.retries.timers and led not in self.patterns.running:
+                level = bbio.HIGH if on else bbio.LOW
+                self.write_pin(output, level)
+                self.check_output(component, level)
+        self.heartbeat.check()
+
+    def reconcile(self):
+        """ Match the LEDs to the saved state, leaving alone any LED that is already right. """
+        saved = self.state_file.load()
+        self.healthMode = self.health.config['enabled'] is True
+        if saved is None:
+            # Nothing to resume (first start): initialize GPIO output pins to be off (low)
+            _log.info("No saved state in {}; starting with the LEDs off.".format(self.state_file.path))
+            self.write_pin(self.portGreenLED_Write, bbio.LOW)
+            self.write_pin(self.portRedLED_Write, bbio.LOW)
+            self.save_state()
+            return
+        # Start from what the feedback pins say is really on.
+        self.GreenOn = self.read_pin(self.portGreenLED_Read) == bbio.HIGH
+        self.RedOn = self.read_pin(self.portRedLED_Read) == bbio.HIGH
+        green = saved.get('GreenOn', False) is True
+        red = saved.get('RedOn', False) is True
+        # An LED that was running a pattern goes back to it below, whatever it reads now (it was blinking).
+        patterns = dict((led, name) for led, name in saved.get('patterns', {}).items()
+                        if led in ('green', 'red') and name in self.patterns.patterns)
+        if 'green' in patterns:
+            self.GreenOn = green = False
+        if 'red' in patterns:
+            self.RedOn = red = False
+        if (self.GreenOn, self.RedOn) == (green, red):
+            _log.info("Resumed the saved state (green on: {}, red on: {}) without changing the outputs.".format(
+                green, red))
+        else:
+            _log.warning("The LEDs don't match the saved state: green {} (saved {}), red {} (saved {}).".format(
+                self.GreenOn, green, self.RedOn, red))
+            if green is True and self.GreenOn is False:
+                self.green_on()
+            elif green is False and self.GreenOn is True:
+                self.green_off()
+            if red is True and self.RedOn is False:
+                self.red_on()
+            elif red is False and self.RedOn is True:
+                self.red_off()
+        for led, name in sorted(patterns.items()):
+            _log.info("Resuming the {} pattern on the {} LED.".format(name, led))
+            self.patterns.start(led, name)
+        self.healthMode = saved.get('health', self.healthMode) is True and not self.relayPins
+        self.save_state()
+
+    def reload_config(self, path):
+        """ Called by the config watcher when the config file has changed. The new config is checked in full
+            first; if anything in it is wrong, the current config stays in use. """
+        try:
+            config = utils.load_config(path)
+            settings = load_settings(config)
+        except (IOError, ValueError, KeyError, TypeError, AttributeError) as error:
+            _log.error("The changed config in {} can't be used ({}); keeping the current config.".format(path, error))
+            self.publish_json('LEDcontrol/status', {}, ('FAILED', 'config', 'RELOAD'))
+            return
+
+        # Everything checked out: switch to the new settings in one go.
+        self.config = config
+        self._agent_id = config['agentid']
+        _log.setLevel(settings['log_level'])
+        rewrite = settings['pins'] != self.pins or settings['pwm'] != self.pwm
+        if rewrite:
+            # Running patterns start again on the new pins, from GPIO.
+            for led in list(self.pwmActive):
+                self.release_led(led)
+            self.pwm = settings['pwm']
+        if settings['pins'] != self.pins:
+            self.move_pins(settings['pins'])
+        for led in self.patterns.reconfigure(config.get('patterns', {}), rewrite):
+            _log.warning("The pattern on the {} LED is no longer in the config; turning the LED off.".format(led))
+            self.end_pattern(led)
+        self.relayPins = settings['relay_pins']
+        if self.relayPins and self.healthMode:
+            self.set_health_mode(False)
+        enabled = self.health.config['enabled']
+        self.health.reconfigure(config.get('health', {}), self.patterns.patterns)
+        if self.health.config['enabled'] != enabled:
+            # health.enabled was edited: switch to the mode it now gives.
+            self.set_health_mode(self.health.config['enabled'] is True)
+        self.retries.config = dict(RETRY_DEFAULTS, **config.get('retry', {}))
+        self.heartbeat.reconfigure(config.get('heartbeat', {}))
+        self.dispatcher.reconfigure(config.get('dispatch', {}))
+        self.io.reconfigure(config.get('io', {}))
+        if settings['state_file'] != self.state_file.path:
+            self.state_file = StateFile(settings['state_file'])
+            self.save_state()
+        board = settings['state_board']
+        if not board['enabled']:
+            self.board = None
+        elif self.board is None or self.board.path != board_path(board['path']):
+            self.board = StateBoard(board['path'])
+            self.update_board()
+        _log.info("Reloaded the config from {}.".format(path))
+        self.publish_json('LEDcontrol/status', {}, ('SUCCESS', 'config', 'RELOAD'))
+        self.heartbeat.check()
+
+    def move_pins(self, pins):
+        """ Switch to a new pin map. A moved output is set to the LED's current state and an output that is
+            no longer used is set low; no other pin is written. """
+        old_outputs = (self.portGreenLED_Write, self.portRedLED_Write)
+        previous, self.pins = self.pins, pins
+        self.setup_pins(previous)
+        for port in old_outputs:
+            if port not in (self.portGreenLED_Write, self.portRedLED_Write):
+                self.write_pin(port, bbio.LOW)
+        for component, port, old_port, on in (('green LED', self.portGreenLED_Write, old_outputs[0], self.GreenOn),
+                                              ('red LED', self.portRedLED_Write, old_outputs[1], self.RedOn)):
+            if port != old_port:
+                level = bbio.HIGH if on else bbio.LOW
+                self.write_pin(port, level)
+                self.check_output(component, level)
+        _log.info("Now using the GPIO pins {}.".format(pins))
+
+    def save_state(self):
+        """ Save the LED states for the next start. """
+        try:
+            self.state_file.save({'GreenOn': self.GreenOn, 'RedOn': self.RedOn, 'patterns': self.patterns.names(),
+                                  'health': self.healthMode})
+        except (IOError, OSError) as error:
+            _log.error("Could not save the state to {}: {}".format(self.state_file.path, error))
+        self.update_board()
+
+    def update_board(self):
+        """ Put the LED states on the state board. """
+        if self.board is None:
+            return
+        try:
+            self.board.publish({'green': self.GreenOn, 'red': self.RedOn, 'patterns': self.patterns.names(),
+                                'health': self.healthMode, 'command': self.lastCommandId, 'time': time.time()})
+        except (IOError, OSError, ValueError) as error:
+            _log.error("Could not update the state board {}: {}".format(self.board.path, error))
+
     def green_on(self):
-        """Set P9.12 high"""
-        digitalWrite(self.portGreenLED_Write, HIGH)     # For BeagleBone
+        """Set P9.12 high, retrying if it doesn't read back high"""
+        self.retries.actuate('green LED', self._green_on)
+
+    def _green_on(self):
+        self.write_pin(self.portGreenLED_Write, bbio.HIGH)     # For BeagleBone
         # Check that the command has been correctly implemented.
-        if self.check_output('green LED', HIGH) is True:
+        if self.check_output('green LED', bbio.HIGH) is True:
             # Set flag, so know green LED is on, and log transition
             self.GreenOn = True
+            self.save_state()
             _log.info("SUCCESS - The green LED is now on.")
+            return True
+        return False
 
     def green_off(self):
-        """Set P9.12 low"""
-        digitalWrite(self.portGreenLED_Write, LOW)      # For BeagleBone
+        """Set P9.12 low, retrying if it doesn't read back low"""
+        self.retries.actuate('green LED', self._green_off, safe=True)
+
+    def _green_off(self):
+        self.write_pin(self.portGreenLED_Write, bbio.LOW)      # For BeagleBone
         # Check that the command has been correctly implemented.
-        if self.check_output('green LED', LOW) is True:
+        if self.check_output('green LED', bbio.LOW) is True:
             # Set flag, so know green LED is off, and log transition
             self.GreenOn = False
+            self.save_state()
             _log.info("SUCCESS - The green LED is now off.")
+            return True
+        return False
 
     def red_on(self):
-        """Set P9.14 high"""
-        digitalWrite(self.portRedLED_Write, HIGH)       # For BeagleBone
+        """Set P9.14 high, retrying if it doesn't read back high"""
+        self.retries.actuate('red LED', self._red_on)
+
+    def _red_on(self):
+        self.write_pin(self.portRedLED_Write, bbio.HIGH)       # For BeagleBone
         # Check that the command has been correctly implemented.
-        if self.check_output('red LED', HIGH) is True:
+        if self.check_output('red LED', bbio.HIGH) is True:
             # Set flag, so know red LED is on, and log transition
             self.RedOn = True
+            self.save_state()
             _log.info("SUCCESS - The red LED is now on.")
+            return True
+        return False
 
     def red_off(self):
-        """Set P9.14 low"""
-        digitalWrite(self.portRedLED_Write, LOW)        # For BeagleBone
+        """Set P9.14 low, retrying if it doesn't read back low"""
+        self.retries.actuate('red LED', self._red_off, safe=True)
+
+    def _red_off(self):
+        self.write_pin(self.portRedLED_Write, bbio.LOW)        # For BeagleBone
         # Check that the command has been correctly implemented.
-        if self.check_output('red LED', LOW) is True:
+        if self.check_output('red LED', bbio.LOW) is True:
             # Set flag, so know red LED is off, and log transition
             self.RedOn = False
+            self.save_state()
             _log.info("SUCCESS - The red LED is now off.")
+            return True
+        return False
+
+    def output_port(self, led):
+        return self.portGreenLED_Write if led == 'green' else self.portRedLED_Write
+
+    def set_pattern(self, led, name):
+        """ Run pattern name on the green or red LED in place of a steady on or off. """
+        component = '{} LED'.format(led)
+        if name not in self.patterns.patterns:
+            _log.warning("There is no LED pattern {!r}. Known patterns: {}.".format(
+                name, ', '.join(sorted(self.patterns.patterns))))
+            self.publish_json('LEDcontrol/status', {}, ('FAILED', component, 'PATTERN'))
+            return
+        # The pattern has the LED now: a retry still pending for it would fight the pattern.
+        self.retries.cancel(component)
+        if led == 'green':
+            self.GreenOn = False
+        else:
+            self.RedOn = False
+        self.patterns.start(led, name)
+        self.save_state()
+        _log.info("SUCCESS - The {} is now running the {} pattern.".format(component, name))
+        self.publish_json('LEDcontrol/status', {}, ('SUCCESS', component, name.upper()))
+
+    def end_pattern(self, led):
+        """ Stop the pattern on led and leave it off (and back on GPIO), checking that it reads back off. """
+        name = self.patterns.stop(led)
+        self.release_led(led)
+        self.save_state()
+        _log.info("The {} LED is no longer running the {} pattern.".format(led, name))
+        self.check_output('{} LED'.format(led), bbio.LOW)
+
+    def set_health_mode(self, on):
+        """ Switch health mode on (the LEDs show the unit's health) or off (they are left off, for commands). """
+        if on == self.healthMode:
+            return
+        if on and self.relayPins:
+            _log.error("Not starting health mode: the LEDs use the dehumidifier's pins {}.".format(
+                ', '.join(self.relayPins)))
+            self.publish_json('LEDcontrol/status', {}, ('FAILED', 'LEDs', 'HEALTH'))
+            return
+        self.healthMode = on
+        if on:
+            _log.info("Health mode: the LEDs now show the dehumidifier's health.")
+            self.retries.cancel('green LED')
+            self.retries.cancel('red LED')
+            self.health.start()
+        else:
+            _log.info("Manual mode: the LEDs now follow commands.")
+            self.health.stop()
+            for led in ('green', 'red'):
+                if led in self.patterns.running:
+                    self.end_pattern(led)
+        self.save_state()
+        self.publish_json('LEDcontrol/status', {}, ('SUCCESS', 'LEDs', 'HEALTH' if on else 'MANUAL'))
+
+    def show_health(self, display):
+        """ Called by the health indicator when the patterns to show change. """
+        _log.info("Health: {} (green {}, red {}).".format(', '.join(sorted(self.health.conditions)) or 'idle',
+                                                          display['green'], display['red']))
+        self.GreenOn = False
+        self.RedOn = False
+        for led in ('green', 'red'):
+            self.patterns.start(led, display[led])
+        self.save_state()
+
+    # Only the dehumidifier's topics: health.check_config() keeps the rules under health.TOPIC_PREFIX.
+    @matching.match_start("dhcontrol/")
+    def health_watch(self, topic, headers, message, match):
+        """In health mode, messages on the dehumidifier's topics that the health rules watch."""
+        if not self.health.watches(topic):
+            return
+        try:
+            value = jsonapi.loads(message[0])
+        except (ValueError, IndexError):
+            return
+        self.health.observe(topic, value)
+
+    def write_led(self, led, level):
+        """ Called by the pattern engine when led's level changes: set the duty cycle of its PWM pin, if it
+            has one, or set its GPIO pin high for any level above 0. Not read back: a blinking LED's feedback
+            pin says nothing useful. Queued on the I/O pool without waiting, behind the LED's other writes. """
+        port = self.output_port(led)
+        if led in self.pwm:
+            self.pwmActive.add(led)
+            self.io.post(port, bbio.analogWrite, getattr(bbio, self.pwm[led]), int(round(level * 255)))
+        else:
+            self.io.post(port, bbio.digitalWrite, port, bbio.HIGH if level > 0 else bbio.LOW)
+
+    def release_led(self, led):
+        """ Set led low, switching its pin back from PWM to GPIO if a pattern used PWM on it. """
+        port = self.output_port(led)
+        operations = []
+        if led in self.pwmActive:
+            self.pwmActive.discard(led)
+            operations = [(port, bbio.analogWrite, (getattr(bbio, self.pwm[led]), 0)),
+                          (port, bbio.pinMode, (port, bbio.OUTPUT))]
+        # Queued on the LED's pin, after any pattern step still queued there.
+        self.io.call_all(operations + [(port, bbio.digitalWrite, (port, bbio.LOW))])
 
     def check_output(self, component, expected_status):
         """ Input pins connected to output pins. Check if output voltage matches what is expected. """
         if component == 'green LED':
             # Read input pins
-            pin_status = digitalRead(self.portGreenLED_Read)
-            if pin_status == HIGH:
+            pin_status = self.read_pin(self.portGreenLED_Read)
+            if pin_status == bbio.HIGH:
                 mode = 'ON'
             else:
                 mode = 'OFF'
@@ -119,8 +511,8 @@ class LEDAgent(PublishMixin, BaseAgent):
                 self.publish_json('LEDcontrol/status', {}, ('FAILED', component, mode))
                 return False
         elif component == 'red LED':
-            pin_status = digitalRead(self.portRedLED_Read)
-            if pin_status == HIGH:
+            pin_status = self.read_pin(self.portRedLED_Read)
+            if pin_status == bbio.HIGH:
                 mode = 'ON'
             else:
                 mode = 'OFF'
@@ -136,21 +528,44 @@ class LEDAgent(PublishMixin, BaseAgent):
 
     def get_output_status(self):
         """ Log the output status of each GPIO pin. """
-        pin_status_green = digitalRead(self.portGreenLED_Read)
-        if pin_status_green == HIGH:
+        pin_status_green = self.read_pin(self.portGreenLED_Read)
+        if pin_status_green == bbio.HIGH:
             mode = 'ON'
         else:
             mode = 'OFF'
         # Log the input pin status
         _log.info("Green LED : {}".format(mode))
 
-        pin_status_red = digitalRead(self.portRedLED_Read)
-        if pin_status_red == HIGH:
+        pin_status_red = self.read_pin(self.portRedLED_Read)
+        if pin_status_red == bbio.HIGH:
             mode = 'ON'
         else:
             mode = 'OFF'
         # Log the input pin status
         _log.info("Red LED   : {}".format(mode))
+        for led, name in sorted(self.patterns.names().items()):
+            _log.info("Pattern   : {} LED {}".format(led, name))
+        if self.healthMode:
+            _log.info("Health    : {}".format(', '.join(sorted(self.health.conditions)) or 'idle'))
+        for device, counts in sorted(self.retries.counts.items()):
+            _log.info("Retries   : {} {}{}".format(device, counts,
+                                                  ' (DEGRADED)' if self.retries.blocked(device) else ''))
+        if self.io.stalls:
+            _log.info("I/O stalls: {}".format(self.io.counts()))
+
+    def snapshot(self):
+        """ Compact state for the heartbeat: the feedback pins and the agent's flags. """
+        # Both pins are read at once; a read that stalled (an IOStalled in place of a level) shows as UNKNOWN.
+        green, red = self.io.call_all([(self.portGreenLED_Read, bbio.digitalRead, (self.portGreenLED_Read,)),
+                                       (self.portRedLED_Read, bbio.digitalRead, (self.portRedLED_Read,))])
+        return {'green': 'ON' if green == bbio.HIGH else 'OFF' if green == bbio.LOW else 'UNKNOWN',
+                'red': 'ON' if red == bbio.HIGH else 'OFF' if red == bbio.LOW else 'UNKNOWN',
+                'GreenOn': self.GreenOn,
+                'RedOn': self.RedOn,
+                'patterns': self.patterns.names(),
+                'health': sorted(self.health.conditions) if self.healthMode else None,
+                'degraded': sorted(device for device in list(self.retries.degraded) if self.retries.blocked(device)),
+                'io_stuck': self.io.stuck_keys()}
 
     # If a message with the subscription name "userinput/state" is in the message bus,
     # execute the text below.
@@ -164,6 +579,30 @@ class LEDAgent(PublishMixin, BaseAgent):
         # message has format [prev_state, state]
         command = jsonapi.loads(message[0])
         command = command[1]
+        self.dispatcher.submit(command, headers)
+
+    def perform_command(self, command, headers):
+        """ Called by the dispatcher with a command from the bus, in its turn: perform it and record it. """
+        self.process_command(command)
+        # Readers of the board can now tell that this command has been dealt with.
+        self.lastCommandId = headers.get(COMMAND_ID)
+        self.save_state()
+        self.heartbeat.check()
+
+    def stop_outputs(self, reason=None):
+        """ Cancel any pending retry and any pattern and set P9.12 and P9.14 low, without reading back or
+            publishing. """
+        self.retries.cancel()
+        self.health.stop()
+        self.patterns.stop_all()
+        for led in list(self.pwmActive):
+            self.release_led(led)
+        # Both LEDs are queued before either is waited for, so they go out together.
+        self.io.call_all([(self.portGreenLED_Write, bbio.digitalWrite, (self.portGreenLED_Write, bbio.LOW)),
+                          (self.portRedLED_Write, bbio.digitalWrite, (self.portRedLED_Write, bbio.LOW))])
+
+    def process_command(self, command):
+        """ Perform a command from the userinput agent. """
         _log.info("Received the command {}.".format(command))
 
         # Now, process the command that was sent.
@@ -172,6 +611,25 @@ class LEDAgent(PublishMixin, BaseAgent):
             self.red_off()
         if command == 'status':
             self.get_output_status()
+        if command == 'kill' and self.healthMode:
+            # The outputs are already off (see stop_outputs()); stay out of health mode until asked.
+            self.healthMode = False
+            self.publish_json('LEDcontrol/status', {}, ('SUCCESS', 'LEDs', 'MANUAL'))
+        if command in ('leds health', 'leds manual'):
+            self.set_health_mode(command == 'leds health')
+            return
+        words = command.split()
+        if self.healthMode and words and words[0] in ('green', 'red'):
+            _log.warning("Ignoring {!r} in health mode; send 'leds manual' first.".format(command))
+            self.publish_json('LEDcontrol/status', {}, ('FAILED', '{} LED'.format(words[0]), 'HEALTH MODE'))
+            return
+        if len(words) == 3 and words[0] in ('green', 'red') and words[1] == 'pattern':
+            self.set_pattern(words[0], words[2])
+            return
+        # A steady on or off takes over from a pattern (which leaves the LED off).
+        for led in ('green', 'red'):
+            if command in (led + ' on', led + ' off') and led in self.patterns.running:
+                self.end_pattern(led)
         if self.GreenOn is True:
             # The green LED is currently on.
             if command == 'green off':
@@ -205,11 +663,32 @@ class LEDAgent(PublishMixin, BaseAgent):
                 # The red LED are already off, so don't need to do anything.
                 pass
 
+    @matching.match_start(CACHE_REPLY)
+    def cache_reply(self, topic, headers, message, match):
+        """The last command sent to each LED, from the cache agent, asked for at start-up. They come oldest
+        first (after the last 'kill', if there was one), and are carried out in that order."""
+        if topic != CACHE_REPLY + self._agent_id or self.lastCommandId is not None:
+            # Not for this agent, or a command has arrived since start-up (and is at least as new).
+            return
+        for entry in jsonapi.loads(message[0])['values']:
+            words = entry['message'][1].split()
+            if entry['topic'] == 'userinput/state' and words and words[0] in ('kill', 'green', 'red', 'leds'):
+                _log.info("Catching up with the last command sent to the {}: {}.".format(entry['key'],
+                                                                                         entry['message'][1]))
+                self.control_led(entry['topic'], entry['headers'], [jsonapi.dumps(entry['message'])], None)
+
+    @matching.match_exact("LEDcontrol/snapshot/request")
+    def heartbeat_request(self, topic, headers, message, match):
+        """A subscriber missed a heartbeat delta and asked for a full snapshot."""
+        self.heartbeat.publish_full()
+
 
 # --------------------------------------- ALWAYS INCLUDE --------------------------------------- #
 # Include this section in every agent, but adjust the agent name and description.
 def main(argv=sys.argv):
     '''Main method called by the eggsecutable.'''
+    # Enable information and debug logging
+    utils.setup_logging()
     utils.default_main(LEDAgent,
                    description='Control green and red LEDs',
                    argv=argv)
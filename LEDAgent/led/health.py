@@ -0,0 +1,243 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Health mode for the LED control agent: the LEDs show how the unit is doing, so it can be read at a     #
+# glance on site.                                                                                        #
+# Messages on the health topics are run through a rule table. A rule names a topic prefix, a message    #
+# pattern and a condition, which it sets (active: true) or clears (active: false) when a message         #
+# matches. A message pattern is matched against the decoded message: '*' matches anything, a list        #
+# matches a list of the same length item by item, a dict matches a dict that has all of its keys (with  #
+# matching values, nested), and anything else must be equal:                                             #
+#     {"topic": "dhcontrol/status", "message": ["FAILED", "*", "DEGRADED"], "condition": "degraded",      #
+#      "active": true}                                                                                   #
+# A watchdog sets its condition when nothing has arrived under its prefix for 'timeout' seconds, and     #
+# clears it on the next message ('comms_lost').                                                          #
+# The agent only subscribes to the dehumidifier's topics (TOPIC_PREFIX), so every rule topic and         #
+# watchdog prefix must be under it.                                                                      #
+# The display table lists conditions in priority order, each with the pattern for each LED; the first   #
+# active one is shown, or 'idle' when none is. Conditions can change on every message, but the LEDs are  #
+# updated at most once every min_interval seconds (to the display wanted at the time), so a burst of     #
+# status messages costs at most one change of pattern.                                                   #
+# ------------------------------------------------------------------------------------------------------ #
+import logging
+import time
+
+
+_log = logging.getLogger(__name__)
+
+# The topics the LED agent subscribes to for health mode (see health_watch() in agent.py).
+TOPIC_PREFIX = 'dhcontrol/'
+
+# Default health settings. Anything under "health" in the LED agent's config overrides these.
+HEALTH_DEFAULTS = {
+    'enabled': False,           # start in health mode (the 'leds health' and 'leds manual' commands switch)
+    'min_interval': 1.0,        # seconds between LED updates
+    'check_interval': 5.0,      # seconds between watchdog checks
+    # Published when health mode starts, so the state is known without waiting for the next change.
+    'requests': ['dhcontrol/snapshot/request'],
+    'rules': [
+        {'topic': 'dhcontrol/status', 'message': ['FAILED', '*', 'DEGRADED'], 'condition': 'degraded',
+         'active': True},
+        {'topic': 'dhcontrol/retry', 'message': {'event': 'degraded'}, 'condition': 'degraded', 'active': True},
+        {'topic': 'dhcontrol/heartbeat', 'message': {'state': {'degraded': []}}, 'condition': 'degraded',
+         'active': False},
+        {'topic': 'dhcontrol/heartbeat', 'message': {'state': {'deferred': True}}, 'condition': 'deferred',
+         'active': True},
+        {'topic': 'dhcontrol/heartbeat', 'message': {'state': {'deferred': False}}, 'condition': 'deferred',
+         'active': False},
+        {'topic': 'dhcontrol/heartbeat', 'message': {'state': {'dehum': 'ON'}}, 'condition': 'running',
+         'active': True},
+        {'topic': 'dhcontrol/heartbeat', 'message': {'state': {'dehum': 'OFF'}}, 'condition': 'running',
+         'active': False},
+        {'topic': 'dhcontrol/status', 'message': ['SUCCESS', 'dehumidifier', 'ON'], 'condition': 'running',
+         'active': True},
+        {'topic': 'dhcontrol/status', 'message': ['SUCCESS', 'dehumidifier', 'OFF'], 'condition': 'running',
+         'active': False},
+        # A pin whose I/O has hung (see bbcommon/iopool.py), until the heartbeat says none is stuck.
+        {'topic': 'dhcontrol/io', 'message': {'event': 'stalled'}, 'condition': 'io_stalled', 'active': True},
+        {'topic': 'dhcontrol/heartbeat', 'message': {'state': {'io_stuck': '*'}}, 'condition': 'io_stalled',
+         'active': True},
+        {'topic': 'dhcontrol/heartbeat', 'message': {'state': {'io_stuck': []}}, 'condition': 'io_stalled',
+         'active': False},
+    ],
+    # DehumAgent sends a full heartbeat at least every 300 seconds.
+    'watchdogs': [{'prefix': 'dhcontrol/', 'timeout': 330.0, 'condition': 'comms_lost'}],
+    'display': [
+        {'condition': 'comms_lost', 'green': 'off', 'red': 'comms_lost'},
+        {'condition': 'degraded', 'green': 'off', 'red': 'degraded'},
+        {'condition': 'io_stalled', 'green': 'off', 'red': 'degraded'},
+        {'condition': 'deferred', 'green': 'deferred', 'red': 'off'},
+        {'condition': 'running', 'green': 'running', 'red': 'off'},
+    ],
+    'idle': {'green': 'dim', 'red': 'off'},
+    # The dehumidifier's output pins (DehumAgent's pins.dehumidifier and pins.fan, and P9.14's PWM). Health
+    # mode dims and blinks the LEDs on its own, so it won't start while an LED pin is one of these.
+    'relay_pins': ['GPIO1_28', 'GPIO1_18', 'PWM1A'],
+}
+
+
+def shared_pins(config, pins):
+    """ The LED output pins in pins that are also the dehumidifier's (relay_pins), sorted. """
+    return sorted(set(pins) & set(dict(HEALTH_DEFAULTS, **config)['relay_pins']))
+
+
+def check_config(config, patterns, pins=()):
+    """ Raise ValueError if the health settings can't be used with the LED patterns named in patterns, or
+        health mode is enabled while an LED output pin in pins is one of the dehumidifier's. """
+    config = dict(HEALTH_DEFAULTS, **config)
+    if not isinstance(config['relay_pins'], list):
+        raise ValueError('The health relay_pins must be a list of pin names')
+    if config['enabled'] is True and shared_pins(config, pins):
+        raise ValueError("Health mode can't be enabled while the LEDs use the dehumidifier's pins {}".format(
+            ', '.join(shared_pins(config, pins))))
+    if float(config['min_interval']) < 0 or float(config['check_interval']) <= 0:
+        raise ValueError('The health min_interval can not be negative, and check_interval must be greater than 0')
+    for rule in config['rules']:
+        if not rule['topic'] or not rule['condition'] or 'message' not in rule:
+            raise ValueError('Each health rule needs a topic, a message and a condition: {}'.format(rule))
+        if not rule['topic'].startswith(TOPIC_PREFIX):
+            raise ValueError('Health rule topics must be under {}: {}'.format(TOPIC_PREFIX, rule))
+    for watchdog in config['watchdogs']:
+        if not watchdog['prefix'] or not watchdog['condition'] or float(watchdog['timeout']) <= 0:
+            raise ValueError('Each health watchdog needs a prefix, a condition and a timeout: {}'.format(watchdog))
+        if not watchdog['prefix'].startswith(TOPIC_PREFIX):
+            raise ValueError('Health watchdog prefixes must be under {}: {}'.format(TOPIC_PREFIX, watchdog))
+    for entry in list(config['display']) + [config['idle']]:
+        for led in ('green', 'red'):
+            if entry[led] not in patterns:
+                raise ValueError('The health display uses an unknown LED pattern {!r}'.format(entry[led]))
+    return config
+
+
+def matches(pattern, value):
+    """ True if the decoded message value matches a rule's message pattern (see the overview). """
+    if pattern == '*':
+        return True
+    if isinstance(pattern, dict):
+        return isinstance(value, dict) and all(key in value and matches(item, value[key])
+                                               for key, item in pattern.items())
+    if isinstance(pattern, list):
+        return (isinstance(value, (list, tuple)) and len(value) == len(pattern)
+                and all(matches(item, part) for item, part in zip(pattern, value)))
+    return pattern == value
+
+
+class HealthIndicator(object):
+    """ Turns health messages into conditions, and conditions into LED patterns: show({'green': name,
+        'red': name}) is called when the patterns to show change. """
+
+    def __init__(self, agent, show, config, patterns):
+        self.agent = agent
+        self.show = show
+        self.running = False
+        self.conditions = set()
+        self.seen = {}              # watchdog prefix -> time of the last message under it
+        self.shown = None
+        self.last_update = 0.0
+        self._pending = None
+        self._timer = None
+        # Messages that matched a rule, and LED updates made, for the heartbeat and status.
+        self.matched = 0
+        self.updates = 0
+        self.reconfigure(config, patterns)
+
+    def reconfigure(self, config, patterns):
+        self.config = check_config(config, patterns)
+        self.rules = list(self.config['rules'])
+        self.watchdogs = list(self.config['watchdogs'])
+        # Every prefix a message must start with to be of interest, for a quick check on each message.
+        self.prefixes = tuple(set([rule['topic'] for rule in self.rules] +
+                                  [watchdog['prefix'] for watchdog in self.watchdogs]))
+        if self.running:
+            self.stop()
+            self.start()
+
+    def start(self):
+        """ Start showing the unit's health. Conditions start clear; the watchdogs start counting now. """
+        now = time.time()
+        self.running = True
+        self.conditions = set()
+        self.seen = dict((watchdog['prefix'], now) for watchdog in self.watchdogs)
+        self.shown = None
+        self._timer = self.agent.periodic_timer(float(self.config['check_interval']), self.check_watchdogs)
+        for topic in self.config['requests']:
+            self.agent.publish_json(topic, {}, {})
+        self.update()
+
+    def stop(self):
+        self.running = False
+        for timer in (self._timer, self._pending):
+            if timer is not None:
+                timer.cancel()
+        self._timer = self._pending = None
+
+    def watches(self, topic):
+        return self.running and topic.startswith(self.prefixes)
+
+    def observe(self, topic, message):
+        """ A decoded message on a watched topic. """
+        now = time.time()
+        changed = False
+        for watchdog in self.watchdogs:
+            if topic.startswith(watchdog['prefix']):
+                self.seen[watchdog['prefix']] = now
+                if watchdog['condition'] in self.conditions:
+                    _log.info("Heard from {} again.".format(watchdog['prefix']))
+                    self.conditions.discard(watchdog['condition'])
+                    changed = True
+        for rule in self.rules:
+            if topic.startswith(rule['topic']) and matches(rule['message'], message):
+                self.matched += 1
+                changed = self._set(rule['condition'], rule.get('active', True)) or changed
+        if changed:
+            self.request_update()
+
+    def check_watchdogs(self):
+        now = time.time()
+        changed = False
+        for watchdog in self.watchdogs:
+            if (now - self.seen.get(watchdog['prefix'], now) > float(watchdog['timeout'])
+                    and watchdog['condition'] not in self.conditions):
+                _log.warning("Nothing from {} for {} seconds.".format(watchdog['prefix'], watchdog['timeout']))
+                self.conditions.add(watchdog['condition'])
+                changed = True
+        if changed:
+            self.request_update()
+
+    def request_update(self):
+        """ Update the LEDs now, or at the end of min_interval if they were updated less than that ago. """
+        if self._pending is not None:
+            return
+        wait = self.last_update + float(self.config['min_interval']) - time.time()
+        if wait > 0:
+            self._pending = self.agent.timer(wait, self._run_pending)
+        else:
+            self.update()
+
+    def display(self):
+        """ The patterns wanted for the active conditions. """
+        for entry in self.config['display']:
+            if entry['condition'] in self.conditions:
+                return {'green': entry['green'], 'red': entry['red']}
+        return {'green': self.config['idle']['green'], 'red': self.config['idle']['red']}
+
+    def update(self):
+        if not self.running:
+            return
+        self.last_update = time.time()
+        wanted = self.display()
+        if wanted != self.shown:
+            self.shown = wanted
+            self.updates += 1
+            self.show(wanted)
+
+    def _run_pending(self):
+        self._pending = None
+        self.update()
+
+    def _set(self, condition, active):
+        if active and condition not in self.conditions:
+            self.conditions.add(condition)
+            return True
+        if not active and condition in self.conditions:
+            self.conditions.discard(condition)
+            return True
+        return False
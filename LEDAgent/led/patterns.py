@@ -0,0 +1,153 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Blink codes and brightness levels for the LED control agent.                                           #
+# A pattern is a list of steps, [level, seconds], repeated for as long as the pattern runs. The level is #
+# a brightness from 0 (off) to 1 (fully on); an LED on a PWM pin shows it, and an LED on a plain GPIO pin #
+# is on for any level above 0. A pattern with one step holds its level.                                  #
+# All LEDs share one timer queue (see bbcommon/timerqueue.py), with one agent timer set for the next     #
+# step change of any LED. Step changes are rounded up to the next multiple of 'tick' seconds, so LEDs    #
+# that change within the same tick are all stepped in one wakeup. There is no thread or sleep per LED,   #
+# an LED holding its level costs nothing, and a step that doesn't change the level isn't written. The    #
+# work done is one heap operation per step change, however many LEDs and patterns there are.             #
+# ------------------------------------------------------------------------------------------------------ #
+import math
+import time
+
+from bbcommon.timerqueue import AgentTimerQueue
+
+
+# The patterns every LED agent knows. Anything under "patterns.patterns" in the config is added to (or
+# replaces) these.
+PATTERN_DEFAULTS = {
+    'off': [[0.0, 1.0]],                                        # steady, off
+    'running': [[1.0, 1.0]],                                    # steady, full brightness
+    'dim': [[0.2, 1.0]],                                        # steady, low brightness
+    'deferred': [[0.3, 1.0], [0.0, 1.0]],                       # slow dim blink: anti-short-cycle wait
+    'degraded': [[1.0, 0.2], [0.0, 0.3], [1.0, 0.2], [0.0, 0.3],
+                 [1.0, 0.2], [0.0, 1.5]],                       # three flashes, then a pause
+    'comms_lost': [[1.0, 0.1], [0.0, 0.1]],                     # fast blink
+}
+
+# Default engine settings. Anything under "patterns" in the agent config overrides these.
+PATTERN_ENGINE_DEFAULTS = {
+    'tick': 0.05,               # seconds; step changes are rounded up to a multiple of this (0: not rounded)
+    'pwm': {},                  # LED -> PWM pin driving it, for LEDs whose pin can dim ({"red": "PWM2B"})
+    'patterns': {},             # extra or replacement patterns, by name
+}
+
+
+def check_config(config):
+    """ Raise ValueError if the pattern settings can't be used. """
+    config = dict(PATTERN_ENGINE_DEFAULTS, **config)
+    if float(config['tick']) < 0:
+        raise ValueError('The patterns tick can not be negative')
+    for name, steps in dict(PATTERN_DEFAULTS, **config['patterns']).items():
+        if not steps:
+            raise ValueError('Pattern {!r} has no steps'.format(name))
+        for level, seconds in steps:
+            if not 0.0 <= float(level) <= 1.0:
+                raise ValueError('Pattern {!r}: levels must be from 0 to 1, not {}'.format(name, level))
+            if float(seconds) <= 0:
+                raise ValueError('Pattern {!r}: steps must last more than 0 seconds, not {}'.format(name, seconds))
+    return config
+
+
+class Running(object):
+    """ A pattern running on one LED. """
+    __slots__ = ('name', 'steps', 'index', 'level', 'due', 'entry')
+
+    def __init__(self, name, steps, now):
+        self.name = name
+        self.steps = steps
+        self.index = 0
+        self.level = None
+        self.due = now          # when the current step ends, unrounded so the rounding doesn't add up
+        self.entry = None
+
+
+class PatternEngine(object):
+    """ Runs a pattern on each of any number of LEDs, calling write(led, level) whenever an LED's level
+        changes. """
+
+    def __init__(self, agent, write, config):
+        self.write = write
+        self.queue = AgentTimerQueue(agent, self._step)
+        self.running = {}
+        # Level changes written, for the heartbeat and benchmarks.
+        self.writes = 0
+        self.reconfigure(config)
+
+    def reconfigure(self, config, rewrite=False):
+        """ Switch to new settings. A running pattern whose steps changed starts again from its first step
+            (every running pattern does if rewrite, and writes its level even if it hasn't changed: the LEDs
+            have moved). Returns the LEDs whose pattern no longer exists; they are stopped. """
+        self.config = check_config(config)
+        self.tick = float(self.config['tick'])
+        self.patterns = dict((name, [(float(level), float(seconds)) for level, seconds in steps])
+                             for name, steps in dict(PATTERN_DEFAULTS, **self.config['patterns']).items())
+        dropped = []
+        for led, running in list(self.running.items()):
+            if running.name not in self.patterns:
+                self.stop(led)
+                dropped.append(led)
+            elif rewrite or self.patterns[running.name] != running.steps:
+                if rewrite:
+                    running.level = None
+                self.start(led, running.name, restart=True)
+        return dropped
+
+    def start(self, led, name, restart=False):
+        """ Run pattern name on led. If it is already running there it carries on where it is, unless restart.
+            Raises KeyError for an unknown pattern. """
+        steps = self.patterns[name]
+        current = self.running.get(led)
+        if current is not None:
+            if current.name == name and not restart:
+                return
+            if current.entry is not None:
+                self.queue.cancel(current.entry)
+        running = self.running[led] = Running(name, steps, time.time())
+        if current is not None:
+            # The LED is showing the old pattern's level; don't write it again if the new one starts there.
+            running.level = current.level
+        self._enter(led, running)
+
+    def stop(self, led):
+        """ Stop led's pattern, leaving the LED at its current level. Returns the pattern's name, or None. """
+        running = self.running.pop(led, None)
+        if running is None:
+            return None
+        if running.entry is not None:
+            self.queue.cancel(running.entry)
+        return running.name
+
+    def stop_all(self):
+        """ Stop every pattern. Returns the LEDs that were running one. """
+        leds = list(self.running)
+        self.running.clear()
+        self.queue.clear()
+        return leds
+
+    def names(self):
+        """ LED -> name of the pattern it is running. """
+        return dict((led, running.name) for led, running in self.running.items())
+
+    def _enter(self, led, running):
+        level, seconds = running.steps[running.index]
+        if level != running.level:
+            running.level = level
+            self.writes += 1
+            self.write(led, level)
+        if len(running.steps) > 1:
+            running.due += seconds
+            deadline = running.due
+            if self.tick > 0:
+                deadline = math.ceil(deadline / self.tick) * self.tick
+            running.entry = self.queue.push(deadline, led)
+
+    def _step(self, led):
+        """ Called by the timer queue when led's current step has run its time. """
+        running = self.running.get(led)
+        if running is None:
+            return
+        running.index = (running.index + 1) % len(running.steps)
+        self._enter(led, running)
@@ -0,0 +1,93 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# This agent compares a shadow control agent's decisions with what the production control agent did,    #
+# command by command (see bbcommon/shadow.py):                                                           #
+#   - 'shadow/decision' comes from the shadow (ControlAgent with "shadow" enabled), and                  #
+#   - 'shadow/actual' comes from production (DehumAgent with "shadow" enabled).                          #
+# The two are matched by command id. A divergence (different transitions or end state) is logged, up    #
+# to log_divergences per report. Every report_interval seconds the counts, the decision-latency           #
+# difference (shadow minus production) and the most recent divergences are published on 'shadow/report'.#
+# ------------------------------------------------------------------------------------------------------ #
+
+
+# --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
+# more import statements may be needed for other agents, but these work for this agent
+import logging
+import sys
+
+from zmq.utils import jsonapi
+from volttron.platform.agent import BaseAgent, PublishMixin
+from volttron.platform.agent import utils, matching
+
+from bbcommon.shadow import ShadowComparator
+
+_log = logging.getLogger(__name__)
+# --------------------------------------- ASSUME THESE ARE NEEDED --------------------------------------- #
+
+
+# Create a class with the convention: NameAgent
+# and always include "PublishMixin, BaseAgent" as its arguments.
+class ShadowAgent(PublishMixin, BaseAgent):
+    """ Matches shadow/decision with shadow/actual and reports how they differ. """
+
+    # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
+    def __init__(self, config_path, **kwargs):
+        super(ShadowAgent, self).__init__(**kwargs)
+        self.config = utils.load_config(config_path)
+        self.comparator = ShadowComparator(self.config.get('comparator', {}))
+        # Divergences logged since the last report.
+        self.logged = 0
+
+    def setup(self):
+        # Demonstrate accessing a value from the config file
+        _log.info(self.config['message'])
+        self._agent_id = self.config['agentid']
+        super(ShadowAgent, self).setup()
+        self.periodic_timer(float(self.config.get('report_interval', 60)), self.publish_report)
+    # --------------------------------------- ASSUME THIS IS NEEDED --------------------------------------- #
+
+    @matching.match_exact("shadow/decision")
+    def on_decision(self, topic, headers, message, match):
+        """A decision from the shadow control agent."""
+        self.compare('decision', jsonapi.loads(message[0]))
+
+    @matching.match_exact("shadow/actual")
+    def on_actual(self, topic, headers, message, match):
+        """What the production control agent did."""
+        self.compare('actual', jsonapi.loads(message[0]))
+
+    def compare(self, kind, outcome):
+        result = self.comparator.add(kind, outcome)
+        if result is not None and result['diverged'] and self.logged < int(self.config.get('log_divergences', 10)):
+            self.logged += 1
+            _log.warning("Divergence on '{}' ({}): shadow {}, production {}.".format(
+                result['command'], result['id'], result['decision'], result['actual']))
+
+    def publish_report(self):
+        self.comparator.expire()
+        report = self.comparator.report()
+        counts = report['counts']
+        _log.info("Shadow: {} matched, {} diverged, {} unmatched, latency difference p50 {} s.".format(
+            counts['matched'], counts['diverged'], counts['unmatched_decision'] + counts['unmatched_actual'],
+            report['latency_delta']['p50']))
+        self.publish_json('shadow/report', {}, report)
+        self.logged = 0
+
+
+# --------------------------------------- ALWAYS INCLUDE --------------------------------------- #
+# Include this section in every agent, but adjust the agent name and description.
+def main(argv=sys.argv):
+    '''Main method called by the eggsecutable.'''
+    # Enable information and debug logging
+    utils.setup_logging()
+    utils.default_main(ShadowAgent,
+                   description='Compare shadow decisions with production',
+                   argv=argv)
+
+
+if __name__ == '__main__':
+    # Entry point for script
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
+# --------------------------------------- ALWAYS INCLUDE --------------------------------------- #
@@ -80,9 +80,18 @@ from zmq.utils import jsonapi
 from volttron.platform.agent import BaseAgent, PublishMixin
 from volttron.platform.agent import utils, matching
 
+from bbcommon import schedules
+from bbcommon.ratelimit import CommandLimiter
+from bbcommon.shadow import COMMAND_ID, COMMAND_TIME, CommandIds
+from bbcommon.stateboard import BoardReader
+
 
 _log = logging.getLogger(__name__)
 
+# Commands a timer may send, each with the command sent at the end of the timer's window (if any).
+TIMED_COMMANDS = {'green on': 'green off', 'red on': 'red off', 'green off': None, 'red off': None,
+                  'kill': None}
+
 
 class UIAgent(PublishMixin, BaseAgent):
     '''Example agent to demonstrate user interaction.'''
@@ -91,14 +100,31 @@ class UIAgent(PublishMixin, BaseAgent):
         '''Initialize instance attributes.'''
         super(UIAgent, self).__init__(**kwargs)
         self.config = {'address': ('127.0.0.1', 7575),
-                       'state': 'all off', 'backlog': 5}
+                       'state': 'all off', 'backlog': 5,
+                       'timers_file': 'ui_timers.json',
+                       'rate_limit': {},
+                       'state_board': {}}
         if config_path:
             self.config.update(utils.load_config(config_path))
         self.ask_socket = None
         self.state = None
+        # Every command published gets an id, so its outcomes can be matched up (see bbcommon/shadow.py).
+        self.command_ids = CommandIds('ui')
+        # Commands typed faster than the limits allow are refused (see bbcommon/ratelimit.py).
+        self.limiter = CommandLimiter(self.config['rate_limit'])
+        # The control agent's own record of the devices (see bbcommon/stateboard.py). When it is there, the flags
+        # below are refreshed from it before each command, so they don't drift from what is really on.
+        board = dict({'enabled': True, 'path': 'led.board'}, **self.config['state_board'])
+        self.board = BoardReader(board['path']) if board['enabled'] else None
+        # CommandID and time of the last command sent, to know when the board has caught up with it.
+        self.lastSent = (None, 0.0)
+        # Calendar timers ('at 02:00-05:00 weekdays ...'), kept in timers_file.
+        self.timers = schedules.TimerBook(self, self.config['timers_file'], self.run_timer)
         # Initialize flags to be False. These are used to know what component is running.
         self.GreenOn = False
         self.RedOn = False
+        # True while the LED control agent shows the unit's health, when it refuses the LED commands.
+        self.healthMode = False
         # Initialize variables/flags that are used to verify the correct action was performed
         self.show_status = False
         self.component = None
@@ -109,6 +135,7 @@ class UIAgent(PublishMixin, BaseAgent):
         '''Perform additional setup.'''
         super(UIAgent, self).setup()
         self.change_state(str(self.config['state']))
+        self.timers.load()
         # Open a socket to listen for incoming connections
         self.ask_socket = sock = socket.socket()
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -121,8 +148,22 @@ class UIAgent(PublishMixin, BaseAgent):
         '''Change state and notify other agents.'''
         # Assign old state and new state
         prev_state, self.state = self.state, state
+        headers = self.command_ids.headers()
+        self.lastSent = (headers[COMMAND_ID], headers[COMMAND_TIME])
         # Publish current state to message bus.
-        self.publish_json('userinput/state', {}, (prev_state, state))
+        self.publish_json('userinput/state', headers, (prev_state, state))
+
+    def refresh_flags(self):
+        '''Take the device flags from the control agent's state board, once it has caught up.'''
+        if self.board is None:
+            return
+        state = self.board.settled(*self.lastSent)
+        if state is not None:
+            # An LED running a pattern is neither on nor off: 'on' and 'off' are both sent.
+            patterns = state.get('patterns', {})
+            self.GreenOn = None if 'green' in patterns else state['green']
+            self.RedOn = None if 'red' in patterns else state['red']
+            self.healthMode = state.get('health', False)
 
     def handle_accept(self, ask_sock):
         '''Accept new connections.'''
@@ -155,50 +196,110 @@ class UIAgent(PublishMixin, BaseAgent):
                 raise socket.error('disconnected')
             response = response.strip()     # strip() gets rid of end line character
             if response:
-                if response == 'kill':
-                    self.GreenOn = False
-                    self.RedOn = False
-                    self.change_state(response)
-                elif response == 'status':
-                    self.change_state(response)
-                elif response == 'help':
-                    file.write("\n************************* Instructions **************************\n"
-                               "   Valid commands are...\n"
-                               "     | green on | green off | red on | red off | status | kill |\n"
-                               "   For help, type 'help'.\n"
-                               "************************* Instructions **************************\n")
-                elif response == 'green on':
-                    if self.GreenOn is True:
-                        file.write("\n** SUCCESS ** - The green LED is already on.\n")
-                    else:
-                        self.GreenOn = True
-                        self.change_state(response)
-                elif response == 'green off':
-                    if self.GreenOn is False:
-                        file.write("\n** SUCCESS ** - The green LED is already off.\n")
-                    else:
-                        self.GreenOn = False
-                        self.change_state(response)
-                elif response == 'red on':
-                    if self.RedOn is True:
-                        file.write("\n** SUCCESS ** - The red LED is already on.\n")
-                    else:
-                        self.RedOn = True
-                        self.change_state(response)
-                elif response == 'red off':
-                    if self.RedOn is False:
-                        file.write("\n** SUCCESS ** - The red LED is already off.\n")
-                    else:
-                        self.RedOn = False
-                        self.change_state(response)
+                refused = self.limiter.check(file.fileno(), response)
+                if refused is not None:
+                    file.write("\n** FAILED ** - Too many commands: {}. Wait a moment and try again.\n".format(refused))
                 else:
-                    file.write("\n** FAILED ** - You entered an invalid command. Valid commands are... \n"
-                               "               | green on | green off | red on | red off | kill |\n")
+                    self.process_response(response, file)
             self.ask_input(file)
         except socket.error:
             _log.info('Connection {} disconnected'.format(file.fileno()))
+            self.limiter.forget(file.fileno())
             self.reactor.unregister(file)
 
+    def process_response(self, response, file):
+        '''Act on one command, typed by the user or sent by a timer. Replies are written to file.'''
+        self.refresh_flags()
+        if response.startswith('at ') or response == 'timers' or response.startswith('cancel '):
+            self.process_timer_command(response, file)
+        elif response == 'kill':
+            self.GreenOn = False
+            self.RedOn = False
+            self.healthMode = False
+            self.change_state(response)
+        elif response == 'status':
+            self.change_state(response)
+        elif response in ('leds health', 'leds manual'):
+            self.healthMode = response == 'leds health'
+            self.change_state(response)
+        elif self.healthMode and response.split()[0] in ('green', 'red'):
+            file.write("\n** FAILED ** - The LEDs are showing the unit's health. Type 'leds manual' first.\n")
+        elif response == 'help':
+            file.write("\n************************* Instructions **************************\n"
+                       "   Valid commands are...\n"
+                       "     | green on | green off | red on | red off | status | kill |\n"
+                       "     | green pattern <name> | red pattern <name> |\n"
+                       "       (patterns: off, running, dim, deferred, degraded, comms_lost, or one in the LED config)\n"
+                       "     | leds health | leds manual |\n"
+                       + schedules.HELP +
+                       "   For help, type 'help'.\n"
+                       "************************* Instructions **************************\n")
+        elif response.startswith(('green pattern ', 'red pattern ')):
+            # The LED control agent knows which patterns there are, and says so if the name is wrong.
+            if response.startswith('green'):
+                self.GreenOn = None
+            else:
+                self.RedOn = None
+            self.change_state(response)
+        elif response == 'green on':
+            if self.GreenOn is True:
+                file.write("\n** SUCCESS ** - The green LED is already on.\n")
+            else:
+                self.GreenOn = True
+                self.change_state(response)
+        elif response == 'green off':
+            if self.GreenOn is False:
+                file.write("\n** SUCCESS ** - The green LED is already off.\n")
+            else:
+                self.GreenOn = False
+                self.change_state(response)
+        elif response == 'red on':
+            if self.RedOn is True:
+                file.write("\n** SUCCESS ** - The red LED is already on.\n")
+            else:
+                self.RedOn = True
+                self.change_state(response)
+        elif response == 'red off':
+            if self.RedOn is False:
+                file.write("\n** SUCCESS ** - The red LED is already off.\n")
+            else:
+                self.RedOn = False
+                self.change_state(response)
+        else:
+            file.write("\n** FAILED ** - You entered an invalid command. Valid commands are... \n"
+                       "               | green on | green off | red on | red off | kill |\n"
+                       "               | green pattern <name> | red pattern <name> | leds health | leds manual |\n")
+
+    def process_timer_command(self, response, file):
+        '''Add, list or cancel calendar timers.'''
+        if response == 'timers':
+            if not self.timers.timers:
+                file.write("\n** No timers are set. **\n")
+            for number, timer in sorted(self.timers.timers.items()):
+                file.write("\n   {}: {}".format(number, schedules.describe(timer)))
+            file.write("\n")
+        elif response.startswith('cancel '):
+            try:
+                number = int(response.split()[1])
+            except ValueError:
+                number = None
+            if number is not None and self.timers.cancel(number):
+                file.write("\n** SUCCESS ** - Timer {} was removed.\n".format(number))
+            else:
+                file.write("\n** FAILED ** - There is no timer {!r}. Type 'timers' to list them.\n".format(
+                    response.split()[1]))
+        else:
+            try:
+                timer = self.timers.add(schedules.parse_timer(response, TIMED_COMMANDS))
+            except ValueError as error:
+                file.write("\n** FAILED ** - {}\n".format(error))
+            else:
+                file.write("\n** SUCCESS ** - Added timer {}: {}\n".format(timer['id'], schedules.describe(timer)))
+
+    def run_timer(self, command):
+        '''Called when a timer's start or end time arrives. Sends the command as if it was typed.'''
+        self.process_response(command, schedules.ReplyLog())
+
     #@matching.match_start('LEDcontrol/status')
     #def pin_status_verification(self, topic, headers, message, match):
     #    incoming_msg = jsonapi.loads(message[0])
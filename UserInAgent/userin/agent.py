@@ -81,6 +81,10 @@ from zmq.utils import jsonapi
 from volttron.platform.agent import BaseAgent, PublishMixin
 from volttron.platform.agent import utils, matching
 
+from bbcommon.ratelimit import CommandLimiter
+from bbcommon.shadow import COMMAND_ID, COMMAND_TIME, CommandIds
+from bbcommon.stateboard import BoardReader
+
 
 _log = logging.getLogger(__name__)
 
@@ -92,14 +96,28 @@ class UserInAgent(PublishMixin, BaseAgent):
         '''Initialize instance attributes.'''
         super(UserInAgent, self).__init__(**kwargs)
         self.config = {'address': ('127.0.0.1', 7575),
-                       'state': 'all off', 'backlog': 5}
+                       'state': 'all off', 'backlog': 5,
+                       'rate_limit': {},
+                       'state_board': {}}
         if config_path:
             self.config.update(utils.load_config(config_path))
         self.ask_socket = None
         self.state = None
+        # Every command published gets an id, so its outcomes can be matched up (see bbcommon/shadow.py).
+        self.command_ids = CommandIds('userin')
+        # Commands typed faster than the limits allow are refused (see bbcommon/ratelimit.py).
+        self.limiter = CommandLimiter(self.config['rate_limit'])
+        # The control agent's own record of the devices (see bbcommon/stateboard.py). When it is there, the flags
+        # below are refreshed from it before each command, so they don't drift from what is really on.
+        board = dict({'enabled': True, 'path': 'dhcontrol.board'}, **self.config['state_board'])
+        self.board = BoardReader(board['path']) if board['enabled'] else None
+        # CommandID and time of the last command sent, to know when the board has caught up with it.
+        self.lastSent = (None, 0.0)
         # Initialize flags to be False. These are used to know what component is running.
         self.dehumidifierOn = False
         self.fanOn = False
+        # True while the control agent's humidistat or schedule is running the dehumidifier.
+        self.autoOn = False
 
     def setup(self):
         '''Perform additional setup.'''
@@ -117,8 +135,20 @@ class UserInAgent(PublishMixin, BaseAgent):
         '''Change state and notify other agents.'''
         # Assign old state and new state
         prev_state, self.state = self.state, state
+        headers = self.command_ids.headers()
+        self.lastSent = (headers[COMMAND_ID], headers[COMMAND_TIME])
         # Publish current state to message bus.
-        self.publish_json('userinput/state', {}, (prev_state, state))
+        self.publish_json('userinput/state', headers, (prev_state, state))
+
+    def refresh_flags(self):
+        '''Take the device flags from the control agent's state board, once it has caught up.'''
+        if self.board is None:
+            return
+        state = self.board.settled(*self.lastSent)
+        if state is not None:
+            self.dehumidifierOn = state['dehumidifier']
+            self.fanOn = state['fan']
+            self.autoOn = state['mode'] != 'manual'
 
     def handle_accept(self, ask_sock):
         '''Accept new connections.'''
@@ -145,63 +175,87 @@ class UserInAgent(PublishMixin, BaseAgent):
                 raise socket.error('disconnected')
             response = response.strip()     # strip() gets rid of end line character
             if response:
-                if response == 'kill':
-                    self.dehumidifierOn = False
-                    self.fanOn = False
-                    file.write("\n** Sending command to turn off the compressor and fan. **\n")
-                    self.change_state(response)
-                elif response == 'help':
-                    file.write("\n************************ Instructions ************************\n"
-                               "   Valid commands are...\n"
-                               "     | run fan | shed fan | run dehum | shed dehum | kill |\n"
-                               "   For help, type 'help'.\n"
-                               "************************ Instructions ************************\n")
-                elif self.dehumidifierOn is True:
-                    # The dehumidifier (compressor and fan) is currently turned on.
-                    if response == 'shed dehum':
-                        self.dehumidifierOn = False
-                        self.change_state(response)
-                    elif response == "run dehum":
-                        file.write("\n** SUCCESS ** - The dehumidifier is already running.\n")
-                    elif response == "run fan" or response == "shed fan":
-                        # 'run fan' or 'shed fan' was issued, but is not allowed when the dehumidifier is on.
-                        file.write("\n** FAILED ** - Turn off the dehumidifier before trying to control the fan.\n")
-                    else:
-                        file.write("\n** FAILED ** - You entered an invalid command. Valid commands are: \n"
-                                   "               | run fan | shed fan | run dehum | shed dehum |\n")
-                elif self.fanOn is True:
-                    # The fan is currently turned on.
-                    if response == "shed fan":
-                        self.fanOn = False
-                        self.change_state(response)
-                    elif response == "run fan":
-                        file.write("\n** SUCCESS ** - The fan is already running.\n")
-                    elif response == "run dehum" or response == "shed dehum":
-                        # 'run dehum' or 'shed dehum' was issued, but is not allowed when the fan is on.
-                        file.write("\n** FAILED ** - Turn off the fan before trying to control the dehumidifier.\n")
-                    else:
-                        file.write("\n** FAILED ** - You entered an invalid command. Valid commands are... \n"
-                                   "               | run fan | shed fan | run dehum | shed dehum | kill |\n")
+                refused = self.limiter.check(file.fileno(), response)
+                if refused is not None:
+                    file.write("\n** FAILED ** - Too many commands: {}. Wait a moment and try again.\n".format(refused))
                 else:
-                    # Everything is currently off.
-                    if response == "run dehum":
-                        self.dehumidifierOn = True
-                        self.change_state(response)
-                    elif response == "run fan":
-                        self.fanOn = True
-                        self.change_state(response)
-                    elif response == "shed dehum":
-                        file.write("\n** SUCCESS ** - The dehumidifier is already off.\n")
-                    elif response == "shed fan":
-                        file.write("\n** SUCCESS ** - The fan is already off.\n")
-                    else:
-                        file.write("\n** FAILED ** - You entered an invalid command. Valid commands are... \n"
-                                   "               | run fan | shed fan | run dehum | shed dehum | kill |\n")
+                    self.process_response(response, file)
             self.ask_input(file)
         except socket.error:
             _log.info('Connection {} disconnected'.format(file.fileno()))
+            self.limiter.forget(file.fileno())
             self.reactor.unregister(file)
 
+    def process_response(self, response, file):
+        '''Act on one command. Replies are written to file.'''
+        self.refresh_flags()
+        if response == 'kill':
+            self.dehumidifierOn = False
+            self.fanOn = False
+            self.autoOn = False
+            file.write("\n** Sending command to turn off the compressor and fan. **\n")
+            self.change_state(response)
+        elif response == 'auto' or response == 'schedule':
+            # The control agent's humidistat ('auto') or time-of-use schedule ('schedule')
+            # decides when to run the dehumidifier.
+            self.autoOn = True
+            file.write("\n** Sending command to control the dehumidifier from the humidity sensor. **\n")
+            self.change_state(response)
+        elif self.autoOn is True and response in ('run fan', 'shed fan', 'run dehum', 'shed dehum'):
+            # A manual command ends auto mode. The humidistat may have changed what is running,
+            # so send the command on and let the control agent decide what is allowed.
+            self.autoOn = False
+            self.dehumidifierOn = response == 'run dehum'
+            self.fanOn = response == 'run fan'
+            self.change_state(response)
+        elif response == 'help':
+            file.write("\n************************ Instructions ************************\n"
+                       "   Valid commands are...\n"
+                       "     | run fan | shed fan | run dehum | shed dehum | auto | schedule | kill |\n"
+                       "   For help, type 'help'.\n"
+                       "************************ Instructions ************************\n")
+        elif self.dehumidifierOn is True:
+            # The dehumidifier (compressor and fan) is currently turned on.
+            if response == 'shed dehum':
+                self.dehumidifierOn = False
+                self.change_state(response)
+            elif response == "run dehum":
+                file.write("\n** SUCCESS ** - The dehumidifier is already running.\n")
+            elif response == "run fan" or response == "shed fan":
+                # 'run fan' or 'shed fan' was issued, but is not allowed when the dehumidifier is on.
+                file.write("\n** FAILED ** - Turn off the dehumidifier before trying to control the fan.\n")
+            else:
+                file.write("\n** FAILED ** - You entered an invalid command. Valid commands are: \n"
+                           "               | run fan | shed fan | run dehum | shed dehum |\n")
+        elif self.fanOn is True:
+            # The fan is currently turned on.
+            if response == "shed fan":
+                self.fanOn = False
+                self.change_state(response)
+            elif response == "run fan":
+                file.write("\n** SUCCESS ** - The fan is already running.\n")
+            elif response == "run dehum" or response == "shed dehum":
+                # 'run dehum' or 'shed dehum' was issued, but is not allowed when the fan is on.
+                file.write("\n** FAILED ** - Turn off the fan before trying to control the dehumidifier.\n")
+            else:
+                file.write("\n** FAILED ** - You entered an invalid command. Valid commands are... \n"
+                           "               | run fan | shed fan | run dehum | shed dehum | kill |\n")
+        else:
+            # Everything is currently off.
+            if response == "run dehum":
+                self.dehumidifierOn = True
+                self.change_state(response)
+            elif response == "run fan":
+                self.fanOn = True
+                self.change_state(response)
+            elif response == "shed dehum":
+                file.write("\n** SUCCESS ** - The dehumidifier is already off.\n")
+            elif response == "shed fan":
+                file.write("\n** SUCCESS ** - The fan is already off.\n")
+            else:
+                file.write("\n** FAILED ** - You entered an invalid command. Valid commands are... \n"
+                           "               | run fan | shed fan | run dehum | shed dehum | kill |\n")
+
 
 def main(argv=sys.argv):
     '''Main method called to start the agent.'''
@@ -1,9 +1,24 @@
 # Configures GPIO pins automatically at startup
-#   - Enable GPIO P9.12 and P9.14 to be outputs and set low
+#   - Enable GPIO P9.12 and P9.14 to be outputs
 #   - Enable GPIO P9.15 and P9.16 to be inputs
+#   - Set P9.12 and P9.14 low, unless the dehumidifier control agent has a saved state.
+#     The agent then puts the outputs back the way they were when it starts (see reconcile() in
+#     DHControlAgent/dhcontrol/agent.py), so running this again doesn't stop a running compressor.
+#
+#   python dhsetup.py [path of the agent's state file]
+#
+# Pass the absolute "state_file" from the agent's config (dhsetup.service does); the agent runs in its own
+# working directory, so a relative path here would name a different file. bbcommon must be installed.
+
+import sys
 
 from bbio import *
 
+from bbcommon.statefile import StateFile
+
+# Saved state of the dehumidifier control agent ("state_file" in its config)
+stateFile = sys.argv[1] if len(sys.argv) > 1 else '/home/debian/startAtBoot/dhcontrol.state'
+
 # Assign GPIO address to variable
 portDehumWrite = GPIO1_28      # P9.12 on BeagleBone
 portFanWrite = GPIO1_18        # P9.14 on BeagleBone
@@ -16,6 +31,8 @@ pinMode(portFanWrite, OUTPUT)       # P9.14 on BeagleBone is output
 pinMode(portDehumRead, INPUT)       # P9.15 on BeagleBone is input
 pinMode(portFanRead, INPUT)         # P9.16 on BeagleBone is input
 
-# Initialize output GPIO pins to be off (low)
-digitalWrite(portDehumWrite, LOW)
-digitalWrite(portFanWrite, LOW)
\ No newline at end of file
+# Initialize output GPIO pins to be off (low), unless the agent will restore them. A file that is missing,
+# empty or damaged holds no state the agent would restore.
+if StateFile(stateFile).load() is None:
+    digitalWrite(portDehumWrite, LOW)
+    digitalWrite(portFanWrite, LOW)
@@ -0,0 +1,160 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# End-to-end throughput benchmark for the input agent -> control agent -> status chain.                  #
+# The real agent classes run on the in-process bus and GPIO from simbus.py. Each command is typed into   #
+# an input agent (as if it came from telnet), published on 'userinput/state', handled by the control     #
+# agents, and followed by their 'dhcontrol/status'/'LEDcontrol/status' messages. A command's latency is  #
+# the time until the bus is idle again.                                                                  #
+# Results (throughput, p50/p99 latency, CPU per message) are saved as JSON. Pass --compare with a        #
+# previous results file to print the change for each scenario.                                           #
+#                                                                                                        #
+#   python tools/bench_bus.py --commands 20000 --output bench.json                                      #
+#   python tools/bench_bus.py --output new.json --compare bench.json                                     #
+# ------------------------------------------------------------------------------------------------------ #
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import simbus
+
+
+perf_counter = getattr(time, 'perf_counter', time.time)
+process_time = getattr(time, 'process_time', time.clock if hasattr(time, 'clock') else time.time)
+
+# Scenario name -> (input agent, control agents, command cycle typed into the input agent).
+SCENARIOS = {
+    'dehum': ('AskAgent', ('DehumAgent',),
+              ('run dehum', 'status', 'shed dehum', 'run fan', 'shed fan', 'kill')),
+    'led': ('UIAgent', ('LEDAgent',),
+            ('green on', 'red on', 'status', 'green off', 'red off', 'kill')),
+    'dehum+control': ('AskAgent', ('DehumAgent', 'ControlAgent'),
+                      ('run dehum', 'status', 'shed dehum', 'run fan', 'shed fan', 'kill')),
+    'full': ('AskAgent', ('DehumAgent', 'LEDAgent', 'ControlAgent'),
+             ('run dehum', 'status', 'shed dehum', 'run fan', 'shed fan', 'kill')),
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_scenario(name, commands, warmup):
+    """ Type commands into the scenario's input agent and time each one until the bus is idle. """
+    input_name, control_names, cycle = SCENARIOS[name]
+    simbus.gpio.reset()
+    bus = simbus.SimBus()
+    for control_name in control_names:
+        simbus.spawn(bus, control_name)
+    # The limiter still runs (its cost is part of the chain) but never refuses the benchmark's commands.
+    unlimited = {'connection_rate': 1e9, 'connection_burst': 1e9, 'global_rate': 1e9, 'global_burst': 1e9}
+    input_agent = simbus.spawn(bus, input_name, {'address': ('127.0.0.1', 0), 'rate_limit': unlimited})
+    client = simbus.SimFile()
+
+    def send(command):
+        client.feed(command)
+        input_agent.handle_input(client)
+        bus.settle()
+
+    for i in range(warmup):
+        send(cycle[i % len(cycle)])
+    del client.output[:]
+
+    latencies = []
+    published = bus.published
+    gpio_ops = simbus.gpio.reads + simbus.gpio.writes
+    cpu_start = process_time()
+    wall_start = perf_counter()
+    for i in range(commands):
+        start = perf_counter()
+        send(cycle[i % len(cycle)])
+        latencies.append(perf_counter() - start)
+    wall = perf_counter() - wall_start
+    cpu = process_time() - cpu_start
+    messages = bus.published - published
+
+    latencies.sort()
+    return {
+        'input_agent': input_name,
+        'control_agents': list(control_names),
+        'commands': commands,
+        'messages': messages,
+        'gpio_ops': simbus.gpio.reads + simbus.gpio.writes - gpio_ops,
+        'wall_s': wall,
+        'commands_per_s': commands / wall if wall else 0.0,
+        'messages_per_s': messages / wall if wall else 0.0,
+        'latency_p50_us': percentile(latencies, 0.50) * 1e6,
+        'latency_p99_us': percentile(latencies, 0.99) * 1e6,
+        'latency_max_us': latencies[-1] * 1e6 if latencies else 0.0,
+        'cpu_per_message_us': cpu / messages * 1e6 if messages else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=simbus.REPO_DIR,
+                                       stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """ Print the relative change of each scenario against a previous results file. """
+    print('\n{:<16} {:>14} {:>14} {:>14}'.format('scenario', 'cmd/s', 'p99 us', 'cpu/msg us'))
+    for name, new in sorted(results['scenarios'].items()):
+        old = baseline.get('scenarios', {}).get(name)
+        if old is None:
+            continue
+        cells = []
+        for key in ('commands_per_s', 'latency_p99_us', 'cpu_per_message_us'):
+            change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            cells.append('{:+.1f}%'.format(change))
+        print('{:<16} {:>14} {:>14} {:>14}'.format(name, *cells))
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Benchmark the agent command chain on a simulated bus.')
+    parser.add_argument('--commands', type=int, default=10000, help='timed commands per scenario')
+    parser.add_argument('--warmup', type=int, default=500, help='untimed commands before measuring')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run (default: all)')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='agent logging level; INFO includes the cost of the agents\' log lines')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(stream=open(os.devnull, 'w'), level=getattr(logging, args.log_level.upper()))
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'log_level': args.log_level.upper(),
+        'scenarios': {},
+    }
+    print('{:<16} {:>10} {:>12} {:>10} {:>10} {:>12}'.format(
+        'scenario', 'cmd/s', 'msg/s', 'p50 us', 'p99 us', 'cpu/msg us'))
+    for name in args.scenario or sorted(SCENARIOS):
+        result = run_scenario(name, args.commands, args.warmup)
+        results['scenarios'][name] = result
+        print('{:<16} {:>10.0f} {:>12.0f} {:>10.1f} {:>10.1f} {:>12.2f}'.format(
+            name, result['commands_per_s'], result['messages_per_s'], result['latency_p50_us'],
+            result['latency_p99_us'], result['cpu_per_message_us']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Benchmark of the sensor filters in DHControlAgent/dhcontrol/filters.py: the NumPy BlockFilter against  #
+# the one-sample-at-a-time ScalarFilter, on a noisy humidity signal with spikes. The stream is split     #
+# into blocks of each requested size, and the block results are checked to be exactly equal to the       #
+# scalar results.                                                                                        #
+#                                                                                                        #
+#   python tools/bench_filters.py --samples 200000 --block 1 --block 10 --block 100 --output f.json     #
+# ------------------------------------------------------------------------------------------------------ #
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'DHControlAgent'))
+from dhcontrol import filters
+
+
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+
+def make_signal(samples, interval, seed):
+    """ Slowly varying humidity with gaussian noise and occasional large spikes. """
+    rng = random.Random(seed)
+    timestamps = [i * interval for i in range(samples)]
+    values = []
+    for i in range(samples):
+        value = 50.0 + 10.0 * math.sin(i / 5000.0) + rng.gauss(0.0, 0.8)
+        if rng.random() < 0.01:
+            value += rng.choice((-1, 1)) * rng.uniform(10.0, 40.0)
+        values.append(value)
+    return timestamps, values
+
+
+def run(filter_class, config, timestamps, values, block):
+    """ Filter the stream in blocks. Returns (filtered values, rates, seconds). """
+    stream_filter = filter_class(config)
+    filtered = []
+    rates = []
+    start = perf_counter()
+    for first in range(0, len(values), block):
+        block_filtered, block_rates = stream_filter.process(timestamps[first:first + block],
+                                                            values[first:first + block])
+        filtered.extend(block_filtered)
+        rates.extend(block_rates)
+    return filtered, rates, perf_counter() - start
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Compare block (NumPy) and scalar sensor filtering.')
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between samples')
+    parser.add_argument('--block', type=int, action='append', help='block size (repeatable)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args(argv[1:])
+
+    if not filters.load_numpy():
+        print('NumPy is not installed; only the scalar filter is available.')
+        return 1
+    config = dict(filters.FILTER_DEFAULTS)
+    timestamps, values = make_signal(args.samples, args.interval, args.seed)
+    scalar_filtered, scalar_rates, scalar_time = run(filters.ScalarFilter, config, timestamps, values,
+                                                     args.samples)
+    results = {'samples': args.samples, 'config': config,
+               'scalar_samples_per_s': args.samples / scalar_time, 'blocks': {}}
+    print('scalar            {:>12.0f} samples/s'.format(results['scalar_samples_per_s']))
+    exact = True
+    for block in args.block or [1, 10, 100, 1000]:
+        filtered, rates, block_time = run(filters.BlockFilter, config, timestamps, values, block)
+        match = (list(map(float, filtered)) == scalar_filtered and list(map(float, rates)) == scalar_rates)
+        exact = exact and match
+        results['blocks'][block] = {'samples_per_s': args.samples / block_time,
+                                    'speedup': scalar_time / block_time, 'exact': match}
+        print('block {:<6}      {:>12.0f} samples/s  {:>6.2f}x  {}'.format(
+            block, args.samples / block_time, scalar_time / block_time, 'exact' if match else 'MISMATCH'))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 0 if exact else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
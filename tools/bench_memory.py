@@ -0,0 +1,94 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Resident memory of the agents run as separate processes against the same agents hosted in one        #
+# HostAgent process, on the simulated bus (simbus.py). Each process starts its agent(s), runs setup()    #
+# and reports VmRSS from /proc.                                                                          #
+# The simulated VOLTTRON and zmq modules are tiny, so the per-process saving measured here is only the   #
+# interpreter and the agents' own modules. --preload imports real modules (e.g. zmq, numpy) in every     #
+# process first, to stand in for the libraries each agent process loads on the BeagleBone.               #
+#                                                                                                        #
+#   python tools/bench_memory.py --agent DehumAgent --agent LEDAgent --agent AskAgent --preload zmq      #
+# ------------------------------------------------------------------------------------------------------ #
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_AGENTS = ['DehumAgent', 'LEDAgent', 'AskAgent']
+
+
+def agent_config(simbus, name):
+    """ Config for name with nothing written to the working directory and the sensor off. """
+    config = simbus.CONFIGS[name]
+    config = simbus.load_config(config) if config is not None else {'address': ('127.0.0.1', 0)}
+    if name in ('DehumAgent', 'LEDAgent'):
+        config['state_file'] = simbus._temp_path('.state')
+    if 'sensor' in config:
+        config['sensor'] = dict(config['sensor'], enabled=False)
+    return config
+
+
+def child(names, hosted, preload):
+    """ Start the agents in this process and print its resident memory in kB. """
+    for module in preload:
+        importlib.import_module(module)
+    sys.path.insert(0, TOOLS_DIR)
+    import simbus
+    simbus.install()
+    from host.agent import resident_memory
+    bus = simbus.SimBus()
+    if hosted:
+        entries = []
+        for name in names:
+            directory, module_name = simbus.AGENTS[name]
+            entries.append({'class': module_name + '.' + name,
+                            'config': simbus._write_config(agent_config(simbus, name))})
+        simbus.spawn(bus, 'HostAgent', {'agentid': 'Host', 'message': 'Memory benchmark', 'agents': entries})
+    else:
+        for name in names:
+            simbus.spawn(bus, name, agent_config(simbus, name))
+    print(json.dumps({'resident_kb': resident_memory()}))
+
+
+def run(names, hosted, preload):
+    command = [sys.executable, os.path.abspath(__file__), '--child'] + ['--agent=' + name for name in names]
+    command += ['--preload=' + module for module in preload] + (['--hosted'] if hosted else [])
+    output = subprocess.check_output(command, stderr=open(os.devnull, 'w'))
+    return json.loads(output.decode().strip().splitlines()[-1])['resident_kb']
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Compare resident memory of separate and hosted agents.')
+    parser.add_argument('--agent', action='append', help='agent to run (repeatable; default: {})'.format(
+        ', '.join(DEFAULT_AGENTS)))
+    parser.add_argument('--preload', action='append', default=[], help='module every process imports first')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--hosted', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+    names = args.agent or DEFAULT_AGENTS
+    if args.child:
+        child(names, args.hosted, args.preload)
+        return 0
+
+    separate = dict((name, run([name], False, args.preload)) for name in names)
+    hosted = run(names, True, args.preload)
+    for name in names:
+        print('{:<28}{:>10} kB'.format(name + ' (own process)', separate[name]))
+    total = sum(separate.values())
+    print('{:<28}{:>10} kB'.format('total, separate processes', total))
+    print('{:<28}{:>10} kB'.format('HostAgent, one process', hosted))
+    print('{:<28}{:>10} kB ({:.0f}%)'.format('saving', total - hosted, 100.0 * (total - hosted) / total))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'preload': args.preload, 'separate_kb': separate, 'separate_total_kb': total,
+                       'hosted_kb': hosted}, output, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
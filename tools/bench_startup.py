@@ -0,0 +1,132 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Start-up benchmark for the agents, on the simulated bus (simbus.py). Each agent is started --repeat     #
+# times, each time in a fresh Python process, and the median of each stage is reported:                 #
+#   import   - importing the agent module                                                                #
+#   joined   - the agent has joined the bus (BaseAgent.setup() has subscribed it)                        #
+#   ready    - setup() has finished: pins set up, timers started                                         #
+#   command  - a 'status' command has been handled                                                       #
+#   process  - the whole process, interpreter start-up included, measured from outside                   #
+# --bbio-delay makes importing the fake bbio take that long, standing in for bbio's hardware probing on  #
+# the BeagleBone, to show which stage pays for it. The report also lists the heavy modules (bbio, numpy) #
+# already imported once the agent module has been imported.                                             #
+#                                                                                                        #
+#   python tools/bench_startup.py --repeat 5 --bbio-delay 2 --output startup.json                        #
+# ------------------------------------------------------------------------------------------------------ #
+import argparse
+import importlib
+import importlib.abc
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ('bbio', 'numpy')
+STAGES = ('import', 'joined', 'ready', 'command', 'process')
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+
+class SlowImport(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """ Serves module after sleeping delay seconds, the first time it is imported. """
+
+    def __init__(self, module, delay):
+        self.module = module
+        self.delay = delay
+
+    def find_spec(self, name, path, target=None):
+        if name == self.module.__name__:
+            return importlib.util.spec_from_loader(name, self)
+        return None
+
+    def create_module(self, spec):
+        time.sleep(self.delay)
+        return self.module
+
+    def exec_module(self, module):
+        pass
+
+
+def child(name, bbio_delay):
+    """ Start one agent in this process and print the time each stage finished, in ms. """
+    start = perf_counter()
+    sys.path.insert(0, TOOLS_DIR)
+    import simbus
+    simbus.install()
+    if bbio_delay:
+        sys.meta_path.insert(0, SlowImport(sys.modules.pop('bbio'), bbio_delay))
+        # spawn() would otherwise install a fresh (fast) fake bbio.
+        simbus.install = lambda: None
+    times = {}
+    base_setup = simbus.BaseAgent.setup
+
+    def setup(agent):
+        base_setup(agent)
+        times.setdefault('joined', perf_counter())
+    simbus.BaseAgent.setup = setup
+
+    directory, module_name = simbus.AGENTS[name]
+    importlib.import_module(module_name)
+    times['import'] = perf_counter()
+    loaded = [module for module in HEAVY_MODULES if module in sys.modules]
+    bus = simbus.SimBus()
+    simbus.spawn(bus, name)
+    times['ready'] = perf_counter()
+    bus.publish('userinput/state', {}, [json.dumps(['status', 'status'])])
+    bus.settle()
+    times['command'] = perf_counter()
+    print(json.dumps({'times': dict((stage, (t - start) * 1000.0) for stage, t in times.items()),
+                      'loaded_at_import': loaded}))
+
+
+def run(name, bbio_delay):
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, '--bbio-delay', str(bbio_delay)]
+    start = perf_counter()
+    output = subprocess.check_output(command, stderr=open(os.devnull, 'w'))
+    elapsed = (perf_counter() - start) * 1000.0
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result['times']['process'] = elapsed
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Measure agent import and start-up times.')
+    parser.add_argument('--agent', action='append', help='agent to start (repeatable; default: all)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--bbio-delay', type=float, default=0.0, help='seconds importing bbio takes')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+    if args.child:
+        child(args.child, args.bbio_delay)
+        return 0
+
+    sys.path.insert(0, TOOLS_DIR)
+    import simbus
+    results = {'bbio_delay': args.bbio_delay, 'agents': {}}
+    print('{:<14}'.format('agent (ms)') + ''.join('{:>10}'.format(stage) for stage in STAGES) +
+          '  imported with the module')
+    for name in args.agent or sorted(simbus.AGENTS):
+        runs = [run(name, args.bbio_delay) for _ in range(args.repeat)]
+        medians = dict((stage, median([result['times'][stage] for result in runs])) for stage in STAGES)
+        loaded = runs[0]['loaded_at_import']
+        results['agents'][name] = {'median_ms': medians, 'loaded_at_import': loaded}
+        print('{:<14}'.format(name) + ''.join('{:>10.1f}'.format(medians[stage]) for stage in STAGES) +
+              '  ' + (', '.join(loaded) or '-'))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
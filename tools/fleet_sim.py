@@ -0,0 +1,199 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Runs FleetAgent against a simulated fleet on the simulated bus (simbus.py), with a virtual clock.        #
+#   - --units synthetic units publish heartbeat deltas (compressor and fan switching, degraded and        #
+#     recovered, deferred), full heartbeats every 300 seconds and metrics every 60 seconds under          #
+#     fleet/unit/<unit>/. A few go silent half way through, to be marked offline.                         #
+#   - --boards real DehumAgents each run on a bus of their own, as unit board-<n>. Each republishes its  #
+#     topics under fleet/unit/board-<n>/, and those are carried over to the fleet bus, as the platforms' #
+#     forwarder would.                                                                                   #
+# At the end it runs the usual queries on the fleet agent's index, checks each answer against a scan of  #
+# every record, and prints how long each took both ways, the memory per unit and one query sent over     #
+# the bus.                                                                                               #
+#                                                                                                        #
+#   python tools/fleet_sim.py --units 5000 --boards 2 --hours 2                                          #
+# ------------------------------------------------------------------------------------------------------ #
+import argparse
+import json
+import random
+import sys
+import timeit
+import tracemalloc
+
+import simbus
+
+
+STEP = 10.0                     # simulated seconds between rounds of synthetic messages
+
+
+class SyntheticUnit(object):
+    """ The state a unit reports, changed at random. """
+
+    def __init__(self, name, rng):
+        self.name = name
+        self.state = {'dehum': 'OFF', 'fan': 'OFF', 'mode': rng.choice(['manual', 'auto', 'schedule']),
+                      'dr': False, 'deferred': False, 'degraded': []}
+        self.run_hours = rng.uniform(0, 5000)
+        self.starts = rng.randint(0, 2000)
+        self.silent = False
+
+    def change(self, rng):
+        """ Change one thing at random. Returns the heartbeat delta. """
+        roll = rng.random()
+        if roll < 0.6:
+            self.state['dehum'] = 'OFF' if self.state['dehum'] == 'ON' else 'ON'
+            self.starts += self.state['dehum'] == 'ON'
+            delta = {'dehum': self.state['dehum']}
+        elif roll < 0.8:
+            self.state['fan'] = 'OFF' if self.state['fan'] == 'ON' else 'ON'
+            delta = {'fan': self.state['fan']}
+        elif roll < 0.9:
+            self.state['deferred'] = not self.state['deferred']
+            delta = {'deferred': self.state['deferred']}
+        else:
+            self.state['degraded'] = [] if self.state['degraded'] else ['dehumidifier']
+            delta = {'degraded': self.state['degraded']}
+        return delta
+
+
+def publish(bus, unit, topic, message):
+    bus.publish('fleet/unit/{}/{}'.format(unit, topic), {}, [json.dumps(message)])
+
+
+def timed(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat)) * 1e6
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Run the fleet agent against a simulated fleet.')
+    parser.add_argument('--units', type=int, default=2000, help='synthetic units (default 2000)')
+    parser.add_argument('--boards', type=int, default=2, help='real DehumAgent boards (default 2)')
+    parser.add_argument('--hours', type=float, default=1.0, help='simulated hours (default 1)')
+    parser.add_argument('--changes', type=float, default=0.02,
+                        help='chance each unit changes something in each %g-second step (default 0.02)' % STEP)
+    parser.add_argument('--silent', type=float, default=0.02,
+                        help='fraction of units that go silent half way through (default 0.02)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv[1:])
+    rng = random.Random(args.seed)
+
+    clock = simbus.VirtualClock()
+    simbus.use_clock(clock)
+    simbus.install()
+    bus = simbus.SimBus(clock)
+    fleet_agent = simbus.spawn(bus, 'FleetAgent', dict(simbus.load_config(simbus.CONFIGS['FleetAgent']),
+                                                       fleet=dict(max_units=args.units + args.boards + 10)))
+    fleet = fleet_agent.fleet
+
+    boards = []
+    for number in range(args.boards):
+        board_bus = simbus.SimBus(clock)
+        config = simbus.load_config(simbus.CONFIGS['DehumAgent'])
+        config['sensor'] = dict(config['sensor'], enabled=False)
+        config['state_board'] = {'enabled': False}
+        config['fleet'] = dict(config.get('fleet', {}), enabled=True, unit='board-{}'.format(number))
+        # The board's agent forwards its topics under fleet/unit/; carry them over to the fleet's bus, as the
+        # platforms' forwarder would.
+        board_bus.taps.append(lambda now, topic, headers, message: topic.startswith('fleet/unit/') and
+                              bus.publish(topic, headers, message))
+        simbus.spawn(board_bus, 'DehumAgent', config)
+        board_bus.publish('userinput/state', {}, [json.dumps([None, 'run dehum'])])
+        boards.append(board_bus)
+
+    units = [SyntheticUnit('unit-{:05d}'.format(number), rng) for number in range(args.units)]
+    steps = int(args.hours * 3600.0 / STEP)
+    start = clock.now()
+    wall_start = simbus._wall_time()
+    for step in range(steps):
+        now = start + (step + 1) * STEP
+        if step == steps // 2:
+            for unit in rng.sample(units, int(len(units) * args.silent)):
+                unit.silent = True
+        for number, unit in enumerate(units):
+            if unit.silent:
+                continue
+            if step % 30 == number % 30:
+                publish(bus, unit.name, 'dhcontrol/heartbeat', {'type': 'full', 'state': unit.state})
+            elif rng.random() < args.changes:
+                publish(bus, unit.name, 'dhcontrol/heartbeat', {'type': 'delta', 'state': unit.change(rng)})
+            if step % 6 == number % 6:
+                if unit.state['dehum'] == 'ON':
+                    unit.run_hours += 60.0 / 3600.0
+                publish(bus, unit.name, 'dhcontrol/metrics', {'run_hours': round(unit.run_hours, 4),
+                                                              'starts': unit.starts,
+                                                              'humidity': round(rng.uniform(35, 70), 1)})
+        for board_bus in boards:
+            board_bus.run_until(now)
+        bus.run_until(now)
+    wall = simbus._wall_time() - wall_start
+
+    records = list(fleet.units.values())
+    queries = [
+        ('compressor ON', {'where': {'dehum': 'ON'}},
+         lambda: [r for r in records if r.get('dehum') == 'ON']),
+        ('degraded', {'where': {'degraded': True}},
+         lambda: [r for r in records if r.get('degraded') is True]),
+        ('offline', {'where': {'online': False}},
+         lambda: [r for r in records if r.get('online') is False]),
+        ('top 10 run hours', {'top': {'field': 'run_hours', 'count': 10}},
+         lambda: sorted((r for r in records if 'run_hours' in r),
+                        key=lambda r: (r['run_hours'], r['unit']), reverse=True)[:10]),
+        ('top 10 run hours, ON and not degraded',
+         {'where': {'dehum': 'ON', 'degraded': False}, 'top': {'field': 'run_hours', 'count': 10}},
+         lambda: sorted((r for r in records if 'run_hours' in r and r.get('dehum') == 'ON'
+                         and r.get('degraded') is False),
+                        key=lambda r: (r['run_hours'], r['unit']), reverse=True)[:10]),
+    ]
+    print('{:<20}{}'.format('units', len(fleet)))
+    print('{:<20}{}'.format('messages', bus.published))
+    print('{:<20}{:.2f}'.format('wall_seconds', wall))
+    print('{:<20}{:.1f}'.format('us_per_message', wall * 1e6 / max(1, bus.published)))
+    print('')
+    print('{:<40}{:>8}{:>12}{:>12}  {}'.format('query', 'matches', 'index us', 'scan us', 'same'))
+    mismatches = 0
+    for name, request, scan in queries:
+        answer = fleet.query(request.get('where'), request.get('top'))
+        expected = scan()
+        if 'top' in request:
+            same = [r['unit'] for r in answer['units']] == [r['unit'] for r in expected]
+        else:
+            # The answer lists max_results of the matches.
+            names = set(r['unit'] for r in answer['units'])
+            same = (answer['count'] == len(expected) and names <= set(r['unit'] for r in expected)
+                    and len(names) == min(len(expected), int(fleet.config['max_results'])))
+        mismatches += not same
+        index_us = timed(lambda: fleet.query(request.get('where'), request.get('top')), 20)
+        scan_us = timed(scan, 5)
+        print('{:<40}{:>8}{:>12.1f}{:>12.1f}  {}'.format(name, answer['count'], index_us, scan_us,
+                                                          'yes' if same else 'NO'))
+
+    # Memory: the records and indexes, rebuilt from the final records under tracemalloc.
+    from bbcommon.fleet import FleetIndex, translate
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    copy = FleetIndex(fleet.config)
+    for record in records:
+        copy.update(record['unit'], dict((k, v) for k, v in record.items() if k not in ('unit', 'seen')),
+                    record['seen'])
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print('')
+    print('{:<20}{:.0f}'.format('bytes_per_unit', used / float(max(1, len(records)))))
+
+    # One query over the bus, as another agent would send it.
+    replies = []
+    bus.taps.append(lambda now, topic, headers, message: topic == 'fleet/reply/fleet_sim' and
+                    replies.append(json.loads(message[0])))
+    bus.publish('fleet/query', {}, [json.dumps({'where': {'degraded': True}, 'top': {'field': 'run_hours',
+                                                                                      'count': 3},
+                                                'reply_to': 'fleet/reply/fleet_sim'})])
+    bus.pump()
+    print('{:<20}{}'.format('bus_query', json.dumps([(r['unit'], r['run_hours']) for r in replies[0]['units']])
+                            if replies else 'no reply'))
+    boards_seen = [record['unit'] for record in records if record['unit'].startswith('board-')]
+    print('{:<20}{}'.format('boards', ', '.join('{} ({} run hours, dehum {})'.format(
+        unit, fleet.units[unit].get('run_hours'), fleet.units[unit].get('dehum')) for unit in sorted(boards_seen))))
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Replays a recorded stream of bus messages through the real control agents on the simulated bus and    #
+# GPIO from simbus.py, then compares what the agents published with what was recorded.                   #
+#                                                                                                        #
+# A recording has one JSON object per line:                                                              #
+#   {"time": 1400000000.5, "topic": "userinput/state", "headers": {}, "message": ["[\"all off\", \"run dehum\"]"]}
+# "message" holds the raw message frames, exactly as publish_json() sent them.                          #
+# Messages on the input topics (default 'userinput/') are published at their recorded times. Every other #
+# recorded message is what the agents are expected to publish; those are compared topic by topic, in     #
+# order, with what the agents published during the replay. Only the topics that appear in the recording  #
+# are compared (so a recording of just dhcontrol/status checks just that), or the topics under the       #
+# --topic prefixes if any are given. Heartbeats are never compared, and fields that hold times or        #
+# latencies (VOLATILE_FIELDS) are left out, since they differ from run to run.                           #
+#                                                                                                        #
+#   python tools/replay.py incident.jsonl                      # as fast as possible                     #
+#   python tools/replay.py incident.jsonl --speed 1            # original speed                          #
+#   python tools/replay.py incident.jsonl --speed 10 --agent DehumAgent --agent LEDAgent                 #
+#   python tools/replay.py incident.jsonl --record result.jsonl                                          #
+#   python tools/replay.py incident.jsonl --topic dhcontrol/status --topic LEDcontrol/status             #
+# The exit status is 1 if any topic differs from the recording.                                          #
+# ------------------------------------------------------------------------------------------------------ #
+import argparse
+import json
+import logging
+import sys
+import time
+from collections import defaultdict
+
+import simbus
+
+
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+# Topics (by suffix) left out of the comparison: heartbeats are periodic, so when they fall depends on
+# when the agent started, and they carry sequence numbers and times.
+IGNORED_TOPICS = ('/heartbeat',)
+
+# Fields of JSON object frames left out of the comparison, by topic suffix.
+VOLATILE_FIELDS = {
+    '/kill': ('latency', 'end_to_end', 'p50', 'p99', 'max'),
+    '/metrics': ('time',),
+}
+
+
+def load_recording(path):
+    """ Read a recording, sorted by time (stable, so messages with equal times keep their order). """
+    records = []
+    with open(path) as recording:
+        for number, line in enumerate(recording, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                record = json.loads(line)
+                records.append((float(record['time']), record['topic'],
+                                record.get('headers') or {}, list(record['message'])))
+            except (ValueError, KeyError, TypeError) as error:
+                raise ValueError('{}:{}: bad record ({})'.format(path, number, error))
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+def decode(topic, message):
+    """ Decode message frames for comparison; frames that are not JSON are compared as text. The topic's
+        volatile fields are dropped from JSON objects. """
+    volatile = ()
+    for suffix, fields in VOLATILE_FIELDS.items():
+        if topic.endswith(suffix):
+            volatile += fields
+    decoded = []
+    for frame in message:
+        try:
+            frame = json.loads(frame)
+        except ValueError:
+            pass
+        if isinstance(frame, dict) and volatile:
+            frame = dict((key, value) for key, value in frame.items() if key not in volatile)
+        decoded.append(frame)
+    return decoded
+
+
+def replay(records, agents, input_prefixes, speed=None, settle=10.0):
+    """ Publish the input records through the agents. Returns (published records, wall time in seconds).
+
+        speed=None runs on a virtual clock as fast as possible; otherwise simulated time runs speed
+        times faster than real time. settle is how long (simulated) to keep running after the last
+        input so delayed actions still happen. """
+    start = records[0][0] if records else simbus.time.time()
+    if speed is None:
+        clock = simbus.VirtualClock(start)
+    else:
+        clock = simbus.ScaledClock(start, speed)
+    simbus.use_clock(clock)
+    simbus.gpio.reset()
+    bus = simbus.SimBus(clock)
+    published = []
+    bus.taps.append(lambda t, topic, headers, message: published.append((t, topic, headers, message)))
+    try:
+        for name in agents:
+            simbus.spawn(bus, name)
+        # Anything published while the agents start up is not part of the comparison.
+        del published[:]
+        wall_start = perf_counter()
+        for t, topic, headers, message in records:
+            if topic.startswith(input_prefixes):
+                bus.run_until(t)
+                bus.publish(topic, headers, message)
+                bus.pump()
+        end = records[-1][0] + settle if records else start
+        bus.run_until(end)
+        wall = perf_counter() - wall_start
+    finally:
+        simbus.use_clock(simbus.RealClock())
+    return published, wall
+
+
+def compare(recorded, replayed, input_prefixes, topics=None, limit=10):
+    """ Compare output messages topic by topic. Returns {topic: (matched, [differences])}.
+
+        topics is a tuple of topic prefixes to compare; None compares the topics in the recording. """
+    def output(topic):
+        return not topic.startswith(input_prefixes) and not topic.endswith(IGNORED_TOPICS)
+
+    expected = defaultdict(list)
+    actual = defaultdict(list)
+    for t, topic, headers, message in recorded:
+        if output(topic) and (topics is None or topic.startswith(topics)):
+            expected[topic].append((t, decode(topic, message)))
+    for t, topic, headers, message in replayed:
+        if output(topic) and (topic in expected if topics is None else topic.startswith(topics)):
+            actual[topic].append((t, decode(topic, message)))
+
+    report = {}
+    for topic in sorted(set(expected) | set(actual)):
+        want, got = expected[topic], actual[topic]
+        matched = 0
+        differences = []
+        for index in range(max(len(want), len(got))):
+            want_message = want[index][1] if index < len(want) else None
+            got_message = got[index][1] if index < len(got) else None
+            if want_message == got_message:
+                matched += 1
+            elif len(differences) < limit:
+                differences.append((index, want_message, got_message))
+            else:
+                differences.append(None)
+        report[topic] = (matched, differences)
+    return report
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Replay a recorded bus stream through the control agents.')
+    parser.add_argument('recording', help='JSON lines file of recorded bus messages')
+    parser.add_argument('--agent', action='append', choices=sorted(simbus.AGENTS),
+                        help='agent to run (repeatable, default: DehumAgent)')
+    parser.add_argument('--speed', default='max',
+                        help="'max' for as fast as possible, or how many times faster than real time")
+    parser.add_argument('--input', action='append', dest='inputs',
+                        help="topic prefix treated as input (repeatable, default: 'userinput/')")
+    parser.add_argument('--topic', action='append', dest='topics',
+                        help='topic prefix to compare (repeatable, default: the topics in the recording)')
+    parser.add_argument('--settle', type=float, default=10.0,
+                        help='simulated seconds to keep running after the last input')
+    parser.add_argument('--record', help='write the replayed stream (inputs and outputs) to this file')
+    parser.add_argument('--log-level', default='WARNING', help='agent logging level')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    speed = None if args.speed == 'max' else float(args.speed)
+    input_prefixes = tuple(args.inputs or ['userinput/'])
+    records = load_recording(args.recording)
+    inputs = sum(1 for record in records if record[1].startswith(input_prefixes))
+
+    replayed, wall = replay(records, args.agent or ['DehumAgent'], input_prefixes, speed, args.settle)
+
+    if args.record:
+        with open(args.record, 'w') as output:
+            for t, topic, headers, message in replayed:
+                output.write(json.dumps({'time': t, 'topic': topic, 'headers': headers,
+                                         'message': message}) + '\n')
+
+    report = compare(records, replayed, input_prefixes, tuple(args.topics) if args.topics else None)
+    print('Replayed {} input messages in {:.3f} s ({:.0f} inputs/s), {} messages published.'.format(
+        inputs, wall, inputs / wall if wall else 0.0, len(replayed)))
+    diverged = False
+    for topic, (matched, differences) in sorted(report.items()):
+        print('{:<24} {:>6} matched {:>6} differ'.format(topic, matched, len(differences)))
+        for difference in differences:
+            if difference is None:
+                print('    ...')
+                break
+            index, want, got = difference
+            print('    #{}: recorded {} replayed {}'.format(index, json.dumps(want), json.dumps(got)))
+        diverged = diverged or bool(differences)
+    return 1 if diverged else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
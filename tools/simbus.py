@@ -0,0 +1,517 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# In-process stand-ins for the VOLTTRON message bus and the bbio GPIO library.                           #
+# install() puts fake 'volttron', 'zmq' and 'bbio' modules into sys.modules, so the real agent classes   #
+# (AskAgent, UIAgent, UserInAgent, DehumAgent, LEDAgent, ControlAgent) can be imported and run on a      #
+# laptop. Messages published by one agent are queued on a SimBus and delivered to every subscribed       #
+# agent when the bus is pumped. Timers run on a shared SimReactor, against either the real clock or a    #
+# virtual clock that only moves when the simulation advances it.                                         #
+# The simulated GPIO wires each feedback (input) pin to its output pin, like the relay board does.       #
+# ------------------------------------------------------------------------------------------------------ #
+import atexit
+import heapq
+import itertools
+import json
+import os
+import re
+import select
+import shutil
+import sys
+import tempfile
+import time
+import types
+from collections import deque
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Directory holding each agent package, and the module/class of the agent inside it.
+AGENTS = {
+    'AskAgent': ('UserInputAgent', 'userinput.agent'),
+    'UserInAgent': ('UserInAgent', 'userin.agent'),
+    'UIAgent': ('UIAgent', 'ui.agent'),
+    'DehumAgent': ('DHControlAgent', 'dhcontrol.agent'),
+    'LEDAgent': ('LEDAgent', 'led.agent'),
+    'ControlAgent': ('ControlAgent', 'control.agent'),
+    'HostAgent': ('HostAgent', 'host.agent'),
+    'ShadowAgent': ('ShadowAgent', 'shadow.agent'),
+    'CacheAgent': ('CacheAgent', 'cache.agent'),
+    'FleetAgent': ('FleetAgent', 'fleet.agent'),
+}
+
+# Config file shipped with each agent (None means the agent runs on its built-in defaults).
+CONFIGS = {
+    'AskAgent': None,
+    'UserInAgent': None,
+    'UIAgent': None,
+    'DehumAgent': os.path.join(REPO_DIR, 'DHControlAgent', 'config'),
+    'LEDAgent': os.path.join(REPO_DIR, 'LEDAgent', 'config'),
+    'ControlAgent': os.path.join(REPO_DIR, 'ControlAgent', 'config'),
+    'HostAgent': os.path.join(REPO_DIR, 'HostAgent', 'config'),
+    'ShadowAgent': os.path.join(REPO_DIR, 'ShadowAgent', 'config'),
+    'CacheAgent': os.path.join(REPO_DIR, 'CacheAgent', 'config'),
+    'FleetAgent': os.path.join(REPO_DIR, 'FleetAgent', 'config'),
+}
+
+
+# ---------------------------------------------- CLOCKS ---------------------------------------------- #
+# Saved before use_clock() can replace time.time.
+_wall_time = time.time
+
+
+class RealClock(object):
+    """ Wall clock time. Timers fire when their deadline has actually passed. """
+    virtual = False
+
+    def now(self):
+        return _wall_time()
+
+    def wait_until(self, t):
+        delay = t - self.now()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ScaledClock(object):
+    """ Simulated time that runs speed times faster than the wall clock, starting at start. """
+    virtual = False
+
+    def __init__(self, start, speed):
+        self.start = float(start)
+        self.speed = float(speed)
+        self._wall_start = _wall_time()
+
+    def now(self):
+        return self.start + (_wall_time() - self._wall_start) * self.speed
+
+    def wait_until(self, t):
+        delay = (t - self.now()) / self.speed
+        if delay > 0:
+            time.sleep(delay)
+
+
+class VirtualClock(object):
+    """ Simulated time. It only moves when the simulation calls advance_to(). """
+    virtual = True
+
+    def __init__(self, start=None):
+        self._now = _wall_time() if start is None else float(start)
+
+    def now(self):
+        return self._now
+
+    def advance_to(self, t):
+        if t > self._now:
+            self._now = t
+
+    wait_until = advance_to
+
+
+def use_clock(clock):
+    """ Make time.time() report clock's time, so agent code that reads the time follows the simulation. """
+    time.time = _wall_time if isinstance(clock, RealClock) else clock.now
+
+
+# ---------------------------------------------- REACTOR ---------------------------------------------- #
+class SimTimer(object):
+    """ Handle returned by BaseAgent.timer()/periodic_timer(). Call cancel() to stop it. """
+
+    def __init__(self, deadline, function, args, kwargs, period=None):
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.period = period
+        self.canceled = False
+
+    def cancel(self):
+        self.canceled = True
+
+
+class SimReactor(object):
+    """ Replaces the agent reactor: keeps registered file objects and a deadline-ordered timer heap. Registered
+        objects with a real file descriptor (not SimFiles) are polled by poll(). """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.registered = {}
+        self.pollable = []
+        self._timers = []
+        self._seq = itertools.count()
+
+    def register(self, fd, callback, flags=None):
+        self.registered[fd] = callback
+        if not isinstance(fd, SimFile):
+            self.pollable.append(fd)
+
+    def unregister(self, fd):
+        self.registered.pop(fd, None)
+        if fd in self.pollable:
+            self.pollable.remove(fd)
+
+    def poll(self):
+        """ Call back each pollable object that is readable now, without waiting. """
+        readable = select.select(self.pollable, [], [], 0)[0]
+        for fd in readable:
+            self.registered[fd](fd)
+        return len(readable)
+
+    def add_timer(self, timer):
+        heapq.heappush(self._timers, (timer.deadline, next(self._seq), timer))
+        return timer
+
+    def next_deadline(self):
+        """ Deadline of the earliest live timer, or None if no timer is pending. """
+        while self._timers and self._timers[0][2].canceled:
+            heapq.heappop(self._timers)
+        return self._timers[0][0] if self._timers else None
+
+    def run_due(self, now):
+        """ Run every timer whose deadline is at or before now. Returns the number of timers run. """
+        count = 0
+        while self._timers and self._timers[0][0] <= now:
+            deadline, _, timer = heapq.heappop(self._timers)
+            if timer.canceled:
+                continue
+            if timer.period is not None:
+                timer.deadline = deadline + timer.period
+                self.add_timer(timer)
+            timer.function(*timer.args, **timer.kwargs)
+            count += 1
+        return count
+
+
+# ---------------------------------------------- BUS ---------------------------------------------- #
+class SimBus(object):
+    """ Publish/subscribe bus shared by every agent spawned on it. """
+
+    def __init__(self, clock=None):
+        self.clock = clock or RealClock()
+        self.reactor = SimReactor(self.clock)
+        self.agents = []
+        self.published = 0
+        self.delivered = 0
+        # Callables called as tap(time, topic, headers, message) for every published message.
+        self.taps = []
+        self._subscriptions = []
+        self._queue = deque()
+
+    def subscribe(self, test, callback):
+        self._subscriptions.append((test, callback))
+
+    def publish(self, topic, headers, message):
+        self.published += 1
+        for tap in self.taps:
+            tap(self.clock.now(), topic, headers, message)
+        self._queue.append((topic, headers, message))
+
+    def pump(self):
+        """ Deliver queued messages (and anything they cause to be published) until the bus is idle. """
+        count = 0
+        if self.reactor.pollable:
+            self.reactor.poll()
+        while self._queue:
+            topic, headers, message = self._queue.popleft()
+            for test, callback in self._subscriptions:
+                match = test(topic)
+                if match:
+                    callback(topic, dict(headers), message, match)
+                    count += 1
+        self.delivered += count
+        return count
+
+    def spawn(self, cls, config_path=None, setup=True, **kwargs):
+        """ Create an agent connected to this bus and (optionally) run its setup(). """
+        agent = cls(config_path, bus=self, **kwargs)
+        self.agents.append(agent)
+        if setup:
+            agent.setup()
+            self.pump()
+        return agent
+
+    def run_until(self, t):
+        """ Fire timers and deliver messages up to time t. The virtual clock jumps between deadlines. """
+        while True:
+            self.pump()
+            deadline = self.reactor.next_deadline()
+            if deadline is None or deadline > t:
+                break
+            self.clock.wait_until(deadline)
+            self.reactor.run_due(deadline)
+        self.clock.wait_until(t)
+        self.pump()
+
+    def settle(self):
+        """ Deliver messages and fire the timers already due (a dispatcher's zero-delay timer) until the bus is
+            idle, without moving the clock on. """
+        while True:
+            self.pump()
+            deadline = self.reactor.next_deadline()
+            now = self.clock.now()
+            if deadline is None or deadline > now:
+                break
+            self.reactor.run_due(now)
+
+    def run_for(self, seconds):
+        self.run_until(self.clock.now() + seconds)
+
+
+class SimFile(object):
+    """ Stands in for the socket file an input agent reads commands from. """
+    _fds = itertools.count(1000)
+
+    def __init__(self):
+        self.lines = deque()
+        self.output = []
+        self._fileno = next(self._fds)
+
+    def feed(self, line):
+        self.lines.append(line if line.endswith('\n') else line + '\n')
+
+    def readline(self):
+        return self.lines.popleft() if self.lines else ''
+
+    def write(self, text):
+        self.output.append(text)
+
+    def fileno(self):
+        return self._fileno
+
+
+# ---------------------------------------------- GPIO ---------------------------------------------- #
+HIGH = 1
+LOW = 0
+INPUT = 'INPUT'
+OUTPUT = 'OUTPUT'
+
+# Feedback pin -> output pin it is wired to: the relays (P9.15 reads P9.12, P9.16 reads P9.14) and the
+# LEDs (P8.12 reads P8.11, P8.14 reads P8.13).
+LOOPBACK = {'GPIO1_16': 'GPIO1_28', 'GPIO1_19': 'GPIO1_18', 'GPIO1_12': 'GPIO1_13', 'GPIO0_26': 'GPIO0_23'}
+
+
+class SimGPIO(object):
+    """ Pin levels for the fake bbio module. Feedback pins read back the output pin they are wired to. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.levels = {}
+        self.modes = {}
+        self.analog = {}
+        self.pwm = {}
+        # Pins listed here read back this fixed level, whatever was written (a stuck relay).
+        self.stuck = {}
+        # Pins listed here take this many (real) seconds for each read or write (a hung sysfs access).
+        self.delays = {}
+        self.writes = 0
+        self.reads = 0
+
+    def pinMode(self, pin, mode, *args, **kwargs):
+        self.modes[pin] = mode
+
+    def digitalWrite(self, pin, level):
+        if pin in self.delays:
+            time.sleep(self.delays[pin])
+        self.writes += 1
+        self.levels[pin] = level
+
+    def digitalRead(self, pin):
+        if pin in self.delays:
+            time.sleep(self.delays[pin])
+        self.reads += 1
+        if pin in self.stuck:
+            return self.stuck[pin]
+        return self.levels.get(LOOPBACK.get(pin, pin), LOW)
+
+    def analogRead(self, pin):
+        self.reads += 1
+        return self.analog.get(pin, 0)
+
+    def analogWrite(self, pin, value, resolution=8):
+        self.writes += 1
+        self.pwm[pin] = (value, resolution)
+
+
+gpio = SimGPIO()
+
+
+def _make_bbio():
+    bbio = types.ModuleType('bbio')
+    names = {'HIGH': HIGH, 'LOW': LOW, 'INPUT': INPUT, 'OUTPUT': OUTPUT,
+             'pinMode': gpio.pinMode, 'digitalWrite': gpio.digitalWrite,
+             'digitalRead': gpio.digitalRead, 'analogRead': gpio.analogRead,
+             'analogWrite': gpio.analogWrite}
+    for bank in range(4):
+        for bit in range(32):
+            names['GPIO{}_{}'.format(bank, bit)] = 'GPIO{}_{}'.format(bank, bit)
+    for ain in range(8):
+        names['AIN{}'.format(ain)] = 'AIN{}'.format(ain)
+    for pwm in ('PWM1A', 'PWM1B', 'PWM2A', 'PWM2B', 'ECAP0', 'ECAP1'):
+        names[pwm] = pwm
+    bbio.__dict__.update(names)
+    bbio.__all__ = sorted(names)
+    return bbio
+
+
+# ---------------------------------------------- VOLTTRON ---------------------------------------------- #
+class BaseAgent(object):
+    """ Minimal BaseAgent: subscribes decorated handlers on setup() and schedules timers on the bus. """
+
+    def __init__(self, bus=None, **kwargs):
+        super(BaseAgent, self).__init__()
+        self.bus = bus
+        self.reactor = bus.reactor
+
+    def setup(self):
+        for name in dir(type(self)):
+            handler = getattr(type(self), name, None)
+            for test in getattr(handler, '_sim_subscriptions', ()):
+                self.bus.subscribe(test, getattr(self, name))
+
+    def timer(self, interval, function, *args, **kwargs):
+        deadline = self.bus.clock.now() + interval
+        return self.reactor.add_timer(SimTimer(deadline, function, args, kwargs))
+
+    def periodic_timer(self, period, function, *args, **kwargs):
+        deadline = self.bus.clock.now() + period
+        return self.reactor.add_timer(SimTimer(deadline, function, args, kwargs, period))
+
+
+class PublishMixin(object):
+    def __init__(self, **kwargs):
+        super(PublishMixin, self).__init__(**kwargs)
+
+    def publish(self, topic, headers, *message):
+        self.bus.publish(topic, headers, list(message))
+
+    def publish_json(self, topic, headers, *message):
+        self.bus.publish(topic, headers, [json.dumps(part) for part in message])
+
+
+def _subscribe(test):
+    def decorate(func):
+        func._sim_subscriptions = getattr(func, '_sim_subscriptions', ()) + (test,)
+        return func
+    return decorate
+
+
+def match_start(prefix):
+    return _subscribe(lambda topic: topic if topic.startswith(prefix) else None)
+
+
+def match_exact(name):
+    return _subscribe(lambda topic: topic if topic == name else None)
+
+
+def match_all(func):
+    return _subscribe(lambda topic: topic)(func)
+
+
+def match_regex(pattern):
+    regex = re.compile(pattern)
+    return _subscribe(lambda topic: regex.match(topic))
+
+
+def load_config(config_path):
+    if isinstance(config_path, dict):
+        return dict(config_path)
+    with open(config_path) as config_file:
+        return json.load(config_file)
+
+
+def _make_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def install():
+    """ Register the fake volttron, zmq and bbio modules and put the agent packages on sys.path. """
+    if 'bbio' in sys.modules and getattr(sys.modules['bbio'], '__sim__', False):
+        return
+    utils = _make_module('volttron.platform.agent.utils', load_config=load_config,
+                         setup_logging=lambda *args, **kwargs: None,
+                         default_main=lambda *args, **kwargs: None)
+    matching = _make_module('volttron.platform.agent.matching', match_start=match_start,
+                            match_exact=match_exact, match_all=match_all, match_regex=match_regex)
+    agent = _make_module('volttron.platform.agent', BaseAgent=BaseAgent, PublishMixin=PublishMixin,
+                         utils=utils, matching=matching)
+    headers = _make_module('volttron.platform.messaging.headers')
+    messaging = _make_module('volttron.platform.messaging', headers=headers)
+    platform = _make_module('volttron.platform', agent=agent, messaging=messaging)
+    volttron = _make_module('volttron', platform=platform)
+    jsonapi = _make_module('zmq.utils.jsonapi', loads=json.loads, dumps=json.dumps)
+    zmq_utils = _make_module('zmq.utils', jsonapi=jsonapi)
+    zmq = _make_module('zmq', utils=zmq_utils)
+    bbio = _make_bbio()
+    bbio.__sim__ = True
+    sys.modules.update({
+        'volttron': volttron, 'volttron.platform': platform,
+        'volttron.platform.agent': agent, 'volttron.platform.agent.utils': utils,
+        'volttron.platform.agent.matching': matching,
+        'volttron.platform.messaging': messaging, 'volttron.platform.messaging.headers': headers,
+        'zmq': zmq, 'zmq.utils': zmq_utils, 'zmq.utils.jsonapi': jsonapi,
+        'bbio': bbio,
+    })
+    for directory in ['BBCommon'] + [directory for directory, _ in AGENTS.values()]:
+        path = os.path.join(REPO_DIR, directory)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    # State boards go in a private directory instead of the machine's shared memory.
+    from bbcommon import stateboard
+    stateboard.BOARD_DIR = tempfile.mkdtemp(prefix='simbus-boards-')
+    atexit.register(shutil.rmtree, stateboard.BOARD_DIR, True)
+
+
+def agent_class(name):
+    """ Import and return the real agent class called name (e.g. 'DehumAgent'). """
+    install()
+    directory, module_name = AGENTS[name]
+    __import__(module_name)
+    return getattr(sys.modules[module_name], name)
+
+
+def spawn(bus, name, config=None, **kwargs):
+    """ Start the named agent on bus, with its shipped config unless another one is given. """
+    cls = agent_class(name)
+    if config is None:
+        config = CONFIGS[name]
+    if config is None and name in ('AskAgent', 'UserInAgent', 'UIAgent'):
+        # Input agents listen on a socket in setup(); let the OS pick a free port.
+        config = {'address': ('127.0.0.1', 0)}
+    if name in ('DehumAgent', 'LEDAgent'):
+        config = load_config(config)
+        state_file = config.get('state_file', '')
+        if not os.path.isabs(state_file) or state_file == load_config(CONFIGS[name]).get('state_file'):
+            # Keep saved output states out of the working directory (and the board's own state file). Each
+            # spawn starts with no saved state.
+            config['state_file'] = _temp_path('.state')
+    if name in ('AskAgent', 'DehumAgent'):
+        from bbcommon.journal import JOURNAL_DEFAULTS
+        config = load_config(config)
+        journal = dict(config.get('journal', {}))
+        path = journal.get('path', JOURNAL_DEFAULTS['path'])
+        if not os.path.isabs(path) or path == JOURNAL_DEFAULTS['path']:
+            # Likewise for the command journal. Pass the same (other) absolute path to both agents to link them.
+            journal['path'] = _temp_path('.journal')
+            config['journal'] = journal
+    if isinstance(config, dict):
+        config = _write_config(config)
+    return bus.spawn(cls, config, **kwargs)
+
+
+def _write_config(config):
+    handle, path = tempfile.mkstemp(prefix='simbus-', suffix='.json')
+    with os.fdopen(handle, 'w') as config_file:
+        json.dump(config, config_file)
+    atexit.register(os.remove, path)
+    return path
+
+
+def _temp_path(suffix):
+    """ A path for a file that doesn't exist yet, removed at exit if it was created. """
+    handle, path = tempfile.mkstemp(prefix='simbus-', suffix=suffix)
+    os.close(handle)
+    os.remove(path)
+    atexit.register(lambda: os.path.exists(path) and os.remove(path))
+    return path
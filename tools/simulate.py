@@ -0,0 +1,112 @@
+# ---------------------------------------------- OVERVIEW ---------------------------------------------- #
+# Runs a control policy against the ControlAgent digital twin (a simulated room and dehumidifier) for     #
+# days or weeks of simulated time, on the simulated bus (simbus.py) with a virtual clock, so it takes     #
+# seconds instead of days.                                                                               #
+# The policy is a small agent that reads the twin's '<prefix>/sensor' readings and sends commands on      #
+# 'userinput/state', like a user or the dehumidifier control agent's humidistat would:                    #
+#   - humidistat: dhcontrol/humidistat.py with the given setpoint, hysteresis and min_on/min_off.         #
+#   - always: runs the dehumidifier all the time; none: never runs it.                                    #
+# At the end it prints the energy used, compressor starts and how long the humidity was over --ceiling.  #
+#                                                                                                        #
+#   python tools/simulate.py --days 7 --setpoint 50 --hysteresis 3 --output week.json                   #
+# ------------------------------------------------------------------------------------------------------ #
+import argparse
+import json
+import sys
+
+import simbus
+
+
+def make_policy(name, args, sensor_topic):
+    """ The policy agent class. Defined once simbus is installed, since it needs the fake VOLTTRON. """
+    from volttron.platform.agent import BaseAgent, PublishMixin, matching
+    from dhcontrol.humidistat import HUMIDISTAT_DEFAULTS, Humidistat
+
+    class PolicyAgent(PublishMixin, BaseAgent):
+        def __init__(self, config_path, **kwargs):
+            super(PolicyAgent, self).__init__(**kwargs)
+            self.humidistat = Humidistat(dict(HUMIDISTAT_DEFAULTS, setpoint=args.setpoint,
+                                              hysteresis=args.hysteresis, min_on=args.min_on,
+                                              min_off=args.min_off))
+            self.running = False
+            self.last_change = None
+            self.commands = 0
+
+        @matching.match_exact(sensor_topic)
+        def on_sensor(self, topic, headers, message, match):
+            reading = json.loads(message[0])
+            if name == 'humidistat':
+                command = self.humidistat.decide(reading['humidity'], self.running, self.last_change,
+                                                 reading['time'])
+            elif name == 'always':
+                command = None if self.running else 'run dehum'
+            else:
+                command = None
+            if command is not None:
+                self.running = command == 'run dehum'
+                self.last_change = reading['time']
+                self.commands += 1
+                self.publish_json('userinput/state', {}, ('policy', command))
+
+    return PolicyAgent
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Run a control policy against the simulated dehumidifier.')
+    parser.add_argument('--days', type=float, default=7.0, help='simulated days (default 7)')
+    parser.add_argument('--policy', choices=('humidistat', 'always', 'none'), default='humidistat')
+    parser.add_argument('--setpoint', type=float, default=50.0)
+    parser.add_argument('--hysteresis', type=float, default=5.0)
+    parser.add_argument('--min-on', type=float, default=300.0)
+    parser.add_argument('--min-off', type=float, default=300.0)
+    parser.add_argument('--ceiling', type=float, default=60.0, help='%%RH counted as too humid (default 60)')
+    parser.add_argument('--room', help='JSON object overriding the twin\'s room settings')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv[1:])
+
+    clock = simbus.VirtualClock()
+    simbus.use_clock(clock)
+    simbus.install()
+    bus = simbus.SimBus(clock)
+    config = simbus.load_config(simbus.CONFIGS['ControlAgent'])
+    config['twin'] = dict(config.get('twin', {}), start_time=None, time_scale=1.0)
+    config['room'] = dict(config.get('room', {}), **json.loads(args.room or '{}'))
+    twin = simbus.spawn(bus, 'ControlAgent', config)
+    policy = bus.spawn(make_policy(args.policy, args, twin.prefix + '/sensor'))
+
+    interval = float(twin.twin_config['sensor_interval'])
+    totals = {'readings': 0, 'over_ceiling': 0, 'max_humidity': 0.0}
+
+    def tap(now, topic, headers, message):
+        if topic == twin.prefix + '/sensor':
+            humidity = json.loads(message[0])['humidity']
+            totals['readings'] += 1
+            totals['over_ceiling'] += humidity > args.ceiling
+            totals['max_humidity'] = max(totals['max_humidity'], humidity)
+    bus.taps.append(tap)
+
+    wall_start = simbus._wall_time()
+    bus.run_for(args.days * 86400.0)
+    wall = simbus._wall_time() - wall_start
+
+    room = twin.room
+    results = {
+        'policy': args.policy, 'days': args.days, 'wall_seconds': wall,
+        'speed': args.days * 86400.0 / wall if wall else None,
+        'energy_kwh': room.energy_kwh, 'compressor_starts': room.compressor_starts,
+        'compressor_hours': room.compressor_seconds / 3600.0, 'commands': policy.commands,
+        'hours_over_ceiling': totals['over_ceiling'] * interval / 3600.0,
+        'max_humidity': totals['max_humidity'], 'final_humidity': room.humidity,
+        'messages': bus.published,
+    }
+    for key in sorted(results):
+        value = results[key]
+        print('{:<20}{}'.format(key, '{:.2f}'.format(value) if isinstance(value, float) else value))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())